@@ -4,7 +4,7 @@
 
 from ann_package import job
 import boto3
-import subprocess, os, ast
+import subprocess, os, ast, json
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
@@ -15,14 +15,59 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config
 
 # Access configurations
 table_name = config['aws']['TableName']
+summary_table_name = config['aws']['SummaryTableName']
 request_queue_url = config['aws']['QueueUrl']
+job_events_topic_arn = config['aws']['JobEventsTopicArn']
 
 # Initialize Boto3 clients for SQS and S3
 sqs = boto3.client('sqs')
+sns = boto3.client('sns', region_name='us-east-1')
 s3 = boto3.resource('s3', config=Config(signature_version='s3v4', region_name='us-east-1'))
 
 mpcs_path = '/home/ec2-user/mpcs-cc'    # local path
 
+def publish_job_event(job_id, user_id, event):
+    """Announce a job status change on the job events topic (web status streams listen)"""
+    try:
+        sns.publish(
+            TopicArn=job_events_topic_arn,
+            Message=json.dumps({'job_id': job_id, 'user_id': user_id, 'event': event}),
+            MessageGroupId=job_id,
+            MessageDeduplicationId=f"{job_id}-{event}"
+        )
+    except ClientError as e:
+        print(f"Couldn't publish {event} event for job {job_id}: {e}")
+
+def update_job_status(job_id, user_id, status, **deltas):
+    """Move a PENDING job to `status` and add deltas to the user's job summary
+    counters (e.g. count_pending=-1), in one transaction. Returns False, and
+    changes nothing, if the job is no longer PENDING (e.g. the message was
+    delivered again), so a job is never counted twice.
+    """
+    dynamo = boto3.resource('dynamodb')
+    try:
+        dynamo.meta.client.transact_write_items(TransactItems=[
+            {'Update': {
+                'TableName': table_name,
+                'Key': {'job_id': job_id},
+                'UpdateExpression': 'SET job_status = :new_status',
+                'ConditionExpression': 'job_status = :current_status',
+                'ExpressionAttributeValues': {':new_status': status, ':current_status': 'PENDING'}
+            }},
+            {'Update': {
+                'TableName': summary_table_name,
+                'Key': {'user_id': user_id},
+                'UpdateExpression': 'ADD ' + ', '.join(f'{k} :{k}' for k in deltas),
+                'ExpressionAttributeValues': {f':{k}': v for k, v in deltas.items()}
+            }}
+        ])
+    except ClientError as e:
+        reasons = e.response.get('CancellationReasons', [])
+        if reasons and reasons[0].get('Code') == 'ConditionalCheckFailed':
+            return False
+        raise
+    return True
+
 def poll_messages():
     while True:
         # Poll the message queue
@@ -75,18 +120,6 @@ def poll_messages():
                 except Exception as e:
                     print(f"An unexpected error occurred: {e}")
 
-                # Update job status to DB
-                # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
-                dynamo = boto3.resource('dynamodb')
-                table = dynamo.Table(table_name)   # move
-
-                update_expression = 'SET job_status = :new_status'
-                expression_attribute_values = {
-                    ':new_status': 'RUNNING',
-                    ':current_status': 'PENDING'
-                }
-                condition_expression = 'job_status = :current_status'
-
                 #--  1. Start the annotation process in bg
                 try:
                     # $ python anntools/hw4_run.py <path-of-file-to-run> <job_id>
@@ -100,13 +133,10 @@ def poll_messages():
                     print('Start the annotation process \n')
                 except Exception as e:
                     try :
-                        response = table.update_item(
-                        Key={ 'job_id': job_id },
-                        UpdateExpression='SET job_status = :job_status',
-                        ExpressionAttributeValues={':job_status': 'FAILED'},
-                        ReturnValues='ALL_NEW'  # Returns all attributes of the item after the update
-                        )
-                        print('Error running popen. Update job status : FAILED \n')
+                        # Only a PENDING job fails here; counted once
+                        if update_job_status(job_id, user_id, 'FAILED',
+                                count_pending=-1, count_failed=1):
+                            print('Error running popen. Update job status : FAILED \n')
                     except ClientError as e:
                         print(f"Error while updating job_status to FAILURE: {e.response['Error']['Message']}")
                         # go to delete message
@@ -115,23 +145,18 @@ def poll_messages():
                     # go to delete message
 
 
-                #-- 2. Update conditional status
+                #-- 2. Update conditional status (and the job summary with it)
+                # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
                 try:
-                    response = table.update_item(
-                        Key={ 'job_id': job_id },
-                        UpdateExpression=update_expression,
-                        ExpressionAttributeValues=expression_attribute_values,
-                        ConditionExpression=condition_expression,
-                        ReturnValues='ALL_NEW'                  # Returns all attributes of the item after the update
-                    )
-                    # print("Update Item succeeded:", response['Attributes'])
+                    if update_job_status(job_id, user_id, 'RUNNING',
+                            count_pending=-1, count_running=1):
+                        publish_job_event(job_id, user_id, 'running')
+                    else:
+                        print("Condition not met, item's job_status is not 'PENDING'. Update not performed.")
 
-                except Exception as e:
+                except ClientError as e:
                     error_code = e.response['Error']['Code']
-                    if error_code == 'ConditionalCheckFailedException':
-                        print("Condition not met, item's job_status is not 'PENDING'. Update not performed.")
-                    else:
-                        print(f'Error while updating job status {e}. Error Code: {error_code}')
+                    print(f'Error while updating job status {e}. Error Code: {error_code}')
                     # go to delete message
 
 
@@ -51,6 +51,46 @@ class Timer(object):
         if self.verbose:
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+def complete_job(job_id, new_fields, result_file_size):
+    """Mark a job COMPLETED and count it in the user's job summary, in one
+    transaction. The job is counted as leaving RUNNING (or PENDING, if the
+    annotator hasn't marked it running yet), and not counted again if it is
+    already COMPLETED. Returns the job item after the update.
+    """
+    dynamo = boto3.resource('dynamodb')
+    table = dynamo.Table(table_name)
+    user_id = table.get_item(Key={'job_id': job_id}, ConsistentRead=True)['Item']['user_id']
+
+    for current_status in ('RUNNING', 'PENDING'):
+        values = {f':{k}': v for k, v in new_fields.items()}
+        values[':current_status'] = current_status
+        try:
+            dynamo.meta.client.transact_write_items(TransactItems=[
+                {'Update': {
+                    'TableName': table_name,
+                    'Key': {'job_id': job_id},
+                    'UpdateExpression': 'SET ' + ', '.join(f'{k} = :{k}' for k in new_fields.keys()),
+                    'ConditionExpression': 'job_status = :current_status',
+                    'ExpressionAttributeValues': values
+                }},
+                {'Update': {
+                    'TableName': config['aws']['SummaryTableName'],
+                    'Key': {'user_id': user_id},
+                    'UpdateExpression': f'ADD count_{current_status.lower()} :minus_one, '
+                        'count_completed :one, bytes_annotated :size',
+                    'ExpressionAttributeValues': {':minus_one': -1, ':one': 1, ':size': result_file_size}
+                }}
+            ])
+            break
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons', [])
+            if not reasons or reasons[0].get('Code') != 'ConditionalCheckFailed':
+                raise
+    else:
+        print(f"Job {job_id} was already completed; not counted again")
+
+    return table.get_item(Key={'job_id': job_id}, ConsistentRead=True)['Item']
+
 # Custom JSON encoder for handling Decimal objects
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -89,6 +129,7 @@ if __name__ == '__main__':
         # print(f"uploaded {s3_results_bucket}")
 
         s3.upload_file(result_file, s3_results_bucket, f'{result_bucket_path}.vcf.count.log')
+        result_file_size = os.path.getsize(result_file)
 
         # 3. Clean up (delete) local job files
         try:
@@ -103,9 +144,6 @@ if __name__ == '__main__':
         print("A valid .vcf file must be provided as input to this program.")
 
     ##---------------- Update job detail to DB --------------------------
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table('nichada_annotations')
-
     # Define the new fields and their values you want to add
     new_fields = {
         's3_results_bucket': s3_results_bucket,
@@ -115,19 +153,13 @@ if __name__ == '__main__':
         'job_status': "COMPLETED"
     }
 
-    update_expression = 'SET ' + ', '.join(f'{k} = :{k}' for k in new_fields.keys())
-    expression_attribute_values = {f':{k}': v for k, v in new_fields.items()}
-
+    # The job and its user's job summary are updated together
     try:
-        response = table.update_item(
-            Key={'job_id': job_id},
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_attribute_values,
-            ReturnValues='ALL_NEW'  # Returns all attributes of the item after the update
-        )
+        response = {'Attributes': complete_job(job_id, new_fields, result_file_size)}
         print("Update Item succeeded:", response)
     except Exception as e:
         print("Error updating item:", e)
+        raise
 
     # Send message to request queue results
     # Move your code here...
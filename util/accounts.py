@@ -0,0 +1,134 @@
+# accounts.py
+#
+# Accounts database access for the util daemons
+#
+# One AccountsClient per database keeps the RDS secret (refetched after
+# secret_ttl, or when a login fails after a rotation), a small
+# thread-safe psycopg2 connection pool (a replaced pool is closed once
+# its connections in use are returned), and a short-lived cache of
+# profiles: a user's role only changes on subscribe/unsubscribe, and a
+# few seconds of staleness is harmless to the archive daemon.
+#
+##
+
+import json
+import time
+from threading import Lock
+
+import boto3
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import psycopg2.extensions
+
+# Prepared once per connection; the identity ID is always a parameter
+# (profiles.identity_id is a uuid column)
+PROFILE_STATEMENT = 'get_profile'
+PROFILE_QUERY = f"PREPARE {PROFILE_STATEMENT} (uuid) AS " \
+  "SELECT * FROM profiles WHERE identity_id = $1"
+
+"""Connection that remembers whether the profile statement is prepared"""
+class AccountsConnection(psycopg2.extensions.connection):
+  profile_prepared = False
+
+class AccountsClient(object):
+  def __init__(self, db_name, secret_id='rds/accounts_database',
+    region_name=None, pool_size=4, profile_ttl=30, secret_ttl=3600,
+    asm=None, clock=time.monotonic):
+    self.db_name = db_name
+    self.secret_id = secret_id
+    self.pool_size = pool_size
+    self.profile_ttl = profile_ttl
+    self.secret_ttl = secret_ttl
+    self.clock = clock
+    self.asm = asm or boto3.client('secretsmanager', region_name=region_name)
+    self.lock = Lock()
+    self.pool = None
+    self.pool_created_at = None
+    self.in_use = {}          # pool -> callers between connection_pool and release_pool
+    self.retired = []         # replaced pools, closed once no longer in use
+    self.profiles = {}        # identity_id -> (profile, expires_at)
+
+  """Connection pool, (re)created with a freshly fetched secret when it is
+  older than secret_ttl or is the `stale` pool that just failed; the
+  caller must hand it back with release_pool
+  """
+  def connection_pool(self, stale=None):
+    with self.lock:
+      if self.pool is None or self.pool is stale or \
+        self.clock() - self.pool_created_at >= self.secret_ttl:
+        response = self.asm.get_secret_value(SecretId=self.secret_id)
+        rds_secret = json.loads(response['SecretString'])
+        if self.pool is not None:
+          self.retired.append(self.pool)
+        self.pool = psycopg2.pool.ThreadedConnectionPool(1, self.pool_size,
+          host=rds_secret['host'], port=rds_secret['port'],
+          user=rds_secret['username'], password=rds_secret['password'],
+          dbname=self.db_name, connection_factory=AccountsConnection)
+        self.pool_created_at = self.clock()
+        self.close_retired()
+      self.in_use[self.pool] = self.in_use.get(self.pool, 0) + 1
+      return self.pool
+
+  def release_pool(self, pool):
+    with self.lock:
+      self.in_use[pool] -= 1
+      if not self.in_use[pool]:
+        del self.in_use[pool]
+      self.close_retired()
+
+  # Close replaced pools nobody is using (called with the lock held)
+  def close_retired(self):
+    for pool in [pool for pool in self.retired if pool not in self.in_use]:
+      self.retired.remove(pool)
+      pool.closeall()
+
+  def query_profile(self, pool, identity_id):
+    try:
+      return self.fetch_profile(pool, identity_id)
+    finally:
+      self.release_pool(pool)
+
+  def fetch_profile(self, pool, identity_id):
+    connection = pool.getconn()
+    try:
+      with connection.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+        if not connection.profile_prepared:
+          cursor.execute(PROFILE_QUERY)
+          connection.profile_prepared = True
+        cursor.execute(f"EXECUTE {PROFILE_STATEMENT} (%s)", (identity_id,))
+        row = cursor.fetchone()
+      connection.rollback()     # end the read-only transaction
+    except psycopg2.Error:
+      # Drop the connection; it may be broken
+      pool.putconn(connection, close=True)
+      raise
+    pool.putconn(connection)
+    return dict(row) if row else None
+
+  """A user's profile as a dict (None if there is no such user)"""
+  def get_profile(self, identity_id):
+    with self.lock:
+      cached = self.profiles.get(identity_id)
+    if cached and cached[1] > self.clock():
+      return cached[0]
+
+    pool = self.connection_pool()
+    try:
+      profile = self.query_profile(pool, identity_id)
+    except psycopg2.OperationalError:
+      # Connection lost or credentials rotated: start over once
+      profile = self.query_profile(self.connection_pool(stale=pool), identity_id)
+
+    with self.lock:
+      if len(self.profiles) >= 10000:
+        now = self.clock()
+        self.profiles = {k: v for k, v in self.profiles.items() if v[1] > now}
+      self.profiles[identity_id] = (profile, self.clock() + self.profile_ttl)
+    return profile
+
+  def invalidate(self, identity_id):
+    with self.lock:
+      self.profiles.pop(identity_id, None)
+
+### EOF
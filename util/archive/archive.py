@@ -7,19 +7,24 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import io
 import os
 import sys
 import ast
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from ann_package import job
 
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 from botocore.client import Config
 
 # Import utility helpers ??
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import glacier
+import compression
+import tiering
 
 # --------
 # Get configuration
@@ -28,6 +33,12 @@ config = ConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'archive_config.ini'))
 vault_name = config['aws']['VaultName']
 archive_queue_url = config['aws']['ArchiveQueueUrl']
+# The archive queue is fed by the retention timer (util/retention) at
+# each job's retention deadline. If PreStage is on, results are copied to
+# Glacier ahead of that from the staging queue, which is subscribed to the
+# job results topic and gets jobs as soon as they complete
+staging_queue_url = config['aws']['StagingQueueUrl'] \
+    if config.getboolean('archive', 'PreStage') else None
 table_name = config['aws']['TableName']
 
 # s3
@@ -35,31 +46,226 @@ sqs = boto3.client('sqs')
 s3 = boto3.resource('s3', config=Config(signature_version='s3v4', region_name='us-east-1'))
 s3_client = boto3.client('s3')
 
+# Glacier uploads: results larger than one part use a parallel multipart
+# upload; with StreamFromS3 the S3 object is read straight into the upload
+# instead of being downloaded to job_data first
+stream_from_s3 = config.getboolean('glacier', 'StreamFromS3')
+glacier_uploader = glacier.GlacierUploader(vault_name,
+    part_size=config.getint('glacier', 'PartSizeMB') * glacier.MB,
+    max_workers=config.getint('glacier', 'UploadThreads'),
+    max_attempts=config.getint('glacier', 'MaxAttempts'),
+    compression_level=config.getint('glacier', 'CompressionLevel'))
+
+# With Backend s3, results are archived in place, by moving them to the
+# S3Tier storage class, rather than uploaded to the Glacier vault
+archive_backend = config['archive']['Backend']
+s3_tier = config['archive']['S3Tier']
+
+# Results are compressed with this codec on their way to Glacier; the
+# codec is recorded on the job item (archive_codec) for thaw
+archive_codec = config['glacier']['Compression']
+if archive_codec == 'none':
+    archive_codec = None
+
+# Results up to PackMemberMaxMB are packed many to an archive; the pack is
+# uploaded once it holds PackSizeMB or is PackWindowSeconds old
+pack_results = config.getboolean('glacier', 'PackResults')
+pack_member_max_size = config.getint('glacier', 'PackMemberMaxMB') * glacier.MB
+archive_pack = glacier.ArchivePack(
+    max_size=config.getint('glacier', 'PackSizeMB') * glacier.MB,
+    window=config.getint('glacier', 'PackWindowSeconds'))
+
+# Work already done for a job (e.g. before a crash) is recorded here
+ledger = helpers.processing_ledger()
+
 # Add utility code here
 def upload_to_glacier(file_path):
-    # Create a Glacier client
-    glacier_client = boto3.client('glacier')
+    try:
+        # Upload the archive to Glacier (in parts if it is large)
+        archive_id = glacier_uploader.upload_file(file_path, codec=archive_codec)
+        # print(f"Archive uploaded: {archive_id}")
+        return archive_id
+    except (ClientError, OSError) as e:
+        print(f"Error uploading archive: {e}")
+        return None
+
+def stream_to_glacier(bucket_name, s3_key_result_file):
+    try:
+        return glacier_uploader.upload_s3_object(s3_client, bucket_name, s3_key_result_file,
+            codec=archive_codec)
+    except (ClientError, OSError) as e:
+        print(f"Error streaming {s3_key_result_file} to Glacier: {e}")
+        return None
+
+def download_and_upload_to_glacier(s3_results_bucket, s3_key_result_file):
+    # Create local directory
+    result_file_name = s3_key_result_file.split('/')[-1]
+    job_id_path, _f = s3_key_result_file.split('~')         # "nichada/UserX/ce848421-d5dc-4899-afb9-4043381cac5f"
+    job_specific_directory = job.create_job(s3_key_result_file, job_id_path, result_file_name) #"./job_data/nichada/UserX/ce848421-d5dc-4899-afb9-4043381cac5f/"
+
+    # Download result file S3 object to a local file for free users
+    # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-download-file.html
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_file.html
+    try:
+        s3.meta.client.download_file(s3_results_bucket, s3_key_result_file, f'{job_specific_directory}/{result_file_name}')
+        # print("File download succeeded!\n")
+    except ClientError as e:
+        error_code = e.response['Error']['Code']
+        if error_code == "403":
+            print(f"Key not found. \n{e}")
+        else:
+            print(f"An unexpected error occurred: {e}")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+
+    # ------------------------------------------
+    # ---------- Upload to Glacier -------------
+    result_file = f'{job_specific_directory}/{result_file_name}'
+    archive_id = upload_to_glacier(result_file)
 
-    # Open the file you want to upload
-    with open(file_path, 'rb') as file:
+    # Clean up (delete) local job files
+    try:
+        os.remove(result_file)
+        # print(f"File result file deleted successfully.")
+    except OSError as e:
+        print(f"Error deleting file '{result_file}' : {str(e)}")
+    return archive_id
+
+def move_to_archive_tier(job_id, s3_results_bucket, s3_key_result_file):
+    """Archive a result in place (S3 backend); returns False on failure"""
+    try:
+        tiering.change_storage_class(s3_client, s3_results_bucket, s3_key_result_file, s3_tier)
+    except ClientError as e:
+        print(f"Error moving {s3_key_result_file} to {s3_tier}: {e}")
+        return False
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET results_file_archive_id = :archive_id, archive_backend = :backend',
+        ExpressionAttributeValues={
+            ':archive_id': f"s3://{s3_results_bucket}/{s3_key_result_file}",
+            ':backend': tiering.S3_BACKEND
+        }
+    )
+    return True
+
+def pack_result(job_id, user_id, s3_results_bucket, s3_key_result_file, queue_url,
+        receipt_handle, staged=False):
+    """Add a small result to the archive pack; False if it is too large to pack"""
+    try:
+        response = s3_client.get_object(Bucket=s3_results_bucket, Key=s3_key_result_file)
+    except ClientError as e:
+        print(f"Error reading {s3_key_result_file} for packing: {e}")
+        return False
+    if response['ContentLength'] > pack_member_max_size:
+        response['Body'].close()
+        return False
+    data = response['Body'].read()
+    if archive_codec:
+        # Members are compressed one by one, so each can be restored alone
+        data = compression.compress(data, archive_codec, glacier_uploader.compression_level)
+
+    # Keep the message hidden until the pack has been uploaded
+    sqs.change_message_visibility(
+        QueueUrl=queue_url,
+        ReceiptHandle=receipt_handle,
+        VisibilityTimeout=archive_pack.window + 300
+    )
+    archive_pack.add(data, job_id=job_id, user_id=user_id,
+        s3_key_result_file=s3_key_result_file, queue_url=queue_url,
+        receipt_handle=receipt_handle, staged=staged)
+    return True
+
+def flush_pack():
+    """Upload the archive pack and record each member's place in it
+    Returns the (queue URL, receipt handle) of the members' messages, to be
+    deleted
+    """
+    data, members = archive_pack.take()
+    if not members:
+        return []
+    try:
+        archive_id = glacier_uploader.upload(io.BytesIO(data).read, len(data),
+            description=f"GAS results pack ({len(members)} files)")
+    except (ClientError, OSError) as e:
+        # The members' messages become visible again and are repacked
+        print(f"Error uploading archive pack: {e}")
+        return []
+
+    receipts = []
+    for member in members:
         try:
-            # Upload the archive to Glacier
-            response = glacier_client.upload_archive(vaultName=vault_name, body=file)
-            # print(f"Archive uploaded: {response['archiveId']}")
-            return response['archiveId']
-        except ClientError as e:
-            print(f"Error uploading archive: {e}")
-            return None
+            upload_archive_id(member['job_id'], archive_id, staged=member['staged'],
+                archive_offset=member['archive_offset'],
+                archive_length=member['archive_length'],
+                archive_size=len(data))
+        except (ClientError, BotoCoreError) as e:
+            # The result stays in S3 and its message is retried (and repacked)
+            print(f"Error recording the packed archive of job {member['job_id']}: {e}")
+            continue
+        if not member['staged']:
+            finish_archive(member['job_id'], member['user_id'], member['s3_key_result_file'])
+        ledger.record(member['job_id'], ledger_action(member['staged']))
+        receipts.append((member['queue_url'], member['receipt_handle']))
+    return receipts
+
+def finish_archive(job_id, user_id, s3_key_result_file):
+    """After a result is in Glacier: announce it and delete the S3 copy"""
+    helpers.publish_job_event(job_id, 'archived', user_id=user_id)
+    helpers.count_job_archived(job_id, user_id)
+
+    # Delete result files from s3 bucket
+    s3_client.delete_object(Bucket=config['aws']['ResultBucketName'], Key=s3_key_result_file)
+    # print(f"Deleted result file from from s3 bucket\n")
+
+def delete_messages(receipts):
+    """Delete processed messages, given as (queue URL, receipt handle), 10 per request"""
+    by_queue = {}
+    for queue_url, receipt_handle in receipts:
+        by_queue.setdefault(queue_url, []).append(receipt_handle)
 
-def upload_archive_id(job_id, archive_id):
-    """upload Glacier archive id to DynamoDb"""
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(table_name)
+    for queue_url, receipt_handles in by_queue.items():
+        for i in range(0, len(receipt_handles), 10):
+            entries = [{'Id': str(n), 'ReceiptHandle': handle}
+                for n, handle in enumerate(receipt_handles[i:i + 10])]
+            try:
+                response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+                for failure in response.get('Failed', []):
+                    print(f"Failed to delete message from the queue: {failure.get('Message')}")
+            except ClientError as e:
+                print(f"Failed to delete messages from the queue: {e} \n")
+
+# Archive attributes of a job item, and where they are kept while the
+# archive is only staged (before the retention deadline)
+STAGED_ATTRIBUTES = {
+    'results_file_archive_id': 'staged_archive_id',
+    'archive_offset': 'staged_archive_offset',
+    'archive_length': 'staged_archive_length',
+    'archive_size': 'staged_archive_size',
+    'archive_codec': 'staged_archive_codec',
+}
+
+def upload_archive_id(job_id, archive_id, staged=False, **fields):
+    """upload Glacier archive id to DynamoDb
+    Packed results also record archive_offset, archive_length and archive_size
+    (of the compressed member, if compressed). A staged archive is recorded
+    under the staged_* names, unless the job was archived in the meantime.
+    Any other error is raised, so that the result isn't deleted from S3
+    before its archive is recorded; the message is then retried.
+    """
+    table = helpers.aws_resource('dynamodb').Table(table_name)
 
     # Define the new fields and their values you want to add
     new_fields = {
         'results_file_archive_id': archive_id,
+        **fields
     }
+    if archive_codec:
+        new_fields['archive_codec'] = archive_codec
+    kwargs = {}
+    if staged:
+        new_fields = {STAGED_ATTRIBUTES[k]: v for k, v in new_fields.items()}
+        kwargs['ConditionExpression'] = 'attribute_not_exists(results_file_archive_id)'
     update_expression = 'SET ' + ', '.join(f'{k} = :{k}' for k in new_fields.keys())
     expression_attribute_values = {f':{k}': v for k, v in new_fields.items()}
 
@@ -68,95 +274,191 @@ def upload_archive_id(job_id, archive_id):
             Key={'job_id': job_id},
             UpdateExpression=update_expression,
             ExpressionAttributeValues=expression_attribute_values,
-            ReturnValues='ALL_NEW'  # Returns all attributes of the item after the update
+            ReturnValues='ALL_NEW',  # Returns all attributes of the item after the update
+            **kwargs
         )
         # print("Update Item succeeded:", response)
-    except Exception as e:
-        print("Error updating item:", e)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print("Error updating item:", e)
+            raise
+        print(f"Job {job_id} was archived before its staged copy was recorded")
+        if 'archive_offset' not in fields:
+            delete_archive(archive_id)
     return
 
-def poll_messages():
-    while True:
-        # Poll the message queue
-        messages = sqs.receive_message(
-            QueueUrl=archive_queue_url,
-            MaxNumberOfMessages=1,  # Adjust if you want to process more messages per request
-            WaitTimeSeconds=5  # Enable long polling, up to 20 seconds
+def get_staged_archive(job_id):
+    """The job's staged_* attributes, or None if no archive is staged"""
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    item = table.get_item(
+        Key={'job_id': job_id},
+        ProjectionExpression=', '.join(STAGED_ATTRIBUTES.values()),
+        ConsistentRead=True
+    ).get('Item') or {}
+    return item if 'staged_archive_id' in item else None
+
+def cut_over_staged_archive(job_id):
+    """At the retention deadline: make the staged archive the job's archive
+    Returns False if there is no staged archive to cut over to.
+    """
+    staged = get_staged_archive(job_id)
+    if staged is None:
+        return False
+    new_fields = {k: staged[v] for k, v in STAGED_ATTRIBUTES.items() if v in staged}
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET ' + ', '.join(f'{k} = :{k}' for k in new_fields) +
+                ' REMOVE ' + ', '.join(STAGED_ATTRIBUTES.values()),
+            ExpressionAttributeValues={f':{k}': v for k, v in new_fields.items()},
+            ConditionExpression='attribute_exists(staged_archive_id)'
         )
+    except ClientError as e:
+        print(f"Error cutting over staged archive of job {job_id}: {e}")
+        return False
+    return True
 
-        if 'Messages' in messages:  # Check if any messages were returned
-            for message in messages['Messages']:
-                # ast.iteraleval : parse dict from str
-                # https://medium.com/@aniruddhapal/the-power-of-the-ast-literal-eval-method-in-python-8fb4014a2574
-                try :
-                    body = ast.literal_eval(message['Body'])
-                    # print("message body: " , body, "\n")
-                    data = ast.literal_eval(body['Message'])
-
-                    job_id=data['job_id']
-                    user_id=data['user_id']
-                    s3_key_result_file=data['s3_key_result_file']
-                    s3_results_bucket=data['s3_results_bucket']
-
-                    # Create local directory
-                    result_file_name = s3_key_result_file.split('/')[-1]
-                    job_id_path, _f = s3_key_result_file.split('~')         # "nichada/UserX/ce848421-d5dc-4899-afb9-4043381cac5f"
-                    job_specific_directory = job.create_job(s3_key_result_file, job_id_path, result_file_name) #"./job_data/nichada/UserX/ce848421-d5dc-4899-afb9-4043381cac5f/"
-
-                except Exception as e:
-                    print(f'Error while parsing message. {e}')
-                    sqs.delete_message(
-                        QueueUrl=archive_queue_url,
-                        ReceiptHandle=message['ReceiptHandle']
-                    )
-                    print(f"Deleted failed message: {job_id} from the queue")
-                    continue  # go to next message
-
-                profile = helpers.get_user_profile(id=user_id)
-
-                if profile['role'] != 'premium_user':
-                    # Download result file S3 object to a local file for free users
-                    # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-download-file.html
-                    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_file.html
-                    try:
-                        s3.meta.client.download_file(s3_results_bucket, s3_key_result_file, f'{job_specific_directory}/{result_file_name}')
-                        # print("File download succeeded!\n")
-                    except ClientError as e:
-                        error_code = e.response['Error']['Code']
-                        if error_code == "403":
-                            print(f"Key not found. \n{e}")
-                        else:
-                            print(f"An unexpected error occurred: {e}")
-                    except Exception as e:
-                        print(f"An unexpected error occurred: {e}")
+def discard_staged_archive(job_id):
+    """The user upgraded before the deadline: forget the staged archive
+    A result packed with others stays in its (shared) pack archive.
+    """
+    staged = get_staged_archive(job_id)
+    if staged is None:
+        return
+    if 'staged_archive_offset' not in staged:
+        delete_archive(staged['staged_archive_id'])
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='REMOVE ' + ', '.join(STAGED_ATTRIBUTES.values())
+    )
+
+def delete_archive(archive_id):
+    """Delete an archive that is no longer referenced by a job"""
+    try:
+        glacier_uploader.glacier.delete_archive(vaultName=vault_name, archiveId=archive_id)
+    except ClientError as e:
+        print(f"Error deleting archive {archive_id}: {e}")
+
+def ledger_action(staged):
+    """Processing ledger action of an archive (or staging) message"""
+    return 'stage' if staged else 'archive'
+
+def process_message(message, queue_url):
+    """Archive the result of one archive (or staging) queue message
+    Messages from the staging queue arrive as soon as the job completes
+    and copy the result to Glacier ahead of time; messages from the
+    archive queue are sent by the retention timer at the deadline and, if a copy is
+    staged, only flip the job item and delete the S3 object.
+    Returns (queue URL, receipt handle) if the message is done with and can
+    be deleted, or None to leave it on the queue.
+    """
+    staged = queue_url == staging_queue_url
+    receipt = (queue_url, message['ReceiptHandle'])
 
-                    # ------------------------------------------
-                    # ---------- Upload to Glacier -------------
-                    result_file = f'{job_specific_directory}/{result_file_name}'
-                    archive_id = upload_to_glacier(result_file)
-                    upload_archive_id(job_id, archive_id)
+    # ast.iteraleval : parse dict from str
+    # https://medium.com/@aniruddhapal/the-power-of-the-ast-literal-eval-method-in-python-8fb4014a2574
+    try :
+        body = ast.literal_eval(message['Body'])
+        # print("message body: " , body, "\n")
+        data = ast.literal_eval(body['Message'])
+
+        job_id=data['job_id']
+        user_id=data['user_id']
+        s3_key_result_file=data['s3_key_result_file']
+        s3_results_bucket=data['s3_results_bucket']
+
+    except Exception as e:
+        print(f'Error while parsing message. {e}')
+        print(f"Deleting failed message from the queue")
+        return receipt
+
+    profile = helpers.get_user_profile(id=user_id)
+    if profile is None:
+        print(f"No profile for user {user_id}; skipping job {job_id}")
+        return receipt
+
+    if profile['role'] == 'premium_user':
+        if not staged:
+            # Upgraded during the retention window
+            discard_staged_archive(job_id)
+        return receipt      # nothing to archive
+
+    # A redelivered message whose work was already done is only acknowledged
+    if ledger.done(job_id, ledger_action(staged)):
+        return receipt
+
+    if archive_backend == tiering.S3_BACKEND:
+        # Nothing to stage: moving the object is all there is to do
+        if staged:
+            return receipt
+        if not move_to_archive_tier(job_id, s3_results_bucket, s3_key_result_file):
+            return None
+        helpers.publish_job_event(job_id, 'archived', user_id=user_id)
+        helpers.count_job_archived(job_id, user_id)
+        ledger.record(job_id, ledger_action(staged))
+        return receipt
+
+    if not staged and cut_over_staged_archive(job_id):
+        finish_archive(job_id, user_id, s3_key_result_file)
+        ledger.record(job_id, ledger_action(staged))
+        return receipt
+
+    if pack_results and pack_result(job_id, user_id, s3_results_bucket,
+            s3_key_result_file, queue_url, message['ReceiptHandle'], staged):
+        return None     # deleted when the pack is uploaded
+
+    if stream_from_s3:
+        # Pipe the S3 object straight into the Glacier upload
+        archive_id = stream_to_glacier(s3_results_bucket, s3_key_result_file)
+    else:
+        archive_id = download_and_upload_to_glacier(s3_results_bucket, s3_key_result_file)
+    if archive_id is None:
+        # Keep the result and the message; retried on redelivery
+        return None
+    upload_archive_id(job_id, archive_id, staged=staged)
+    if not staged:
+        finish_archive(job_id, user_id, s3_key_result_file)
+    ledger.record(job_id, ledger_action(staged))
+    return receipt
+
+def poll_messages():
+    # Messages are processed ArchiveThreads at a time; new ones are
+    # received as soon as a thread is free, and finished ones deleted in
+    # batches
+    archive_threads = config.getint('archive', 'ArchiveThreads')
+    queue_urls = [archive_queue_url] + ([staging_queue_url] if staging_queue_url else [])
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=archive_threads) as pool:
+        while True:
+            for queue_url in queue_urls:
+                if len(in_flight) >= archive_threads:
+                    break
+                # Poll the message queues; long polling only when idle
+                messages = sqs.receive_message(
+                    QueueUrl=queue_url,
+                    MaxNumberOfMessages=min(archive_threads - len(in_flight), 10),
+                    WaitTimeSeconds=0 if in_flight or queue_url != queue_urls[-1] else 5
+                )
+                for message in messages.get('Messages', []):
+                    in_flight.add(pool.submit(process_message, message, queue_url))
 
-                    # Clean up (delete) local job files
+            done = []
+            if in_flight:
+                finished, in_flight = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+                for future in finished:
                     try:
-                        os.remove(result_file)
-                        # print(f"File result file deleted successfully.")
-                    except OSError as e:
-                        print(f"Error deleting file '{result_file}' : {str(e)}")
-
-
-                    # Delete the message from the queue if job was successfully submitted
-                    try :
-                        sqs.delete_message(
-                            QueueUrl=archive_queue_url,
-                            ReceiptHandle=message['ReceiptHandle']
-                        )
-                        # print(f"Deleted message: {job_id} from the queue\n")
+                        receipt = future.result()
+                        if receipt:
+                            done.append(receipt)
                     except Exception as e:
-                        print(f"Failed to delete message from the queue: {e} \n")
+                        # Left on the queue; retried on redelivery
+                        print(f"Error archiving result: {e}")
 
-                    # Delete result files from s3 bucket
-                    s3_client.delete_object(Bucket=config['aws']['ResultBucketName'], Key=s3_key_result_file)
-                    # print(f"Deleted result file from from s3 bucket\n")
+            if pack_results and archive_pack.ready():
+                done += flush_pack()
+            delete_messages(done)
 
 
 if __name__ == "__main__":
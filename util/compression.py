@@ -0,0 +1,86 @@
+# compression.py
+#
+# Streaming compression of archived results
+#
+# Results are compressed on their way to Glacier and decompressed on
+# their way back to S3; both sides work chunk by chunk, so neither holds
+# a whole result in memory. The codec used is recorded on the job item
+# as archive_codec ('gzip', or absent for results archived raw).
+#
+##
+
+import zlib
+
+GZIP = 'gzip'
+CHUNK_SIZE = 1024 * 1024
+
+# wbits for zlib's gzip container (header and CRC trailer)
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+"""Compress a whole (small) result"""
+def compress(data, codec=GZIP, level=6):
+  if codec != GZIP:
+    raise ValueError(f"Unsupported archive codec: {codec}")
+  compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+"""A read(n) source whose output is the gzip of another read(n) source
+"""
+class CompressingReader(object):
+  def __init__(self, read, codec=GZIP, level=6, chunk_size=CHUNK_SIZE):
+    if codec != GZIP:
+      raise ValueError(f"Unsupported archive codec: {codec}")
+    self.source = read
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    self.chunk_size = chunk_size
+    self.buffer = bytearray()
+    self.eof = False
+
+  def read(self, n=-1):
+    while not self.eof and (n < 0 or len(self.buffer) < n):
+      chunk = self.source(self.chunk_size)
+      if chunk:
+        self.buffer.extend(self.compressor.compress(chunk))
+      else:
+        self.buffer.extend(self.compressor.flush())
+        self.eof = True
+    if n < 0:
+      n = len(self.buffer)
+    data = bytes(self.buffer[:n])
+    del self.buffer[:n]
+    return data
+
+"""File-like object that decompresses a compressed file-like object as it
+is read (e.g. a Glacier job output body passed to S3 upload_fileobj)
+"""
+class DecompressingReader(object):
+  def __init__(self, fileobj, codec=GZIP, chunk_size=CHUNK_SIZE):
+    if codec != GZIP:
+      raise ValueError(f"Unsupported archive codec: {codec}")
+    self.fileobj = fileobj
+    self.decompressor = zlib.decompressobj(_GZIP_WBITS)
+    self.chunk_size = chunk_size
+    self.buffer = bytearray()
+    self.eof = False
+
+  def read(self, n=-1):
+    while not self.eof and (n < 0 or len(self.buffer) < n):
+      chunk = self.fileobj.read(self.chunk_size)
+      if chunk:
+        self.buffer.extend(self.decompressor.decompress(chunk))
+      else:
+        self.buffer.extend(self.decompressor.flush())
+        if not self.decompressor.eof:
+          raise IOError("Compressed result is truncated")
+        self.eof = True
+    if n < 0:
+      n = len(self.buffer)
+    data = bytes(self.buffer[:n])
+    del self.buffer[:n]
+    return data
+
+  def close(self):
+    if hasattr(self.fileobj, 'close'):
+      self.fileobj.close()
+
+### EOF
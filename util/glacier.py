@@ -0,0 +1,243 @@
+# glacier.py
+#
+# Glacier archive uploads for the util daemons
+#
+# Archives larger than one part are sent with the multipart API: parts
+# are uploaded concurrently by a bounded pool, each part is retried on
+# its own, and the SHA-256 tree hash of the archive is built from the
+# 1 MB leaf hashes computed part by part, so the data is hashed once.
+# Small results can instead be packed many to an archive (ArchivePack).
+#
+##
+
+import os
+import time
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+
+import boto3
+from botocore.exceptions import ClientError, BotoCoreError
+
+import compression
+
+MB = 1024 * 1024
+
+"""Call read(n) until it has returned n bytes or the stream ends
+(a network stream may return less than asked for)
+"""
+def read_exactly(read, n):
+  chunks, remaining = [], n
+  while remaining > 0:
+    chunk = read(remaining)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    remaining -= len(chunk)
+  return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+"""SHA-256 hashes of each 1 MB chunk of data (the tree hash leaves)
+"""
+def leaf_hashes(data):
+  if not data:
+    return [hashlib.sha256(b'').digest()]
+  return [hashlib.sha256(data[i:i + MB]).digest() for i in range(0, len(data), MB)]
+
+"""Combine leaf hashes into a Glacier SHA-256 tree hash (hex)
+https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+"""
+def tree_hash(hashes):
+  hashes = list(hashes)
+  while len(hashes) > 1:
+    hashes = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest()
+      if i + 1 < len(hashes) else hashes[i]
+      for i in range(0, len(hashes), 2)]
+  return hashes[0].hex()
+
+class GlacierUploader(object):
+  def __init__(self, vault_name, part_size=64 * MB, max_workers=4,
+    max_attempts=5, compression_level=6, glacier=None):
+    # Glacier part sizes are 1 MB times a power of two
+    if part_size < MB or part_size & (part_size - 1):
+      raise ValueError(f"Invalid Glacier part size: {part_size}")
+    self.vault_name = vault_name
+    self.part_size = part_size
+    self.max_workers = max_workers
+    self.max_attempts = max_attempts
+    self.compression_level = compression_level
+    self.glacier = glacier or boto3.client('glacier')
+
+  """Upload a local file, compressed with `codec` if given; returns the
+  archive ID
+  """
+  def upload_file(self, file_path, description='', codec=None):
+    with open(file_path, 'rb') as file:
+      if codec:
+        reader = compression.CompressingReader(file.read, codec, self.compression_level)
+        return self.upload(reader.read, None, description)
+      return self.upload(file.read, os.path.getsize(file_path), description)
+
+  """Upload an S3 object straight from its GET response body, with no
+  local copy; returns the archive ID
+  """
+  def upload_s3_object(self, s3, bucket, key, description='', codec=None):
+    response = s3.get_object(Bucket=bucket, Key=key)
+    body = response['Body']
+    try:
+      if codec:
+        reader = compression.CompressingReader(body.read, codec, self.compression_level)
+        return self.upload(reader.read, None, description)
+      return self.upload(body.read, response['ContentLength'], description)
+    finally:
+      body.close()
+
+  """Upload the bytes produced by read(n) calls; returns the archive ID
+  `size` may be None when it isn't known up front (e.g. a compressed
+  stream). Up to max_workers parts are read ahead and in flight, so
+  memory use is bounded by a few parts, whatever the archive size.
+  """
+  def upload(self, read, size=None, description=''):
+    if size is None:
+      first = read_exactly(read, self.part_size)
+      second = read_exactly(read, self.part_size) if len(first) == self.part_size else b''
+      if not second:
+        return self.upload_single(first, description)
+      parts = itertools.chain([first, second],
+        iter(lambda: read_exactly(read, self.part_size), b''))
+    elif size <= self.part_size:
+      return self.upload_single(read_exactly(read, size), description)
+    else:
+      parts = self.read_parts(read, size)
+
+    upload_id = self.glacier.initiate_multipart_upload(
+      vaultName=self.vault_name,
+      archiveDescription=description,
+      partSize=str(self.part_size))['uploadId']
+    try:
+      leaves, archive_size = self.upload_parts(upload_id, parts)
+      return self.retry(lambda: self.glacier.complete_multipart_upload(
+        vaultName=self.vault_name,
+        uploadId=upload_id,
+        archiveSize=str(archive_size),
+        checksum=tree_hash(leaves)))['archiveId']
+    except Exception:
+      self.glacier.abort_multipart_upload(vaultName=self.vault_name, uploadId=upload_id)
+      raise
+
+  def upload_single(self, data, description=''):
+    return self.retry(lambda: self.glacier.upload_archive(
+      vaultName=self.vault_name,
+      archiveDescription=description,
+      checksum=tree_hash(leaf_hashes(data)),
+      body=data))['archiveId']
+
+  # Parts of a source of known size; raises IOError if it ends early
+  def read_parts(self, read, size):
+    for start in range(0, size, self.part_size):
+      data = read_exactly(read, min(self.part_size, size - start))
+      if len(data) != min(self.part_size, size - start):
+        raise IOError(f"Short read at byte {start} of {size}")
+      yield data
+
+  # Returns (leaf hashes of all parts in order, archive size)
+  def upload_parts(self, upload_id, parts):
+    slots = BoundedSemaphore(self.max_workers)
+    futures = []
+    start = 0
+    with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+      while True:
+        slots.acquire()
+        # Stop reading once a part has failed for good
+        if any(f.done() and f.exception() for f in futures):
+          slots.release()
+          break
+        try:
+          data = next(parts, None)
+        except Exception:
+          slots.release()
+          raise
+        if data is None:
+          slots.release()
+          break
+        future = pool.submit(self.upload_part, upload_id, start, data)
+        future.add_done_callback(lambda _f: slots.release())
+        futures.append(future)
+        start += len(data)
+
+    leaves = []
+    for future in futures:
+      leaves += future.result()
+    return leaves, start
+
+  def upload_part(self, upload_id, start, data):
+    hashes = leaf_hashes(data)
+    self.retry(lambda: self.glacier.upload_part(
+      vaultName=self.vault_name,
+      uploadId=upload_id,
+      range=f"bytes {start}-{start + len(data) - 1}/*",
+      checksum=tree_hash(hashes),
+      body=data))
+    return hashes
+
+  def retry(self, call):
+    for attempt in range(1, self.max_attempts + 1):
+      try:
+        return call()
+      except (ClientError, BotoCoreError) as e:
+        if attempt == self.max_attempts:
+          raise
+        print(f"Glacier request failed (attempt {attempt}), retrying: {e}")
+        time.sleep(min(2 ** attempt, 30))
+
+"""Small results packed back to back into one Glacier archive
+Each member's byte offset and length in the archive are recorded on its
+job item; a restore then retrieves only the megabyte-aligned range that
+holds the member (see member_range). A pack is ready to upload once it
+holds max_size bytes or its first member is `window` seconds old.
+"""
+class ArchivePack(object):
+  def __init__(self, max_size=64 * MB, window=120, clock=time.monotonic):
+    self.max_size = max_size
+    self.window = window
+    self.clock = clock
+    self.lock = Lock()
+    self.reset()
+
+  def reset(self):
+    self.data = bytearray()
+    self.members = []
+    self.opened_at = None
+
+  """Append a member's data; `member` is kept with its archive_offset and
+  archive_length for when the pack is uploaded
+  """
+  def add(self, data, **member):
+    with self.lock:
+      if not self.members:
+        self.opened_at = self.clock()
+      member.update(archive_offset=len(self.data), archive_length=len(data))
+      self.data += data
+      self.members.append(member)
+
+  def ready(self):
+    with self.lock:
+      return bool(self.members) and (len(self.data) >= self.max_size or
+        self.clock() - self.opened_at >= self.window)
+
+  """Empty the pack; returns (data, members)"""
+  def take(self):
+    with self.lock:
+      data, members = bytes(self.data), self.members
+      self.reset()
+      return data, members
+
+"""Megabyte-aligned (first, last) byte range of an archive holding a
+packed member, as Glacier byte-range retrievals require
+"""
+def member_range(offset, length, archive_size):
+  first = offset - offset % MB
+  last = min(-(-(offset + length) // MB) * MB, archive_size) - 1
+  return first, last
+
+### EOF
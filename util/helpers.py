@@ -10,6 +10,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import threading
 import boto3
 from botocore.exceptions import ClientError
 
@@ -18,6 +19,32 @@ from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
 
+_aws_lock = threading.Lock()
+_aws_clients = {}
+_aws_local = threading.local()
+
+"""Shared boto3 client for a service
+Clients are thread-safe once created, but creating them from the default
+session is not, so they are created once, under a lock.
+"""
+def aws_client(service):
+  with _aws_lock:
+    if service not in _aws_clients:
+      _aws_clients[service] = boto3.client(service,
+        region_name=config['aws']['AwsRegionName'])
+    return _aws_clients[service]
+
+"""boto3 resource for a service, one per thread (resources are not
+thread-safe)
+"""
+def aws_resource(service):
+  resources = _aws_local.__dict__.setdefault('resources', {})
+  if service not in resources:
+    with _aws_lock:
+      resources[service] = boto3.session.Session().resource(service,
+        region_name=config['aws']['AwsRegionName'])
+  return resources[service]
+
 """Send email via Amazon SES
 """
 def send_email_ses(recipients=None, 
@@ -40,41 +67,85 @@ def send_email_ses(recipients=None,
 
   return response
 
+"""Announce a change to a job item (archived, restored, ...) on the job
+events topic, so web servers can drop cached copies of the item
+"""
+def publish_job_event(job_id, event, **fields):
+  sns = aws_client('sns')
+  data = dict(fields, job_id=job_id, event=event)
+  try:
+    sns.publish(
+      TopicArn=config['aws']['JobEventsTopicArn'],
+      Message=json.dumps(data),
+      MessageGroupId=job_id,
+      MessageDeduplicationId=f"{job_id}-{event}")
+  except ClientError as e:
+    print(f"Couldn't publish {event} event for job {job_id}: {e}")
 
-import psycopg2
-import psycopg2.extras
+"""Count a job in (or, with archived=False, out of) its user's archived
+jobs summary counter. The job item's summary_archived flag changes in the
+same transaction, on the condition that it doesn't already say so, so a
+redelivered message can't count the job twice.
+"""
+def count_job_archived(job_id, user_id, archived=True):
+  dynamodb = aws_resource('dynamodb')
+  if archived:
+    flag_update, flag_condition = ('SET summary_archived = :archived',
+      'attribute_not_exists(summary_archived)')
+  else:
+    flag_update, flag_condition = ('REMOVE summary_archived',
+      'attribute_exists(summary_archived)')
+  job_update = {
+    'TableName': config['aws']['TableName'],
+    'Key': {'job_id': job_id},
+    'UpdateExpression': flag_update,
+    'ConditionExpression': flag_condition}
+  if archived:
+    job_update['ExpressionAttributeValues'] = {':archived': True}
+  try:
+    dynamodb.meta.client.transact_write_items(TransactItems=[
+      {'Update': job_update},
+      {'Update': {
+        'TableName': config['aws']['SummaryTableName'],
+        'Key': {'user_id': user_id},
+        'UpdateExpression': 'ADD count_archived :delta',
+        'ExpressionAttributeValues': {':delta': 1 if archived else -1}}}])
+  except ClientError as e:
+    reasons = e.response.get('CancellationReasons', [])
+    if reasons and reasons[0].get('Code') == 'ConditionalCheckFailed':
+      return
+    print(f"Error updating job summary for user {user_id}: {e}")
+
+import accounts
+import ledger
+
+_accounts_clients = {}
 
 """Access user profile in accounts database
+Returns the profile as a dict. Profiles are cached for a few seconds
+(see accounts.py), and connections are pooled.
 """
 def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    raise ClientError
+  db_name = db_name or config['gas']['AccountsDatabase']
+  with _aws_lock:
+    if db_name not in _accounts_clients:
+      _accounts_clients[db_name] = accounts.AccountsClient(db_name,
+        region_name=config['aws']['AwsRegionName'],
+        pool_size=config.getint('accounts', 'PoolSize'),
+        profile_ttl=config.getint('accounts', 'ProfileCacheTTL'),
+        secret_ttl=config.getint('accounts', 'SecretCacheTTL'))
+  return _accounts_clients[db_name].get_profile(id)
 
-  db_uri = "postgresql://" + rds_secret['username'] + ':' + \
-    rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-    str(rds_secret['port']) + '/' + \
-    (db_name or config['gas']['AccountsDatabase'])
+_ledger = None
 
-  try:
-    # Connect to accounts database and get a cursor
-    connection = psycopg2.connect(db_uri)
-    cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
-    
-    # Query the database and get the user's profile record
-    query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-    cursor.execute(query_string)
-    profile = cursor.fetchall()[0]
-  
-  except psycopg2.Error as e:
-    connection.rollback()
-    raise psycopg2.Error
-
-  # Return user profile record as a dict
-  return profile
+"""Shared processing ledger (see ledger.py)"""
+def processing_ledger():
+  global _ledger
+  with _aws_lock:
+    if _ledger is None:
+      _ledger = ledger.Ledger(config['aws']['LedgerTableName'],
+        ttl=config.getint('ledger', 'TTLHours') * 3600,
+        region_name=config['aws']['AwsRegionName'])
+    return _ledger
 
 ### EOF
\ No newline at end of file
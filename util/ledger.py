@@ -0,0 +1,80 @@
+# ledger.py
+#
+# Processing ledger for the archive, restore and thaw daemons
+#
+# SQS delivers messages at least once, and a daemon may stop between
+# doing its work and deleting the message. Each daemon records the work
+# it has done for a job as a ledger item keyed '<job_id>#<action>',
+# written with a condition so that only the first record counts, and
+# checks the ledger before repeating Glacier or S3 work for a redelivered
+# message. A later step clears the records of the steps before it (thaw
+# clears the archive and restore records, restore the thaw record), so
+# a result can go through the cycle again; records also expire after
+# `ttl` seconds (expires_at, the table's TTL attribute).
+#
+##
+
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+class Ledger(object):
+  def __init__(self, table_name, ttl=86400, region_name=None, dynamodb=None,
+    clock=time.time):
+    self.table_name = table_name
+    self.ttl = ttl
+    self.clock = clock
+    # A client, unlike a resource, can be shared by the archive threads
+    self.dynamodb = dynamodb or boto3.client('dynamodb', region_name=region_name)
+
+  """The details recorded for an action (a dict, possibly empty), or None if
+  it hasn't been done
+  """
+  def get(self, job_id, action):
+    item = self.dynamodb.get_item(
+      TableName=self.table_name,
+      Key={'ledger_key': {'S': f"{job_id}#{action}"}},
+      ConsistentRead=True).get('Item')
+    # TTL deletes expired items some time after they expire
+    if not item or int(item['expires_at']['N']) <= self.clock():
+      return None
+    return {name: value['S'] for name, value in item.items()
+      if name not in ('ledger_key', 'expires_at', 'done_at')}
+
+  def done(self, job_id, action):
+    return self.get(job_id, action) is not None
+
+  """Record that an action was done, with optional string details; returns
+  False if it was already recorded
+  """
+  def record(self, job_id, action, **details):
+    now = int(self.clock())
+    item = {
+      'ledger_key': {'S': f"{job_id}#{action}"},
+      'done_at': {'N': str(now)},
+      'expires_at': {'N': str(now + self.ttl)},
+    }
+    item.update({name: {'S': str(value)} for name, value in details.items()})
+    try:
+      self.dynamodb.put_item(
+        TableName=self.table_name,
+        Item=item,
+        ConditionExpression='attribute_not_exists(ledger_key) OR expires_at <= :now',
+        ExpressionAttributeValues={':now': {'N': str(now)}})
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        return False
+      raise
+    return True
+
+  """Forget actions, so that they can be done again (e.g. archiving a
+  result once it has been restored)
+  """
+  def clear(self, job_id, *actions):
+    for action in actions:
+      self.dynamodb.delete_item(
+        TableName=self.table_name,
+        Key={'ledger_key': {'S': f"{job_id}#{action}"}})
+
+### EOF
@@ -15,6 +15,8 @@ import json
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import glacier
+import tiering
 
 # Get configuration
 from configparser import ConfigParser
@@ -24,32 +26,39 @@ vault_name = config['aws']['VaultName']
 subscription_queue_url = config['aws']['SubscriptionUpgradeQueueUrl']
 table_name = config['aws']['TableName']
 thaws_topic_arn = config['aws']['ThawsTopicArn']
+ledger = helpers.processing_ledger()
+restore_days = config.getint('s3', 'RestoreDays')
 
 # s3
 import boto3
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 sqs = boto3.client('sqs')
+s3_client = boto3.client('s3')
 
 
-def initiate_retrieval(archive_id, retrieval_type='Expedited'):
+def initiate_retrieval(archive_id, retrieval_type='Expedited', byte_range=None):
+    """byte_range: (first, last) megabyte-aligned bytes to retrieve, for packed results"""
     glacier_client = boto3.client('glacier')
+    job_parameters = {
+        'Type': 'archive-retrieval',
+        'ArchiveId': archive_id,
+        'Tier': retrieval_type
+    }
+    if byte_range:
+        job_parameters['RetrievalByteRange'] = f"{byte_range[0]}-{byte_range[1]}"
     try:
         # Initiate the retrieval job
         response = glacier_client.initiate_job(
             vaultName=vault_name,
-            jobParameters={
-                'Type': 'archive-retrieval',
-                'ArchiveId': archive_id,
-                'Tier': retrieval_type
-            }
+            jobParameters=job_parameters
         )
         return response['jobId']
     except ClientError as e:
         print(e.response['Error']['Code']) # debugging
         if e.response['Error']['Code'] == 'InsufficientCapacityException':
             print("Expedited retrieval failed, falling back to standard retrieval.")
-            return initiate_retrieval(archive_id, 'Standard')       # fall back to standard type
+            return initiate_retrieval(archive_id, 'Standard', byte_range)       # fall back to standard type
         else:
             print(f"Error initiating retrieval job: {e}")
             raise e
@@ -95,6 +104,18 @@ def put_restore_message(job_id):
         print("Error updating item:", e)
     return
 
+def mark_restored(job_id, user_id):
+    """Show a result that needed no restore as available, as thaw does"""
+    table = boto3.resource('dynamodb').Table(table_name)
+    table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET restore_message = :restored',
+        ExpressionAttributeValues={':restored': ''}
+    )
+    helpers.publish_job_event(job_id, 'restored', user_id=user_id)
+    helpers.count_job_archived(job_id, user_id, archived=False)
+    ledger.clear(job_id, 'archive', 'stage')
+
 
 def poll_messages():
     while True:
@@ -147,21 +168,66 @@ def poll_messages():
                 # print(f"get result_files : {result_files}") # debug
 
                 for result in result_files:
+                    if 'results_file_archive_id' not in result:
+                        continue    # not archived
                     archive_id = result['results_file_archive_id']
                     s3_key_result_file = result['s3_key_result_file']
                     job_id = result['job_id']
 
+                    # Already restoring (the message was redelivered)
+                    if ledger.done(job_id, 'restore'):
+                        continue
+                    ledger.clear(job_id, 'thaw')
+
+                    if result.get('archive_backend') == tiering.S3_BACKEND:
+                        # Archived in place: restore the object; thaw moves it
+                        # back to STANDARD once the restore is done
+                        if not tiering.request_restore(s3_client, result['s3_results_bucket'],
+                                s3_key_result_file, restore_days):
+                            # Not in a Glacier storage class: already readable
+                            print(f"Result of job {job_id} needs no restore")
+                            mark_restored(job_id, user_id)
+                            continue
+                        put_restore_message(job_id)
+                        data = {
+                            "archive_backend" : tiering.S3_BACKEND,
+                            "s3_results_bucket" : result['s3_results_bucket'],
+                            "s3_key_result_file" : s3_key_result_file,
+                            "job_id" : job_id,
+                            "user_id" : user_id
+                            }
+                        publish_sns_topic(thaws_topic_arn, data,
+                            MessageDeduplicationId=f"{job_id}-s3-restore")
+                        ledger.record(job_id, 'restore')
+                        continue
+
+                    # A packed result is retrieved as the megabyte-aligned
+                    # range that holds it; thaw cuts the result out of it
+                    byte_range = None
+                    if 'archive_offset' in result:
+                        byte_range = glacier.member_range(int(result['archive_offset']),
+                            int(result['archive_length']), int(result['archive_size']))
+
+                    retrieval_job_id = initiate_retrieval(archive_id, byte_range=byte_range)
+
+                    # update db with restore message before announcing the thaw,
+                    # web servers drop their cached copy of the job on the announcement
+                    put_restore_message(job_id)
+
                     # send retrieval_job_idto thaw SNS topic
-                    retrieval_job_id = initiate_retrieval(archive_id)
                     data = {
                         "retrieval_job_id" : retrieval_job_id,
                         "s3_key_result_file" : s3_key_result_file,
-                        "job_id" : job_id
+                        "job_id" : job_id,
+                        "user_id" : user_id
                         }
+                    if 'archive_codec' in result:
+                        data['archive_codec'] = result['archive_codec']
+                    if byte_range:
+                        data['member_offset'] = int(result['archive_offset']) - byte_range[0]
+                        data['member_length'] = int(result['archive_length'])
                     publish_sns_topic(thaws_topic_arn, data, MessageDeduplicationId=data['retrieval_job_id'])
-
-                    # update db with restore message
-                    put_restore_message(job_id)
+                    ledger.record(job_id, 'restore', retrieval_job_id=retrieval_job_id)
 
                 # Delete the message from the queue if job was successfully submitted
                 try :
@@ -0,0 +1,209 @@
+# retention.py
+#
+# NOTE: This file lives on the Utils instance
+#
+# Retention timer: fires archive tasks for completed jobs once their
+# results have been kept for the retention period
+#
+# Completed jobs are scheduled by writing their due time (complete_time
+# plus RetentionSeconds) to the job item, as archive_due, with an
+# archive_shard; the sparse archive_due_index (partition key
+# archive_shard, sort key archive_due) then holds only the jobs waiting
+# to be archived. Due jobs are read from the index a batch at a time,
+# claimed with a conditional update that leases them for LeaseSeconds (so
+# several timers can run, and a task lost in a crash fires again), sent
+# to the archive queue 10 to a request, and then unscheduled.
+##
+
+import os
+import sys
+import ast
+import json
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError, BotoCoreError
+
+# Import utility helpers
+sys.path.insert(1, os.path.realpath(os.path.pardir))
+import helpers
+
+# Get configuration
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'retention_config.ini'))
+schedule_queue_url = config['aws']['ScheduleQueueUrl']
+archive_queue_url = config['aws']['ArchiveQueueUrl']
+table_name = config['aws']['TableName']
+
+retention_seconds = config.getint('retention', 'RetentionSeconds')
+shards = config.getint('retention', 'Shards')
+batch_size = config.getint('retention', 'BatchSize')
+lease_seconds = config.getint('retention', 'LeaseSeconds')
+claim_threads = config.getint('retention', 'ClaimThreads')
+
+sqs = boto3.client('sqs')
+
+# Job attributes the archive daemon reads from its messages
+TASK_ATTRIBUTES = ('job_id', 'user_id', 's3_key_result_file', 's3_results_bucket')
+
+
+def archive_shard(job_id):
+    """Index partition of a job; spreads due jobs over `shards` partitions"""
+    return zlib.crc32(job_id.encode()) % shards
+
+def schedule_job(job_id, complete_time):
+    """Record when the job's results are due to be archived"""
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET archive_due = :due, archive_shard = :shard',
+            ExpressionAttributeValues={
+                ':due': int(complete_time) + retention_seconds,
+                ':shard': archive_shard(job_id)
+            },
+            ConditionExpression='attribute_exists(job_id) AND '
+                'attribute_not_exists(results_file_archive_id)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        print(f"Job {job_id} is already archived; not scheduled")
+
+def schedule_completed_jobs(wait_seconds):
+    """Schedule the jobs announced on the schedule queue (subscribed to the
+    job results topic); returns the number of messages received
+    """
+    messages = sqs.receive_message(
+        QueueUrl=schedule_queue_url,
+        MaxNumberOfMessages=10,
+        WaitTimeSeconds=wait_seconds
+    ).get('Messages', [])
+
+    done = []
+    for message in messages:
+        try:
+            body = ast.literal_eval(message['Body'])
+            data = ast.literal_eval(body['Message'])
+            schedule_job(data['job_id'], data['complete_time'])
+        except ClientError as e:
+            # Left on the queue; retried on redelivery
+            print(f"Error scheduling job: {e}")
+            continue
+        except Exception as e:
+            print(f'Error while parsing message. {e}')
+            print(f"Deleting failed message from the queue")
+        done.append({'Id': str(len(done)), 'ReceiptHandle': message['ReceiptHandle']})
+
+    if done:
+        response = sqs.delete_message_batch(QueueUrl=schedule_queue_url, Entries=done)
+        for failure in response.get('Failed', []):
+            print(f"Failed to delete message from the queue: {failure.get('Message')}")
+    return len(messages)
+
+def due_jobs(shard, now):
+    """Up to batch_size jobs of a shard that are due, earliest first"""
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    response = table.query(
+        IndexName='archive_due_index',
+        KeyConditionExpression=Key('archive_shard').eq(shard) & Key('archive_due').lte(now),
+        Limit=batch_size
+    )
+    return response['Items']
+
+def claim_job(job, lease_until):
+    """Lease a due job; False if another timer claimed it first"""
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    try:
+        table.update_item(
+            Key={'job_id': job['job_id']},
+            UpdateExpression='SET archive_due = :lease_until',
+            ExpressionAttributeValues={':due': job['archive_due'], ':lease_until': lease_until},
+            ConditionExpression='archive_due = :due'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            print(f"Error claiming job {job['job_id']}: {e}")
+        return False
+    return True
+
+def unschedule_job(job_id, lease_until):
+    """Remove a fired job from the index (unless it was claimed again)"""
+    table = helpers.aws_resource('dynamodb').Table(table_name)
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='REMOVE archive_due, archive_shard',
+            ExpressionAttributeValues={':lease_until': lease_until},
+            ConditionExpression='archive_due = :lease_until'
+        )
+    except ClientError as e:
+        print(f"Error unscheduling job {job_id}: {e}")
+
+def archive_task(job):
+    """Archive queue message for a job, in the form the results topic
+    delivers (the archive daemon parses both the same way)
+    """
+    data = {name: job[name] for name in TASK_ATTRIBUTES}
+    return json.dumps({'Type': 'Notification', 'Message': json.dumps(data)})
+
+def fire_jobs(pool, jobs):
+    """Claim due jobs, send their archive tasks and unschedule them"""
+    lease_until = int(time.time()) + lease_seconds
+    claimed = [job for job, ok in
+        zip(jobs, pool.map(lambda job: claim_job(job, lease_until), jobs)) if ok]
+
+    sent = []
+    for i in range(0, len(claimed), 10):
+        batch = claimed[i:i + 10]
+        entries = [{'Id': str(n), 'MessageBody': archive_task(job)}
+            for n, job in enumerate(batch)]
+        try:
+            response = sqs.send_message_batch(QueueUrl=archive_queue_url, Entries=entries)
+        except ClientError as e:
+            # Fired again once the lease runs out
+            print(f"Error sending archive tasks: {e}")
+            continue
+        for failure in response.get('Failed', []):
+            print(f"Failed to send archive task: {failure.get('Message')}")
+        sent += [batch[int(success['Id'])]['job_id'] for success in response.get('Successful', [])]
+
+    list(pool.map(lambda job_id: unschedule_job(job_id, lease_until), sent))
+    return len(claimed)
+
+def fire_due_jobs(pool):
+    """Fire every job that is due, a batch at a time per shard"""
+    now = int(time.time())
+    for shard in range(shards):
+        while True:
+            jobs = due_jobs(shard, now)
+            fired = fire_jobs(pool, jobs) if jobs else 0
+            # Claimed jobs leave the due range; stop if none could be
+            if len(jobs) < batch_size or not fired:
+                break
+
+def run_timer():
+    with ThreadPoolExecutor(max_workers=claim_threads) as pool:
+        while True:
+            try:
+                # Long poll only when no new jobs are coming in
+                received = schedule_completed_jobs(wait_seconds=5)
+                for _ in range(10):
+                    if received < 10:
+                        break
+                    received = schedule_completed_jobs(wait_seconds=0)
+                fire_due_jobs(pool)
+            except (ClientError, BotoCoreError) as e:
+                # e.g. throttling, or a connection or endpoint error
+                print(f"Error running retention timer: {e}")
+                time.sleep(5)
+
+
+if __name__ == "__main__":
+    run_timer()
+
+### EOF
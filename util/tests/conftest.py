@@ -0,0 +1,17 @@
+# conftest.py
+#
+# Tests for the util modules and daemons; AWS services and the accounts
+# database are replaced by local fakes
+#
+##
+
+import os
+import sys
+
+UTIL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, UTIL_DIR)
+# The daemons, imported by their tests (see their importorskip calls)
+for daemon in ('archive', 'retention'):
+  sys.path.insert(0, os.path.join(UTIL_DIR, daemon))
+
+### EOF
@@ -0,0 +1,118 @@
+import json
+
+import pytest
+
+pytest.importorskip('psycopg2')
+
+import psycopg2
+
+import accounts
+from accounts import AccountsClient
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+class FakeSecretsManager(object):
+  def get_secret_value(self, SecretId):
+    return {'SecretString': json.dumps({'host': 'db', 'port': 5432,
+      'username': 'gas', 'password': 'secret'})}
+
+
+class FakeCursor(object):
+  def __init__(self, connection):
+    self.connection = connection
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+  def execute(self, statement, parameters=None):
+    if self.connection.broken:
+      raise psycopg2.OperationalError('server closed the connection')
+
+  def fetchone(self):
+    return {'identity_id': 'u1', 'role': 'free_user'}
+
+
+class FakeConnection(object):
+  profile_prepared = False
+
+  def __init__(self, broken=False):
+    self.broken = broken
+
+  def cursor(self, cursor_factory=None):
+    return FakeCursor(self)
+
+  def rollback(self):
+    pass
+
+
+class FakePool(object):
+  created = []
+
+  def __init__(self, minconn, maxconn, **kwargs):
+    self.closed = False
+    self.broken = False
+    FakePool.created.append(self)
+
+  def getconn(self):
+    assert not self.closed
+    return FakeConnection(self.broken)
+
+  def putconn(self, connection, close=False):
+    pass
+
+  def closeall(self):
+    self.closed = True
+
+
+@pytest.fixture
+def client(monkeypatch):
+  FakePool.created = []
+  monkeypatch.setattr(accounts.psycopg2.pool, 'ThreadedConnectionPool', FakePool)
+  return AccountsClient('accounts', asm=FakeSecretsManager(), secret_ttl=60,
+    profile_ttl=0, clock=FakeClock())
+
+def test_pool_is_reused_until_the_secret_ttl(client):
+  first = client.connection_pool()
+  client.clock.now += 59
+  assert client.connection_pool() is first
+  client.release_pool(first)
+  client.release_pool(first)
+  assert len(FakePool.created) == 1
+
+def test_replaced_pool_is_closed_once_released(client):
+  old = client.connection_pool()
+  client.clock.now += 60
+  new = client.connection_pool()
+  assert new is not old
+  assert not old.closed       # still in use
+  client.release_pool(old)
+  assert old.closed
+  client.release_pool(new)
+  assert not new.closed
+
+def test_idle_pool_is_closed_when_replaced(client):
+  client.get_profile('u1')
+  old = FakePool.created[-1]
+  client.clock.now += 60
+  client.get_profile('u1')
+  assert old.closed
+  assert len(FakePool.created) == 2
+  assert client.in_use == {}
+
+def test_failed_pool_is_replaced_and_closed(client):
+  client.get_profile('u1')
+  old = FakePool.created[-1]
+  old.broken = True
+  assert client.get_profile('u1') == {'identity_id': 'u1', 'role': 'free_user'}
+  assert old.closed
+  assert not FakePool.created[-1].closed
@@ -0,0 +1,171 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+# helpers reaches the accounts database through psycopg2
+pytest.importorskip('psycopg2')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.exceptions import ClientError
+
+import archive
+import helpers
+
+STAGING_QUEUE = 'https://sqs.us-east-1.amazonaws.com/123/staging'
+ARCHIVE_QUEUE = 'https://sqs.us-east-1.amazonaws.com/123/archives'
+
+
+class FakeTable(object):
+  def __init__(self, items=()):
+    self.items = {item['job_id']: dict(item) for item in items}
+    self.fail = None
+
+  def get_item(self, Key, ProjectionExpression=None, ConsistentRead=False):
+    item = self.items.get(Key['job_id'])
+    if item is None:
+      return {}
+    names = [name.strip() for name in ProjectionExpression.split(',')]
+    return {'Item': {name: item[name] for name in names if name in item}}
+
+  def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None,
+    ConditionExpression=None, ReturnValues=None):
+    if self.fail:
+      raise ClientError({'Error': {'Code': self.fail}}, 'UpdateItem')
+    item = self.items.setdefault(Key['job_id'], {'job_id': Key['job_id']})
+    if ConditionExpression:
+      test, name = ConditionExpression.rstrip(')').split('(')
+      if (name in item) != (test == 'attribute_exists'):
+        raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+    updates, _, removes = UpdateExpression.partition(' REMOVE ')
+    if updates.startswith('REMOVE '):
+      updates, removes = '', updates[len('REMOVE '):]
+    for assignment in filter(None, updates[len('SET '):].split(', ')):
+      name, value = assignment.split(' = ')
+      item[name] = ExpressionAttributeValues[value]
+    for name in filter(None, removes.split(', ')):
+      item.pop(name, None)
+
+
+class FakeResource(object):
+  def __init__(self, table):
+    self.table = table
+
+  def Table(self, name):
+    return self.table
+
+
+class FakeLedger(object):
+  def __init__(self):
+    self.records = set()
+
+  def done(self, job_id, action):
+    return (job_id, action) in self.records
+
+  def record(self, job_id, action, **details):
+    self.records.add((job_id, action))
+
+
+class FakeS3(object):
+  def __init__(self):
+    self.deleted = []
+
+  def delete_object(self, Bucket, Key):
+    self.deleted.append(Key)
+
+
+class FakeGlacier(object):
+  def __init__(self):
+    self.deleted = []
+
+  def delete_archive(self, vaultName, archiveId):
+    self.deleted.append(archiveId)
+
+
+@pytest.fixture
+def daemon(monkeypatch):
+  table = FakeTable([{'job_id': 'j1', 'user_id': 'u1'}])
+  state = SimpleNamespace(table=table, role='free_user', uploads=[], events=[],
+    s3=FakeS3(), glacier=FakeGlacier(), ledger=FakeLedger())
+
+  def stream_to_glacier(bucket, key):
+    state.uploads.append(key)
+    return f"archive-{len(state.uploads)}"
+
+  monkeypatch.setattr(helpers, 'aws_resource', lambda service: FakeResource(table))
+  monkeypatch.setattr(helpers, 'get_user_profile',
+    lambda id=None, db_name=None: {'role': state.role})
+  monkeypatch.setattr(helpers, 'publish_job_event',
+    lambda job_id, event, **fields: state.events.append((job_id, event)))
+  monkeypatch.setattr(helpers, 'count_job_archived', lambda job_id, user_id: None)
+  monkeypatch.setattr(archive, 'stream_to_glacier', stream_to_glacier)
+  monkeypatch.setattr(archive, 's3_client', state.s3)
+  monkeypatch.setattr(archive.glacier_uploader, 'glacier', state.glacier)
+  monkeypatch.setattr(archive, 'ledger', state.ledger)
+  monkeypatch.setattr(archive, 'staging_queue_url', STAGING_QUEUE)
+  monkeypatch.setattr(archive, 'archive_queue_url', ARCHIVE_QUEUE)
+  monkeypatch.setattr(archive, 'archive_backend', 'vault')
+  monkeypatch.setattr(archive, 'archive_codec', 'gzip')
+  monkeypatch.setattr(archive, 'pack_results', False)
+  monkeypatch.setattr(archive, 'stream_from_s3', True)
+  return state
+
+def message(job_id='j1'):
+  data = {'job_id': job_id, 'user_id': 'u1', 's3_results_bucket': 'results',
+    's3_key_result_file': f"prefix/u1/{job_id}~sample.annot.vcf"}
+  return {'ReceiptHandle': f"r-{job_id}",
+    'Body': json.dumps({'Type': 'Notification', 'Message': json.dumps(data)})}
+
+def test_staging_copies_the_result_but_keeps_it_in_s3(daemon):
+  assert archive.process_message(message(), STAGING_QUEUE) == (STAGING_QUEUE, 'r-j1')
+  item = daemon.table.items['j1']
+  assert item['staged_archive_id'] == 'archive-1'
+  assert item['staged_archive_codec'] == 'gzip'
+  assert 'results_file_archive_id' not in item
+  assert daemon.s3.deleted == []
+  assert daemon.ledger.done('j1', 'stage')
+
+def test_deadline_cuts_over_to_the_staged_archive(daemon):
+  archive.process_message(message(), STAGING_QUEUE)
+  assert archive.process_message(message(), ARCHIVE_QUEUE) == (ARCHIVE_QUEUE, 'r-j1')
+
+  item = daemon.table.items['j1']
+  assert item['results_file_archive_id'] == 'archive-1'
+  assert item['archive_codec'] == 'gzip'
+  assert not any(name.startswith('staged_') for name in item)
+  assert daemon.uploads == ['prefix/u1/j1~sample.annot.vcf']
+  assert daemon.s3.deleted == ['prefix/u1/j1~sample.annot.vcf']
+  assert daemon.events == [('j1', 'archived')]
+
+def test_deadline_without_a_staged_copy_uploads_then(daemon):
+  archive.process_message(message(), ARCHIVE_QUEUE)
+  assert daemon.table.items['j1']['results_file_archive_id'] == 'archive-1'
+  assert daemon.s3.deleted == ['prefix/u1/j1~sample.annot.vcf']
+
+def test_upgrade_before_the_deadline_discards_the_staged_archive(daemon):
+  archive.process_message(message(), STAGING_QUEUE)
+  daemon.role = 'premium_user'
+  assert archive.process_message(message(), ARCHIVE_QUEUE) == (ARCHIVE_QUEUE, 'r-j1')
+
+  assert daemon.glacier.deleted == ['archive-1']
+  assert not any(name.startswith('staged_') for name in daemon.table.items['j1'])
+  assert daemon.s3.deleted == []
+
+def test_staged_copy_of_an_archived_job_is_deleted(daemon):
+  daemon.table.items['j1']['results_file_archive_id'] = 'earlier'
+  archive.process_message(message(), STAGING_QUEUE)
+  assert daemon.glacier.deleted == ['archive-1']
+  assert 'staged_archive_id' not in daemon.table.items['j1']
+
+def test_result_is_kept_when_its_archive_cant_be_recorded(daemon):
+  daemon.table.fail = 'ProvisionedThroughputExceededException'
+  with pytest.raises(ClientError):
+    archive.process_message(message(), ARCHIVE_QUEUE)
+  assert daemon.s3.deleted == []
+  assert not daemon.ledger.done('j1', 'archive')
+
+def test_redelivered_message_is_only_acknowledged(daemon):
+  daemon.ledger.record('j1', 'stage')
+  assert archive.process_message(message(), STAGING_QUEUE) == (STAGING_QUEUE, 'r-j1')
+  assert daemon.uploads == []
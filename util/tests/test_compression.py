@@ -0,0 +1,68 @@
+import gzip
+import io
+
+import pytest
+
+from compression import CompressingReader, DecompressingReader, compress
+
+DATA = b'#CHROM\tPOS\tID\n' + b'chr1\t12345\trs1\tA\tG\n' * 20000
+
+
+class ChunkedSource(object):
+  def __init__(self, data):
+    self.file = io.BytesIO(data)
+    self.sizes = []
+
+  def read(self, n):
+    self.sizes.append(n)
+    return self.file.read(n)
+
+
+def read_all(read, n):
+  chunks = []
+  while True:
+    chunk = read(n)
+    if not chunk:
+      return b''.join(chunks)
+    chunks.append(chunk)
+
+def test_compress_is_gzip():
+  assert gzip.decompress(compress(DATA)) == DATA
+
+def test_unknown_codec_is_rejected():
+  with pytest.raises(ValueError):
+    compress(DATA, codec='zstd')
+  with pytest.raises(ValueError):
+    CompressingReader(io.BytesIO(DATA).read, codec='zstd')
+
+def test_compressing_reader_streams_gzip():
+  source = ChunkedSource(DATA)
+  reader = CompressingReader(source.read, chunk_size=4096)
+  compressed = read_all(reader.read, 1000)
+  assert gzip.decompress(compressed) == DATA
+  assert set(source.sizes) == {4096}
+  assert len(compressed) < len(DATA) / 10
+
+def test_compressing_reader_reads_everything_with_no_size():
+  reader = CompressingReader(io.BytesIO(DATA).read, chunk_size=4096)
+  assert gzip.decompress(reader.read()) == DATA
+  assert reader.read(10) == b''
+
+def test_decompressing_reader_round_trip():
+  reader = DecompressingReader(io.BytesIO(compress(DATA)), chunk_size=100)
+  assert read_all(reader.read, 777) == DATA
+
+def test_decompressing_reader_of_empty_result():
+  reader = DecompressingReader(io.BytesIO(compress(b'')))
+  assert reader.read() == b''
+
+def test_truncated_input_is_an_error():
+  compressed = compress(DATA)
+  reader = DecompressingReader(io.BytesIO(compressed[:len(compressed) // 2]), chunk_size=100)
+  with pytest.raises(IOError):
+    read_all(reader.read, 1000)
+
+def test_close_closes_the_source():
+  source = io.BytesIO(compress(DATA))
+  DecompressingReader(source).close()
+  assert source.closed
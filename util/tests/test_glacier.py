@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+
+import pytest
+from botocore.exceptions import ClientError
+
+import glacier
+from glacier import MB, ArchivePack, GlacierUploader, leaf_hashes, member_range, tree_hash
+
+
+def reference_tree_hash(data):
+  # Straight from the Glacier documentation: hash 1 MB chunks, then pairs
+  level = [hashlib.sha256(data[i:i + MB]).digest()
+    for i in range(0, max(len(data), 1), MB)]
+  while len(level) > 1:
+    pairs = [level[i:i + 2] for i in range(0, len(level), 2)]
+    level = [hashlib.sha256(b''.join(pair)).digest() if len(pair) == 2 else pair[0]
+      for pair in pairs]
+  return level[0].hex()
+
+
+class FakeGlacier(object):
+  def __init__(self, fail_parts=0):
+    self.fail_parts = fail_parts    # upload_part calls to fail first
+    self.archives = {}
+    self.uploads = {}
+    self.aborted = []
+
+  def upload_archive(self, vaultName, archiveDescription, checksum, body):
+    assert checksum == reference_tree_hash(body)
+    archive_id = f"a{len(self.archives)}"
+    self.archives[archive_id] = body
+    return {'archiveId': archive_id}
+
+  def initiate_multipart_upload(self, vaultName, archiveDescription, partSize):
+    upload_id = f"u{len(self.uploads)}"
+    self.uploads[upload_id] = {'part_size': int(partSize), 'parts': {}}
+    return {'uploadId': upload_id}
+
+  def upload_part(self, vaultName, uploadId, range, checksum, body):
+    if self.fail_parts:
+      self.fail_parts -= 1
+      raise ClientError({'Error': {'Code': 'RequestTimeoutException'}}, 'UploadPart')
+    first, last = map(int, range.split(' ')[1].split('/')[0].split('-'))
+    assert last - first + 1 == len(body)
+    assert checksum == reference_tree_hash(body)
+    self.uploads[uploadId]['parts'][first] = body
+
+  def complete_multipart_upload(self, vaultName, uploadId, archiveSize, checksum):
+    parts = self.uploads.pop(uploadId)['parts']
+    data = b''.join(parts[first] for first in sorted(parts))
+    assert int(archiveSize) == len(data)
+    assert checksum == reference_tree_hash(data)
+    archive_id = f"a{len(self.archives)}"
+    self.archives[archive_id] = data
+    return {'archiveId': archive_id}
+
+  def abort_multipart_upload(self, vaultName, uploadId):
+    self.aborted.append(uploadId)
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class ShortReads(object):
+  # A network stream that returns less than asked for
+  def __init__(self, data, most=300 * 1024):
+    self.data = data
+    self.most = most
+
+  def read(self, n):
+    chunk, self.data = self.data[:min(n, self.most)], self.data[min(n, self.most):]
+    return chunk
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+  monkeypatch.setattr(glacier.time, 'sleep', lambda seconds: None)
+
+def data_of(size):
+  return bytes(range(256)) * (size // 256) + bytes(size % 256)
+
+def uploader(fake, **kwargs):
+  return GlacierUploader('vault', part_size=MB, glacier=fake, **kwargs)
+
+def test_tree_hash_matches_the_reference():
+  for size in (0, 1, MB, MB + 1, 3 * MB + 5, 4 * MB):
+    data = data_of(size)
+    assert tree_hash(leaf_hashes(data)) == reference_tree_hash(data)
+
+def test_tree_hash_of_parts_is_the_archive_tree_hash():
+  data = data_of(5 * MB + 17)
+  leaves = leaf_hashes(data[:2 * MB]) + leaf_hashes(data[2 * MB:4 * MB]) + \
+    leaf_hashes(data[4 * MB:])
+  assert tree_hash(leaves) == reference_tree_hash(data)
+
+def test_part_size_must_be_a_power_of_two_megabytes():
+  with pytest.raises(ValueError):
+    GlacierUploader('vault', part_size=3 * MB, glacier=FakeGlacier())
+
+def test_small_archive_is_uploaded_in_one_request():
+  fake = FakeGlacier()
+  archive_id = uploader(fake).upload(ShortReads(b'small').read, 5)
+  assert fake.archives[archive_id] == b'small'
+  assert not fake.uploads
+
+def test_large_archive_is_uploaded_in_parallel_parts():
+  fake = FakeGlacier()
+  data = data_of(5 * MB + 17)
+  archive_id = uploader(fake, max_workers=3).upload(ShortReads(data).read, len(data))
+  assert fake.archives[archive_id] == data
+
+def test_unknown_size_stream_is_uploaded_in_parts():
+  fake = FakeGlacier()
+  data = data_of(2 * MB + 1)
+  archive_id = uploader(fake).upload(ShortReads(data).read)
+  assert fake.archives[archive_id] == data
+
+def test_failed_part_is_retried():
+  fake = FakeGlacier(fail_parts=2)
+  data = data_of(3 * MB)
+  archive_id = uploader(fake).upload(ShortReads(data).read, len(data))
+  assert fake.archives[archive_id] == data
+
+def test_upload_is_aborted_when_a_part_keeps_failing():
+  fake = FakeGlacier(fail_parts=100)
+  data = data_of(3 * MB)
+  with pytest.raises(ClientError):
+    uploader(fake, max_attempts=2).upload(ShortReads(data).read, len(data))
+  assert fake.aborted == ['u0']
+  assert not fake.archives
+
+def test_compressed_upload_from_s3():
+  class Body(ShortReads):
+    closed = False
+
+    def close(self):
+      self.closed = True
+
+  class FakeS3(object):
+    def get_object(self, Bucket, Key):
+      self.body = Body(data)
+      return {'Body': self.body, 'ContentLength': len(data)}
+
+  fake, s3 = FakeGlacier(), FakeS3()
+  data = data_of(3 * MB)
+  archive_id = uploader(fake).upload_s3_object(s3, 'bucket', 'key', codec='gzip')
+  assert gzip.decompress(fake.archives[archive_id]) == data
+  assert s3.body.closed
+
+def test_short_source_is_an_error():
+  fake = FakeGlacier()
+  with pytest.raises(IOError):
+    uploader(fake).upload(ShortReads(data_of(MB + 10)).read, 3 * MB)
+  assert fake.aborted == ['u0']
+
+def test_pack_records_each_members_place():
+  pack = ArchivePack(max_size=100, window=60, clock=FakeClock())
+  pack.add(b'first', job_id='j1')
+  pack.add(b'second!', job_id='j2')
+  data, members = pack.take()
+  assert data == b'first' + b'second!'
+  assert members == [
+    {'job_id': 'j1', 'archive_offset': 0, 'archive_length': 5},
+    {'job_id': 'j2', 'archive_offset': 5, 'archive_length': 7}]
+  assert pack.take() == (b'', [])
+
+def test_pack_is_ready_when_full_or_old():
+  clock = FakeClock()
+  pack = ArchivePack(max_size=10, window=60, clock=clock)
+  assert not pack.ready()
+  pack.add(b'12345', job_id='j1')
+  assert not pack.ready()
+  clock.now += 60
+  assert pack.ready()
+
+  pack.take()
+  pack.add(b'1234567890', job_id='j2')
+  assert pack.ready()
+
+def test_member_range_is_megabyte_aligned():
+  size = 5 * MB + 100
+  assert member_range(10, 20, size) == (0, MB - 1)
+  assert member_range(MB - 5, 10, size) == (0, 2 * MB - 1)
+  assert member_range(2 * MB, MB, size) == (2 * MB, 3 * MB - 1)
+  assert member_range(5 * MB + 10, 50, size) == (5 * MB, size - 1)
+
+def test_member_range_holds_the_member():
+  data = data_of(3 * MB + 7)
+  offset, length = MB + 12345, MB + 3
+  first, last = member_range(offset, length, len(data))
+  retrieved = data[first:last + 1]
+  assert retrieved[offset - first:offset - first + length] == data[offset:offset + length]
@@ -0,0 +1,83 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from ledger import Ledger
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1700000000.0
+
+  def __call__(self):
+    return self.now
+
+
+class FakeDynamoDB(object):
+  def __init__(self):
+    self.items = {}
+
+  def get_item(self, TableName, Key, ConsistentRead):
+    item = self.items.get(Key['ledger_key']['S'])
+    return {'Item': dict(item)} if item else {}
+
+  def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeValues):
+    assert ConditionExpression == 'attribute_not_exists(ledger_key) OR expires_at <= :now'
+    existing = self.items.get(Item['ledger_key']['S'])
+    now = int(ExpressionAttributeValues[':now']['N'])
+    if existing and int(existing['expires_at']['N']) > now:
+      raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+    self.items[Item['ledger_key']['S']] = dict(Item)
+
+  def delete_item(self, TableName, Key):
+    self.items.pop(Key['ledger_key']['S'], None)
+
+def new_ledger(ttl=3600):
+  clock = FakeClock()
+  return Ledger('ledger', ttl=ttl, dynamodb=FakeDynamoDB(), clock=clock), clock
+
+def test_first_record_counts():
+  ledger, clock = new_ledger()
+  assert not ledger.done('j1', 'archive')
+  assert ledger.record('j1', 'archive', archive_id='a1')
+  assert not ledger.record('j1', 'archive', archive_id='a2')
+  assert ledger.get('j1', 'archive') == {'archive_id': 'a1'}
+  assert ledger.done('j1', 'archive')
+
+def test_actions_are_recorded_separately():
+  ledger, clock = new_ledger()
+  ledger.record('j1', 'archive')
+  assert ledger.get('j1', 'archive') == {}
+  assert not ledger.done('j1', 'restore')
+  assert not ledger.done('j2', 'archive')
+
+def test_clear_lets_actions_be_done_again():
+  ledger, clock = new_ledger()
+  ledger.record('j1', 'archive')
+  ledger.record('j1', 'restore')
+  ledger.clear('j1', 'archive', 'restore')
+  assert not ledger.done('j1', 'archive')
+  assert not ledger.done('j1', 'restore')
+  assert ledger.record('j1', 'archive')
+
+def test_expired_records_are_ignored_and_replaced():
+  ledger, clock = new_ledger(ttl=60)
+  ledger.record('j1', 'thaw')
+  clock.now += 60
+  assert not ledger.done('j1', 'thaw')
+  assert ledger.record('j1', 'thaw')
+  assert ledger.done('j1', 'thaw')
+
+def test_other_errors_are_raised():
+  ledger, clock = new_ledger()
+  def throttled(**kwargs):
+    raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'PutItem')
+  ledger.dynamodb.put_item = throttled
+  with pytest.raises(ClientError):
+    ledger.record('j1', 'archive')
+
+def test_processing_ledger_is_shared():
+  pytest.importorskip('psycopg2')
+  import helpers
+  shared = helpers.processing_ledger()
+  assert helpers.processing_ledger() is shared
+  assert shared.ttl == helpers.config.getint('ledger', 'TTLHours') * 3600
@@ -0,0 +1,180 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# helpers reaches the accounts database through psycopg2
+pytest.importorskip('psycopg2')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from botocore.exceptions import ClientError
+
+import helpers
+import retention
+
+
+def conditional_check_failed():
+  return ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+
+class FakeTable(object):
+  def __init__(self, items=()):
+    self.items = {item['job_id']: dict(item) for item in items}
+
+  def update_item(self, Key, UpdateExpression, ConditionExpression,
+    ExpressionAttributeValues):
+    item = self.items.get(Key['job_id'])
+    values = ExpressionAttributeValues
+    if ConditionExpression.startswith('attribute_exists(job_id)'):
+      ok = item is not None and 'results_file_archive_id' not in item
+    else:
+      name, value = ConditionExpression.split(' = ')
+      ok = item is not None and item.get(name) == values[value]
+    if not ok:
+      raise conditional_check_failed()
+
+    if UpdateExpression.startswith('REMOVE '):
+      for name in UpdateExpression[len('REMOVE '):].split(', '):
+        item.pop(name, None)
+    else:
+      for assignment in UpdateExpression[len('SET '):].split(', '):
+        name, value = assignment.split(' = ')
+        item[name] = values[value]
+
+  def query(self, IndexName, KeyConditionExpression, Limit):
+    shard_condition, due_condition = KeyConditionExpression.get_expression()['values']
+    shard = shard_condition.get_expression()['values'][1]
+    now = due_condition.get_expression()['values'][1]
+    due = sorted((item for item in self.items.values()
+      if item.get('archive_shard') == shard and item.get('archive_due', now + 1) <= now),
+      key=lambda item: item['archive_due'])
+    return {'Items': [dict(item) for item in due[:Limit]]}
+
+
+class FakeResource(object):
+  def __init__(self, table):
+    self.table = table
+
+  def Table(self, name):
+    return self.table
+
+
+class FakeSqs(object):
+  def __init__(self, received=(), fail_sends=False):
+    self.received = list(received)
+    self.fail_sends = fail_sends
+    self.sent = []
+    self.batches = []
+    self.deleted = []
+
+  def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+    messages, self.received = self.received[:MaxNumberOfMessages], \
+      self.received[MaxNumberOfMessages:]
+    return {'Messages': messages}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+    self.deleted += [entry['ReceiptHandle'] for entry in Entries]
+    return {'Successful': Entries}
+
+  def send_message_batch(self, QueueUrl, Entries):
+    if self.fail_sends:
+      raise ClientError({'Error': {'Code': 'ServiceUnavailable'}}, 'SendMessageBatch')
+    self.batches.append(len(Entries))
+    self.sent += [json.loads(json.loads(entry['MessageBody'])['Message'])
+      for entry in Entries]
+    return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+
+@pytest.fixture
+def table(monkeypatch):
+  table = FakeTable()
+  monkeypatch.setattr(helpers, 'aws_resource', lambda service: FakeResource(table))
+  return table
+
+@pytest.fixture
+def pool():
+  with ThreadPoolExecutor(max_workers=4) as pool:
+    yield pool
+
+def job(job_id, **attributes):
+  return dict({'job_id': job_id, 'user_id': 'u1', 's3_results_bucket': 'results',
+    's3_key_result_file': f"prefix/u1/{job_id}~sample.annot.vcf"}, **attributes)
+
+def due_job(job_id, due):
+  return job(job_id, archive_due=due, archive_shard=retention.archive_shard(job_id))
+
+def notification(job_id, complete_time):
+  message = str({'job_id': job_id, 'complete_time': complete_time})
+  return {'ReceiptHandle': f"r-{job_id}", 'Body': str({'Message': message})}
+
+def test_shards_spread_jobs_deterministically():
+  shards = {retention.archive_shard(f"job-{n}") for n in range(100)}
+  assert shards == set(range(retention.shards))
+  assert retention.archive_shard('job-1') == retention.archive_shard('job-1')
+
+def test_completed_jobs_are_scheduled(table, monkeypatch):
+  table.items = {'j1': job('j1'), 'j2': job('j2', results_file_archive_id='a1')}
+  sqs = FakeSqs([notification('j1', 1000), notification('j2', 1000),
+    {'ReceiptHandle': 'r-bad', 'Body': 'not a message'}])
+  monkeypatch.setattr(retention, 'sqs', sqs)
+
+  assert retention.schedule_completed_jobs(wait_seconds=0) == 3
+  assert table.items['j1']['archive_due'] == 1000 + retention.retention_seconds
+  assert table.items['j1']['archive_shard'] == retention.archive_shard('j1')
+  assert 'archive_due' not in table.items['j2']
+  assert sqs.deleted == ['r-j1', 'r-j2', 'r-bad']
+
+def test_due_jobs_are_fired_and_unscheduled(table, pool, monkeypatch):
+  now = int(time.time())
+  table.items = {job_id: due_job(job_id, now - 10) for job_id in ('j1', 'j2')}
+  table.items['later'] = due_job('later', now + 3600)
+  sqs = FakeSqs()
+  monkeypatch.setattr(retention, 'sqs', sqs)
+
+  retention.fire_due_jobs(pool)
+
+  assert sorted(task['job_id'] for task in sqs.sent) == ['j1', 'j2']
+  assert set(sqs.sent[0]) == set(retention.TASK_ATTRIBUTES)
+  assert 'archive_due' not in table.items['j1']
+  assert 'archive_shard' not in table.items['j2']
+  assert table.items['later']['archive_due'] == now + 3600
+
+def test_tasks_are_sent_ten_to_a_request(table, pool, monkeypatch):
+  now = int(time.time())
+  job_ids = [f"job-{n}" for n in range(40)]
+  table.items = {job_id: due_job(job_id, now - 10) for job_id in job_ids}
+  sqs = FakeSqs()
+  monkeypatch.setattr(retention, 'sqs', sqs)
+  monkeypatch.setattr(retention, 'batch_size', 5)
+
+  retention.fire_due_jobs(pool)
+
+  assert sorted(task['job_id'] for task in sqs.sent) == sorted(job_ids)
+  assert max(sqs.batches) <= 10
+
+def test_a_job_is_claimed_by_one_timer_only(table):
+  table.items = {'j1': due_job('j1', 100)}
+  claimed = dict(table.items['j1'])
+  assert retention.claim_job(claimed, 500)
+  assert not retention.claim_job(claimed, 600)
+  assert table.items['j1']['archive_due'] == 500
+
+def test_unsent_tasks_fire_again_when_their_lease_ends(table, pool, monkeypatch):
+  now = int(time.time())
+  table.items = {'j1': due_job('j1', now - 10)}
+  monkeypatch.setattr(retention, 'sqs', FakeSqs(fail_sends=True))
+
+  retention.fire_due_jobs(pool)
+
+  lease_until = table.items['j1']['archive_due']
+  assert now + retention.lease_seconds <= lease_until <= int(time.time()) + retention.lease_seconds
+  assert table.items['j1']['archive_shard'] == retention.archive_shard('j1')
+
+def test_unschedule_keeps_a_job_claimed_again(table):
+  table.items = {'j1': due_job('j1', 900)}
+  retention.unschedule_job('j1', 500)
+  assert table.items['j1']['archive_due'] == 900
+  retention.unschedule_job('j1', 900)
+  assert 'archive_due' not in table.items['j1']
@@ -0,0 +1,64 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from tiering import change_storage_class, request_restore, restore_status
+
+
+class FakeS3(object):
+  def __init__(self, errors=(), head=None):
+    self.errors = dict(errors)    # tier -> error code
+    self.head = head or {}
+    self.restores = []
+    self.copies = []
+
+  def restore_object(self, Bucket, Key, RestoreRequest):
+    tier = RestoreRequest['GlacierJobParameters']['Tier']
+    self.restores.append(tier)
+    if tier in self.errors:
+      raise ClientError({'Error': {'Code': self.errors[tier]}}, 'RestoreObject')
+
+  def head_object(self, Bucket, Key):
+    return dict(self.head)
+
+  def copy(self, CopySource, Bucket, Key, ExtraArgs):
+    self.copies.append((CopySource, Bucket, Key, ExtraArgs))
+
+def test_expedited_restore():
+  s3 = FakeS3()
+  assert request_restore(s3, 'bucket', 'key')
+  assert s3.restores == ['Expedited']
+
+@pytest.mark.parametrize('code', ['GlacierExpeditedRetrievalNotAvailable', 'InvalidArgument'])
+def test_expedited_failure_falls_back_to_standard(code):
+  s3 = FakeS3(errors={'Expedited': code})
+  assert request_restore(s3, 'bucket', 'key')
+  assert s3.restores == ['Expedited', 'Standard']
+
+def test_restore_in_progress_counts_as_started():
+  s3 = FakeS3(errors={'Expedited': 'RestoreAlreadyInProgress'})
+  assert request_restore(s3, 'bucket', 'key')
+  assert s3.restores == ['Expedited']
+
+def test_object_not_in_glacier_has_nothing_to_restore():
+  s3 = FakeS3(errors={'Expedited': 'InvalidObjectState'})
+  assert not request_restore(s3, 'bucket', 'key')
+
+def test_standard_failure_is_raised():
+  s3 = FakeS3(errors={'Expedited': 'InvalidArgument', 'Standard': 'AccessDenied'})
+  with pytest.raises(ClientError):
+    request_restore(s3, 'bucket', 'key')
+
+def test_restore_status():
+  assert restore_status(FakeS3(head={}), 'bucket', 'key') == 'standard'
+  assert restore_status(FakeS3(head={'StorageClass': 'GLACIER'}), 'bucket', 'key') == 'restoring'
+  assert restore_status(FakeS3(head={'StorageClass': 'DEEP_ARCHIVE',
+    'Restore': 'ongoing-request="true"'}), 'bucket', 'key') == 'restoring'
+  assert restore_status(FakeS3(head={'StorageClass': 'GLACIER',
+    'Restore': 'ongoing-request="false", expiry-date="Fri, 23 Dec 2026 00:00:00 GMT"'}),
+    'bucket', 'key') == 'restored'
+
+def test_change_storage_class_copies_in_place():
+  s3 = FakeS3()
+  change_storage_class(s3, 'bucket', 'key', 'GLACIER')
+  assert s3.copies == [({'Bucket': 'bucket', 'Key': 'key'}, 'bucket', 'key',
+    {'StorageClass': 'GLACIER', 'MetadataDirective': 'COPY'})]
@@ -14,7 +14,9 @@ import time
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
-# import helpers
+import helpers
+import compression
+import tiering
 
 # Get configuration
 from configparser import ConfigParser
@@ -31,10 +33,7 @@ from botocore.exceptions import ClientError
 sqs = boto3.client('sqs')
 vault_name = config['aws']['VaultName']
 table_name = config['aws']['TableName']
-
-# make local path
-download_dir = config['local']['DownloadDir']
-os.makedirs(download_dir, exist_ok=True)
+ledger = helpers.processing_ledger()
 
 def check_job_status(job_id):
     glacier_client = boto3.client('glacier')
@@ -45,26 +44,46 @@ def check_job_status(job_id):
         print(f"Error checking job status: {e}")
         raise
 
-def download_restored_file(job_id, download_path):
+def restore_to_s3(job_id, bucket_name, object_name, member_offset=None,
+        member_length=None, codec=None):
+    """Stream a retrieval job's output to S3, decompressing it on the way if
+    it was archived compressed. Packed results are cut out of the retrieved
+    range with a ranged get_job_output.
+    """
     glacier_client = boto3.client('glacier')
+    s3_client = boto3.client('s3')
+    kwargs = {}
+    if member_offset is not None:
+        kwargs['range'] = f"bytes={member_offset}-{member_offset + member_length - 1}"
     try:
-        response = glacier_client.get_job_output(vaultName=vault_name, jobId=job_id)
-
-        # Write the response data to a file
-        with open(download_path, 'wb') as file:
-            file.write(response['body'].read())
-        # print(f"Downloaded to local successfully. Job id: {job_id}")
-    except ClientError as e:
-        print(f"Error downloading restored file: {e}")
+        response = glacier_client.get_job_output(vaultName=vault_name, jobId=job_id, **kwargs)
+        body = response['body']
+        if codec:
+            body = compression.DecompressingReader(body, codec)
+        try:
+            s3_client.upload_fileobj(body, bucket_name, object_name)
+        finally:
+            body.close()
+        # print("Uploaded retrived file to s3 successfully")
+    except (ClientError, IOError) as e:
+        print(f"Error restoring file to S3: {e}")
         raise
 
-def upload_file_to_s3(file_path, bucket_name, object_name):
+def restore_s3_object(bucket_name, object_name):
+    """Move a result archived in place back to STANDARD once its restore is
+    done; returns False while it is still being restored
+    """
     s3_client = boto3.client('s3')
     try:
-        response = s3_client.upload_file(file_path, bucket_name, object_name)
-        # print("Uploaded retrived file to s3 successfully")
+        status = tiering.restore_status(s3_client, bucket_name, object_name)
+        if status == 'restoring':
+            return False
+        # An object already in STANDARD can't be copied onto itself as is
+        if status == 'restored':
+            tiering.change_storage_class(s3_client, bucket_name, object_name, 'STANDARD')
+        return True
     except ClientError as e:
-        print(f"Error uploading file to S3: {e}")
+        print(f"Error restoring {object_name} in S3: {e}")
         raise
 
 def update_restore_message(job_id):
@@ -109,7 +128,6 @@ def poll_messages():
                     body = ast.literal_eval(message['Body'])
                     data = ast.literal_eval(body['Message'])
 
-                    retrieval_job_id = data['retrieval_job_id']
                     s3_key_result_file = data['s3_key_result_file']
                     job_id = data['job_id']
 
@@ -123,29 +141,50 @@ def poll_messages():
                     print(f"Deleted bad request message from the queue")
                     continue  # go to next message
 
-                # ---- process the retrieval_job_id -----
-                # download restore files to local
-                status_code = check_job_status(retrieval_job_id)
-                download_path = os.path.join(download_dir, retrieval_job_id)
-
-                if status_code == 'Succeeded':
-                    download_restored_file(retrieval_job_id, download_path)
-
-                    # move restore files to s3
-                    upload_file_to_s3(download_path, s3_results_bucket, s3_key_result_file)
-
-                    # Delete the message from the queue if job was successfully submitted
-                    try :
+                try:
+                    # Already thawed (the message was redelivered)
+                    if ledger.done(job_id, 'thaw'):
                         sqs.delete_message(
                             QueueUrl=thaws_queue_url,
                             ReceiptHandle=message['ReceiptHandle']
                         )
-                        print(f"Deleted : {s3_key_result_file} from the queue\n")
-                    except Exception as e:
-                        print(f"Failed to delete message from the queue: {e} \n")
-
-                    # Update database to signal web to show download link
-                    update_restore_message(job_id)
+                        continue
+
+                    if data.get('archive_backend') == tiering.S3_BACKEND:
+                        # ---- archived in place: wait for the S3 restore -----
+                        restored = restore_s3_object(data['s3_results_bucket'], s3_key_result_file)
+                    else:
+                        # ---- process the retrieval_job_id -----
+                        retrieval_job_id = data['retrieval_job_id']
+                        restored = check_job_status(retrieval_job_id) == 'Succeeded'
+                        if restored:
+                            # stream restored file to s3 (no local copy)
+                            restore_to_s3(retrieval_job_id, s3_results_bucket, s3_key_result_file,
+                                data.get('member_offset'), data.get('member_length'),
+                                data.get('archive_codec'))
+
+                    if restored:
+                        # Delete the message from the queue if job was successfully submitted
+                        try :
+                            sqs.delete_message(
+                                QueueUrl=thaws_queue_url,
+                                ReceiptHandle=message['ReceiptHandle']
+                            )
+                            print(f"Deleted : {s3_key_result_file} from the queue\n")
+                        except Exception as e:
+                            print(f"Failed to delete message from the queue: {e} \n")
+
+                        # Update database to signal web to show download link
+                        update_restore_message(job_id)
+                        helpers.publish_job_event(job_id, 'restored', user_id=data.get('user_id'))
+                        if data.get('user_id'):
+                            helpers.count_job_archived(job_id, data['user_id'], archived=False)
+                        # The result is back in S3: it can be archived (and restored) again
+                        ledger.record(job_id, 'thaw')
+                        ledger.clear(job_id, 'archive', 'stage', 'restore')
+                except Exception as e:
+                    # Left on the queue; retried on the next poll
+                    print(f"Error thawing job {job_id}: {e}")
 
         time.sleep(60) # wait between each poll
 
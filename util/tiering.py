@@ -0,0 +1,59 @@
+# tiering.py
+#
+# S3 storage-class archive backend for the util daemons
+#
+# Instead of copying results into the Glacier vault, a result can be
+# archived where it is: the object is copied onto itself in a Glacier
+# storage class, restored with restore_object, and copied back to
+# STANDARD once the restore is done. The data never leaves S3; jobs
+# archived this way have archive_backend 's3' on their item.
+#
+##
+
+from botocore.exceptions import ClientError
+
+S3_BACKEND = 's3'
+
+"""Copy an object onto itself in another storage class (in parts, if it
+is too large for a single copy_object)
+"""
+def change_storage_class(s3, bucket, key, storage_class):
+  s3.copy({'Bucket': bucket, 'Key': key}, bucket, key,
+    ExtraArgs={'StorageClass': storage_class, 'MetadataDirective': 'COPY'})
+
+"""Start restoring an archived object for `days`; tries the Expedited tier
+first, as the vault backend does. Returns False if the object is not in
+a Glacier storage class (there is nothing to restore).
+"""
+def request_restore(s3, bucket, key, days=7, tier='Expedited'):
+  try:
+    s3.restore_object(Bucket=bucket, Key=key, RestoreRequest={
+      'Days': days,
+      'GlacierJobParameters': {'Tier': tier}
+    })
+  except ClientError as e:
+    code = e.response['Error']['Code']
+    if code == 'RestoreAlreadyInProgress':
+      return True
+    if code == 'InvalidObjectState':
+      return False
+    if tier == 'Expedited' and code in ('GlacierExpeditedRetrievalNotAvailable',
+      'InvalidArgument'):
+      print("Expedited restore failed, falling back to standard restore.")
+      return request_restore(s3, bucket, key, days, 'Standard')
+    raise
+  return True
+
+"""Where an object is in the restore cycle: 'standard' (not in a Glacier
+storage class, nothing to restore), 'restoring' or 'restored' (a
+readable temporary copy exists)
+"""
+def restore_status(s3, bucket, key):
+  head = s3.head_object(Bucket=bucket, Key=key)
+  if head.get('StorageClass', 'STANDARD') not in ('GLACIER', 'DEEP_ARCHIVE'):
+    return 'standard'
+  if 'ongoing-request="false"' in head.get('Restore', ''):
+    return 'restored'
+  return 'restoring'
+
+### EOF
@@ -0,0 +1,151 @@
+# admission.py
+#
+# Per-user admission control for job submission
+#
+# Each (user, role) pair gets a token bucket: it refills at `rate`
+# tokens per second up to `burst`, and each submitted job takes one
+# token. Buckets are items in a DynamoDB table shared by every web
+# worker and server, so a user gets the same quota however many workers
+# serve them. An item is read, its bucket updated, and written back on
+# the condition that its version hasn't changed, i.e. that no one else
+# wrote it in between (else the take is retried). Items expire (TTL
+# attribute expires_at) once their bucket would be full again, as a
+# missing item means a full bucket.
+#
+##
+
+import time
+from decimal import Decimal
+from threading import Lock
+
+from botocore.exceptions import ClientError
+
+import logging
+logger = logging.getLogger(__name__)
+
+"""Token bucket; a plain value, stored by AdmissionController"""
+class TokenBucket(object):
+  def __init__(self, rate, burst, now, tokens=None):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.tokens = float(burst) if tokens is None else float(tokens)
+    self.updated = now
+
+  def refill(self, now):
+    self.tokens = min(self.burst,
+      self.tokens + max(now - self.updated, 0) * self.rate)
+    self.updated = max(now, self.updated)
+
+  """Take `cost` tokens if available; returns seconds to wait otherwise"""
+  def take(self, cost, now):
+    self.refill(now)
+    if cost <= self.tokens:
+      self.tokens -= cost
+      return 0
+    if cost > self.burst or self.rate <= 0:
+      return None     # can never be admitted
+    return (cost - self.tokens) / self.rate
+
+  """Give back `cost` tokens (up to burst)"""
+  def give(self, cost, now):
+    self.refill(now)
+    self.tokens = min(self.burst, self.tokens + cost)
+    return 0
+
+  # When the bucket will be full again (and its item can go)
+  def full_at(self):
+    if self.rate <= 0:
+      return self.updated
+    return self.updated + (self.burst - self.tokens) / self.rate
+
+"""Admission control on token buckets kept in `table` (a DynamoDB table
+resource with partition key bucket_key); the clock must be wall-clock
+time, as it is compared across servers. Counters of admitted and
+rejected jobs are kept per process.
+"""
+class AdmissionController(object):
+  def __init__(self, quotas, table, clock=time.time, max_attempts=5,
+    contended_wait=1.0):
+    self.quotas = quotas      # role -> (rate per second, burst)
+    self.table = table
+    self.clock = clock
+    self.max_attempts = max_attempts
+    self.contended_wait = contended_wait
+    self.lock = Lock()
+    self.counts = {}
+
+  """Most jobs a user with `role` can submit at once"""
+  def burst(self, role):
+    return self.quotas.get(role, self.quotas['free_user'])[1]
+
+  """Try to admit `cost` jobs for a user
+  Returns (admitted, retry_after seconds); retry_after is None when the
+  request is larger than the role's burst and can never be admitted.
+  """
+  def admit(self, user_id, role, cost=1):
+    wait = self.update(user_id, role, lambda bucket, now: bucket.take(cost, now))
+    outcome = 'admitted' if wait == 0 else 'rejected'
+    with self.lock:
+      counts = self.counts.setdefault(role, {'admitted': 0, 'rejected': 0, 'refunded': 0})
+      counts[outcome] += cost
+    return wait == 0, wait
+
+  """Give back tokens taken for jobs that were not submitted after all"""
+  def refund(self, user_id, role, cost=1):
+    self.update(user_id, role, lambda bucket, now: bucket.give(cost, now))
+    with self.lock:
+      counts = self.counts.setdefault(role, {'admitted': 0, 'rejected': 0, 'refunded': 0})
+      counts['refunded'] += cost
+
+  """Apply change(bucket, now) to a user's bucket and store it, unless
+  change returns a nonzero wait; returns what change returned. Retried
+  when another request changed the bucket first, up to max_attempts
+  times; then returns contended_wait.
+  """
+  def update(self, user_id, role, change):
+    rate, burst = self.quotas.get(role, self.quotas['free_user'])
+    key = f"{user_id}#{role}"
+    for attempt in range(self.max_attempts):
+      now = self.clock()
+      item = self.table.get_item(Key={'bucket_key': key},
+        ConsistentRead=True).get('Item')
+      if item is None:
+        bucket = TokenBucket(rate, burst, now)
+      else:
+        bucket = TokenBucket(rate, burst, float(item['updated']), item['tokens'])
+
+      result = change(bucket, now)
+      if result != 0:
+        return result
+      try:
+        self.store(key, bucket, item)
+      except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+          raise
+        continue
+      return result
+    logger.warning(f"Token bucket {key} is changing too fast to update")
+    return self.contended_wait
+
+  def store(self, key, bucket, item):
+    kwargs = {
+      'Item': {
+        'bucket_key': key,
+        'tokens': Decimal(repr(bucket.tokens)),
+        'updated': Decimal(repr(bucket.updated)),
+        'version': item['version'] + 1 if item else 1,
+        'expires_at': int(bucket.full_at()) + 1
+      }
+    }
+    if item is None:
+      kwargs['ConditionExpression'] = 'attribute_not_exists(bucket_key)'
+    else:
+      kwargs['ConditionExpression'] = 'version = :version'
+      kwargs['ExpressionAttributeValues'] = {':version': item['version']}
+    self.table.put_item(**kwargs)
+
+  def counters(self):
+    with self.lock:
+      return {'jobs': {role: dict(counts) for role, counts in self.counts.items()}}
+
+### EOF
@@ -0,0 +1,46 @@
+# aws.py
+#
+# Per-process boto3 clients and resources for the GAS web app
+#
+# gunicorn runs with --preload, so modules are imported once in the
+# master and the workers are forked from it. boto3 clients and resources
+# (and their connection pools) must not cross a fork, so module-level
+# ones are wrapped in ProcessLocal: each process creates its own on first
+# use, and a worker never touches the one its master may have made.
+#
+##
+
+import os
+from threading import Lock
+
+import boto3
+
+"""An object created on first use in each process
+Attribute access is passed through, so a ProcessLocal can stand in for
+the client, resource or table that `factory` returns.
+"""
+class ProcessLocal(object):
+  def __init__(self, factory):
+    self.factory = factory
+    self.lock = Lock()
+    self.pid = None
+    self.instance = None
+
+  def get(self):
+    if self.pid != os.getpid():
+      with self.lock:
+        if self.pid != os.getpid():
+          self.instance = self.factory()
+          self.pid = os.getpid()
+    return self.instance
+
+  def __getattr__(self, name):
+    return getattr(self.get(), name)
+
+def client(service, **kwargs):
+  return ProcessLocal(lambda: boto3.client(service, **kwargs))
+
+def resource(service, **kwargs):
+  return ProcessLocal(lambda: boto3.resource(service, **kwargs))
+
+### EOF
@@ -0,0 +1,124 @@
+# cache.py
+#
+# Small in-process caches shared by the GAS web app
+#
+##
+
+import time
+from threading import RLock
+
+"""Thread-safe key/value cache with a per-entry time-to-live
+Entries are dropped lazily, on read, once they expire.
+"""
+class TTLCache(object):
+  def __init__(self, ttl=60, max_entries=10000, clock=time.monotonic):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.clock = clock
+    self.lock = RLock()
+    self.entries = {}
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return default
+      value, expires_at = entry
+      if expires_at <= self.clock():
+        del self.entries[key]
+        return default
+      return value
+
+  def set(self, key, value, ttl=None):
+    ttl = self.ttl if ttl is None else ttl
+    with self.lock:
+      if len(self.entries) >= self.max_entries and key not in self.entries:
+        self.evict()
+      self.entries[key] = (value, self.clock() + ttl)
+
+  def invalidate(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  """Return the cached value for key, calling loader() on a miss
+  A loader result of None is not cached.
+  """
+  def get_or_load(self, key, loader, ttl=None):
+    value = self.get(key)
+    if value is None:
+      value = loader()
+      if value is not None:
+        self.set(key, value, ttl=ttl)
+    return value
+
+  # Drop expired entries; if still full, drop the oldest-expiring ones
+  def evict(self):
+    now = self.clock()
+    for key in [k for k, (_v, exp) in self.entries.items() if exp <= now]:
+      del self.entries[key]
+    overflow = len(self.entries) - self.max_entries + 1
+    if overflow > 0:
+      oldest = sorted(self.entries, key=lambda k: self.entries[k][1])
+      for key in oldest[:overflow]:
+        del self.entries[key]
+
+# Job statuses after which an item only changes on archive/restore
+TERMINAL_STATUSES = ('COMPLETED', 'FAILED')
+
+"""Read-through cache of job items, keyed by job ID and projection
+Terminal jobs are kept for JOB_CACHE_TTL; jobs still in flight for the
+much shorter JOB_CACHE_ACTIVE_TTL. A cached full item also answers
+requests for any projection of it.
+"""
+class JobCache(object):
+  def __init__(self, table, ttl=300, active_ttl=5):
+    self.table = table
+    self.ttl = ttl
+    self.active_ttl = active_ttl
+    # job_id -> {projection (None for the full item): item}
+    self.items = TTLCache(ttl=ttl)
+
+  def get(self, job_id, attributes=None):
+    projection = tuple(sorted(attributes)) if attributes else None
+
+    views = self.items.get(job_id) or {}
+    item = views.get(None) or views.get(projection)
+    if item is None:
+      item = self.load(job_id, projection)
+      if item is None:
+        return None
+      self.store(job_id, projection, item, views)
+
+    if projection:
+      return {k: item[k] for k in projection if k in item}
+    return dict(item)
+
+  def load(self, job_id, projection):
+    kwargs = {'Key': {'job_id': job_id}}
+    if projection:
+      names = {f'#p{i}': name for i, name in enumerate(projection)}
+      kwargs['ProjectionExpression'] = ', '.join(names)
+      kwargs['ExpressionAttributeNames'] = names
+    return self.table.get_item(**kwargs).get('Item')
+
+  def store(self, job_id, projection, item, views):
+    views = dict(views)
+    views[projection] = item
+    status = views.get(None, item).get('job_status')
+    ttl = self.ttl if status in TERMINAL_STATUSES else self.active_ttl
+    self.items.set(job_id, views, ttl=ttl)
+
+  def invalidate(self, job_id):
+    self.items.invalidate(job_id)
+
+  """EventBus subscriber: any notification naming a job evicts it"""
+  def on_event(self, topic, data):
+    job_id = data.get('job_id') if isinstance(data, dict) else None
+    if job_id:
+      self.invalidate(job_id)
+
+### EOF
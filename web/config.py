@@ -14,6 +14,8 @@ import boto3
 import base64
 from botocore.exceptions import ClientError
 
+from credentials import secrets
+
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config(object):
@@ -37,25 +39,20 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-
-  # Get Flask application secret
+  # Get various credentials from AWS Secrets Manager, all at once
   try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
+    asm_secrets = secrets.load(
+      ['gas/web_server', 'rds/accounts_database', 'globus/auth_client'])
   except ClientError as e:
-    print(f"Unable to retrieve Flask secret from ASM: {e}")
+    print(f"Unable to retrieve GAS credentials from ASM: {e}")
     raise e
+
+  # Get Flask application secret
+  flask_secret = asm_secrets['gas/web_server']
   SECRET_KEY = flask_secret['flask_secret_key']
 
   # Get RDS secret and construct database URI
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve accounts database credentials from ASM: {e}")
-    raise e
+  rds_secret = asm_secrets['rds/accounts_database']
 
   SQLALCHEMY_DATABASE_TABLE = os.environ['ACCOUNTS_DATABASE_TABLE']
   SQLALCHEMY_DATABASE_URI = "postgresql://" + \
@@ -65,21 +62,40 @@ class Config(object):
   SQLALCHEMY_TRACK_MODIFICATIONS = True
 
   # Get the Globus Auth client ID and secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
-    raise e
+  globus_auth = asm_secrets['globus/auth_client']
 
   # Set the Globus Auth client ID and secret
   GAS_CLIENT_ID = globus_auth['gas_client_id']
   GAS_CLIENT_SECRET = globus_auth['gas_client_secret']
   GLOBUS_AUTH_LOGOUT_URI = "https://auth.globus.org/v2/web/logout"
 
+  # Portal tokens are reused until this many seconds before they expire
+  GLOBUS_TOKEN_REFRESH_MARGIN = 300
+
   # Set validity of pre-signed POST requests (in seconds)
   AWS_SIGNED_REQUEST_EXPIRATION = 60
 
+  # Batch submission: most files per batch, and validity of the batch's
+  # pre-signed POSTs (in seconds; files are uploaded one after another)
+  BATCH_MAX_FILES = 200
+  BATCH_SIGNED_REQUEST_EXPIRATION = 3600
+
+  # JSON API (/api/v1)
+  API_PAGE_DEFAULT = 50
+  API_PAGE_MAX = 100
+  API_STATUS_MAX_JOBS = 500
+
+  # Inputs larger than MULTIPART_THRESHOLD (in bytes) are uploaded in
+  # parts of MULTIPART_PART_SIZE bytes (S3 minimum is 5 MB); part URLs
+  # are signed MULTIPART_SIGN_BATCH at a time
+  MULTIPART_THRESHOLD = 64 * 1024 * 1024
+  MULTIPART_PART_SIZE = 16 * 1024 * 1024
+  MULTIPART_SIGN_BATCH = 100
+
+  # Largest file (in bytes) the browser hashes to look for an identical
+  # earlier upload; larger files are always uploaded
+  DEDUPE_MAX_HASH_BYTES = 512 * 1024 * 1024
+
   AWS_S3_INPUTS_BUCKET = "mpcs-cc-gas-inputs"
   AWS_S3_RESULTS_BUCKET = "mpcs-cc-gas-results"
   # Set the S3 key (object name) prefix to your CNetID
@@ -97,13 +113,99 @@ class Config(object):
     "arn:aws:sns:us-east-1:659248683008:nichada_job_results.fifo"
   AWS_SNS_SUBSCRIPTION_UPGRADE_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:nichada_subscription_upgrade.fifo"
+  # Archive/restore updates published by the util instance
+  AWS_SNS_JOB_EVENTS_TOPIC = \
+    "arn:aws:sns:us-east-1:659248683008:nichada_job_events.fifo"
+  AWS_SNS_JOB_THAWS_TOPIC = \
+    "arn:aws:sns:us-east-1:659248683008:nichada_job_thaws.fifo"
+  # Profile changes, published by the web servers themselves
+  AWS_SNS_PROFILE_EVENTS_TOPIC = \
+    "arn:aws:sns:us-east-1:659248683008:nichada_profile_events.fifo"
+
+  # Topics each web worker subscribes a queue of its own to, to keep its
+  # caches fresh and feed its job status streams (new jobs reach them
+  # through the job requests topic)
+  JOB_EVENT_TOPICS = (AWS_SNS_JOB_REQUEST_TOPIC, AWS_SNS_JOB_COMPLETE_TOPIC,
+    AWS_SNS_JOB_THAWS_TOPIC, AWS_SNS_JOB_EVENTS_TOPIC,
+    AWS_SNS_PROFILE_EVENTS_TOPIC)
+  # Name prefix of those per-worker queues (None disables them), and how
+  # long (in seconds) their messages are kept
+  AWS_SQS_JOB_EVENTS_QUEUE_PREFIX = \
+    os.environ['AWS_SQS_JOB_EVENTS_QUEUE_PREFIX'] \
+    if ('AWS_SQS_JOB_EVENTS_QUEUE_PREFIX' in os.environ) else None
+  AWS_SQS_JOB_EVENTS_RETENTION = 300
+
+  # Job request outbox: how often to look for jobs left unpublished and
+  # how old (in seconds) such jobs must be
+  OUTBOX_SWEEP_INTERVAL = 60
+  OUTBOX_SWEEP_AGE = 60
+
+  # Lifetime of cached job items (in seconds), for finished jobs and
+  # for jobs still pending/running; without notification queues (no
+  # AWS_SQS_JOB_EVENTS_QUEUE_PREFIX) finished jobs get the short one too
+  JOB_CACHE_TTL = 300
+  JOB_CACHE_ACTIVE_TTL = 5
+
+  # Lifetime of a job status stream and interval between keep-alive
+  # comments (in seconds); keep both below the load balancer idle timeout
+  JOB_STREAM_TIMEOUT = 55
+  JOB_STREAM_HEARTBEAT = 15
+  # Each open stream holds a worker thread (of GUNICORN_THREADS); at most
+  # this many streams per worker, and seconds until a turned-away page
+  # tries again
+  JOB_STREAM_MAX_PER_WORKER = 4
+  JOB_STREAM_RETRY = 30
+  # How often each worker re-reads the unfinished jobs its streams' pages
+  # show, all in one batch (in seconds), and at most how many jobs one
+  # stream watches
+  JOB_STREAM_POLL_INTERVAL = 15
+  JOB_STREAM_MAX_WATCHED = 100
+
+  # Log viewer: size of streamed chunks (in bytes) and default size of
+  # the tail view (in KB)
+  LOG_STREAM_CHUNK_SIZE = 65536
+  LOG_TAIL_DEFAULT_KB = 64
+
+  # Size of one page of the results preview (in bytes)
+  PREVIEW_PAGE_BYTES = 65536
+
+  # Zip export: results fetched from S3 in parallel, each read ahead at
+  # most EXPORT_QUEUE_CHUNKS chunks of EXPORT_CHUNK_SIZE bytes
+  EXPORT_CONCURRENCY = 4
+  EXPORT_CHUNK_SIZE = 1024 * 1024
+  EXPORT_QUEUE_CHUNKS = 4
 
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "nichada_annotations"
+  # Per-user job counters (hash key user_id)
+  AWS_DYNAMODB_SUMMARIES_TABLE = "nichada_annotation_summaries"
+  # Job submission token buckets (hash key bucket_key, TTL attribute
+  # expires_at)
+  AWS_DYNAMODB_ADMISSION_TABLE = "nichada_submission_buckets"
 
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "nichada@mpcs-cc.com"
 
+  # Job submission quotas per user, across all web servers, by role:
+  # (jobs per second, burst size); a batch counts one job per file
+  GAS_SUBMISSION_QUOTAS = {
+    'free_user': (1.0 / 60, 20),
+    'premium_user': (1.0, 300),
+  }
+
+  # Globus identities allowed to see /admin pages (comma separated)
+  GAS_ADMIN_IDENTITIES = os.environ['GAS_ADMIN_IDENTITIES'].split(',') \
+    if ('GAS_ADMIN_IDENTITIES' in os.environ) else []
+
+  # Add a Server-Timing header (app, AWS and database time) to responses
+  METRICS_SERVER_TIMING = (os.environ['METRICS_SERVER_TIMING'] == 'true') \
+    if ('METRICS_SERVER_TIMING' in os.environ) else False
+
+  # Lifetime of cached user profiles/roles (in seconds); profile writes
+  # invalidate immediately in this process and, through the profile
+  # events topic, within a second or so in the others
+  PROFILE_CACHE_TTL = 30
+
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
@@ -0,0 +1,100 @@
+# credentials.py
+#
+# Cache of AWS Secrets Manager secrets for the GAS web app
+#
+# Imported by config.py, so it must not import the Flask app.
+#
+##
+
+import os
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
+
+import boto3
+from botocore.exceptions import ClientError
+
+"""Secrets Manager secrets, fetched concurrently and cached with refresh-ahead
+A secret older than refresh_ahead * ttl is refreshed in the background
+on its next read (the caller still gets the cached value); one older
+than ttl is refetched before returning. Pass `client` to use a fake
+Secrets Manager.
+"""
+class SecretCache(object):
+  def __init__(self, region_name=None, ttl=3600, refresh_ahead=0.75,
+    client=None, clock=time.monotonic):
+    self.region_name = region_name
+    self.ttl = ttl
+    self.refresh_ahead = refresh_ahead
+    self.clock = clock
+    self.lock = Lock()
+    self.secrets = {}       # secret_id -> (value, fetched_at)
+    self.refreshing = set()
+    self._client = client
+    self._client_pid = os.getpid() if client else None
+
+  # boto3 clients must not cross a fork (e.g. gunicorn --preload), and
+  # creating them on the default session isn't thread-safe
+  def client(self):
+    with self.lock:
+      if self._client is None or self._client_pid != os.getpid():
+        self._client = boto3.client('secretsmanager', region_name=self.region_name)
+        self._client_pid = os.getpid()
+      return self._client
+
+  def fetch(self, secret_id):
+    response = self.client().get_secret_value(SecretId=secret_id)
+    value = json.loads(response['SecretString'])
+    with self.lock:
+      self.secrets[secret_id] = (value, self.clock())
+    return value
+
+  """Fetch several secrets at once; returns {secret_id: secret}
+  Raises the first ClientError, after all requests have finished.
+  """
+  def load(self, secret_ids):
+    # Before the threads start, so they share one client
+    self.client()
+    with ThreadPoolExecutor(max_workers=max(len(secret_ids), 1)) as pool:
+      futures = {secret_id: pool.submit(self.fetch, secret_id)
+        for secret_id in secret_ids}
+    return {secret_id: future.result() for secret_id, future in futures.items()}
+
+  def get(self, secret_id):
+    with self.lock:
+      cached = self.secrets.get(secret_id)
+    if cached is None:
+      return self.fetch(secret_id)
+
+    value, fetched_at = cached
+    age = self.clock() - fetched_at
+    if age >= self.ttl:
+      return self.fetch(secret_id)
+    if age >= self.ttl * self.refresh_ahead:
+      self.refresh_in_background(secret_id)
+    return value
+
+  def refresh_in_background(self, secret_id):
+    with self.lock:
+      if secret_id in self.refreshing:
+        return
+      self.refreshing.add(secret_id)
+
+    def refresh():
+      try:
+        self.fetch(secret_id)
+      except ClientError as e:
+        # Keep serving the cached value; retried on a later read
+        print(f"Unable to refresh secret {secret_id} from ASM: {e}")
+      finally:
+        with self.lock:
+          self.refreshing.discard(secret_id)
+
+    Thread(target=refresh, daemon=True).start()
+
+
+secrets = SecretCache(region_name=os.environ['AWS_REGION_NAME'] \
+  if ('AWS_REGION_NAME' in os.environ) else "us-east-1")
+
+### EOF
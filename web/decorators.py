@@ -8,11 +8,18 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
-from flask import redirect, request, session, url_for
+import math
+
+from flask import (abort, jsonify, make_response, redirect, render_template,
+  request, session, url_for)
 from functools import wraps
 
-from gas import db
-from models import Profile
+from botocore.exceptions import ClientError
+
+import aws
+from gas import app
+from admission import AdmissionController
+from profiles import get_cached_profile
 
 """Mark a route as requiring authentication
 """
@@ -32,18 +39,39 @@ def authenticated(fn):
 
   return decorated_function
 
+"""Mark a JSON API route as requiring authentication
+Same session login as authenticated(), but answers with a JSON error
+instead of redirecting to the login or profile page.
+"""
+def api_authenticated(fn):
+  @wraps(fn)
+  def decorated_function(*args, **kwargs):
+    if not session.get('is_authenticated'):
+      return jsonify(error="Authentication required"), 401
+
+    if (not session.get('name') or not session.get('email')):
+      return jsonify(error="Complete your profile before using the API"), 403
+
+    return fn(*args, **kwargs)
+
+  return decorated_function
+
 """Mark a route as accessible to subscribers (premium users) only
 Subscriber must have profile.role = premium_user
 """
 def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
-    # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
+    # Check if user is a subscriber (cached; see profiles.py)
+    profile = get_cached_profile(session.get('primary_identity'))
+    # The session role changes with /subscribe; the cached copy may not
+    # have caught up yet
+    if profile and profile['role'] != session.get('role'):
+      profile = get_cached_profile(session.get('primary_identity'), refresh=True)
     if not profile:
       # Force login
       return redirect(url_for('login', next=request.url))
-    elif (profile.role != "premium_user"):
+    elif (profile['role'] != "premium_user"):
       # Redirect free user to subscribe
       return redirect(url_for('subscribe', next=request.url))
 
@@ -51,4 +79,92 @@ def is_premium(fn):
 
   return decorated_function
 
+# Token buckets for job submission, per user and role, shared by all
+# web workers (see admission.py)
+submission_admission = AdmissionController(app.config['GAS_SUBMISSION_QUOTAS'],
+  aws.ProcessLocal(lambda: aws.resource('dynamodb',
+    region_name=app.config['AWS_REGION_NAME']).Table(
+    app.config['AWS_DYNAMODB_ADMISSION_TABLE'])))
+
+"""Take `jobs` submission tokens for the current user
+Returns None if admitted, else a 429 Too Many Requests response with
+Retry-After, as JSON for JSON requests and as the error page otherwise.
+Submissions are admitted if the token buckets can't be reached.
+"""
+def admit_submission(jobs=1):
+  try:
+    admitted, retry_after = submission_admission.admit(
+      session.get('primary_identity'), session.get('role', 'free_user'), jobs)
+  except ClientError as e:
+    app.logger.error(f"Unable to check submission quota: {e}")
+    return None
+  if admitted:
+    return None
+
+  if retry_after is None:
+    message = "This request submits more jobs than your plan allows at once."
+    headers = {}
+  else:
+    retry_after = max(int(math.ceil(retry_after)), 1)
+    message = f"You are submitting jobs too quickly; please retry in {retry_after} seconds."
+    headers = {'Retry-After': str(retry_after)}
+  if request.is_json:
+    return jsonify(error=message, retry_after=retry_after), 429, headers
+  return render_template('error.html',
+    title='Too many requests', alert_level='warning',
+    message=message), 429, headers
+
+"""Most jobs the current user can submit in one request"""
+def submission_burst():
+  return int(submission_admission.burst(session.get('role', 'free_user')))
+
+"""Give back `jobs` submission tokens taken for the current user"""
+def refund_submission(jobs=1):
+  try:
+    submission_admission.refund(
+      session.get('primary_identity'), session.get('role', 'free_user'), jobs)
+  except ClientError as e:
+    app.logger.error(f"Unable to refund submission quota: {e}")
+
+"""Limit how fast a user can submit jobs
+`cost` returns the number of jobs the request submits (default 1), or
+None for a malformed request, which is passed on to the route without
+taking tokens so that it can answer 400. The tokens are given back if
+the request fails (an error response, e.g. a rejected file list, or an
+exception), as no jobs were submitted.
+"""
+def admission_controlled(cost=None):
+  def decorator(fn):
+    @wraps(fn)
+    def decorated_function(*args, **kwargs):
+      jobs = cost() if cost else 1
+      if jobs is None:
+        return fn(*args, **kwargs)
+      rejected = admit_submission(jobs)
+      if rejected:
+        return rejected
+      try:
+        response = make_response(fn(*args, **kwargs))
+      except Exception:
+        refund_submission(jobs)
+        raise
+      if response.status_code >= 400:
+        refund_submission(jobs)
+      return response
+
+    return decorated_function
+  return decorator
+
+"""Mark a route as accessible to GAS administrators only
+Administrators are the Globus identities listed in GAS_ADMIN_IDENTITIES.
+"""
+def is_admin(fn):
+  @wraps(fn)
+  def decorated_function(*args, **kwargs):
+    if session.get('primary_identity') not in app.config['GAS_ADMIN_IDENTITIES']:
+      abort(403)
+    return fn(*args, **kwargs)
+
+  return decorated_function
+
 ### EOF
\ No newline at end of file
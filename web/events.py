@@ -0,0 +1,352 @@
+# events.py
+#
+# In-process publish/subscribe for job notifications
+#
+# The util and annotator instances announce job changes on SNS topics
+# (job results, thaws, job events). Each web worker subscribes an SQS
+# queue of its own to those topics; SqsEventListener drains that queue
+# and republishes each notification on the worker's EventBus, so web-tier
+# consumers (caches, status streams) never talk to SQS themselves. Tests can publish straight onto
+# the bus and skip SQS entirely.
+#
+##
+
+import ast
+import atexit
+import json
+import os
+import re
+import socket
+import time
+import uuid
+from threading import Lock, Thread
+
+from botocore.exceptions import ClientError
+
+import logging
+logger = logging.getLogger(__name__)
+
+"""Fan notifications out to in-process subscribers
+Subscribers are called synchronously on the publishing thread with
+(topic, data); a failing subscriber never stops delivery to the others.
+"""
+class EventBus(object):
+  def __init__(self):
+    self.lock = Lock()
+    self.subscribers = []
+
+  def subscribe(self, callback):
+    with self.lock:
+      self.subscribers.append(callback)
+    return callback
+
+  def unsubscribe(self, callback):
+    with self.lock:
+      if callback in self.subscribers:
+        self.subscribers.remove(callback)
+
+  def publish(self, topic, data):
+    with self.lock:
+      subscribers = list(self.subscribers)
+    for callback in subscribers:
+      try:
+        callback(topic, data)
+      except Exception as e:
+        logger.error(f"Event subscriber failed on {topic}: {e}")
+
+"""Parse an SNS notification delivered through SQS
+Returns (topic name, message dict). Publishers in this project send
+either JSON or a Python dict repr, so accept both.
+"""
+def parse_notification(body):
+  envelope = json.loads(body)
+  topic = envelope.get('TopicArn', '').split(':')[-1]
+  message = envelope['Message']
+  try:
+    data = json.loads(message)
+  except ValueError:
+    data = ast.literal_eval(message)
+  return topic, data
+
+"""Background thread that moves SNS notifications from SQS onto a bus
+Every process needs every notification (each has its own caches and
+streams), so each listener makes an SQS queue of its own, named
+<queue_prefix>-<host>-<pid>-<random>, and subscribes it to the topics;
+a queue shared by several workers would give each notification to just
+one of them. The queue is removed when the process exits. A live
+listener refreshes its queue's last_seen tag every `heartbeat` seconds,
+and every listener sweeps, on start and every `sweep_interval` seconds,
+the queues under the prefix (from any host) whose tag is older than
+`stale_after`, or whose process on this host is gone: those of crashed
+workers and of terminated instances. Started lazily, and again after a
+fork.
+"""
+class SqsEventListener(object):
+  def __init__(self, bus, sqs, sns, topic_arns, queue_prefix,
+    wait_time=20, retention_period=300, heartbeat=60, stale_after=600,
+    sweep_interval=600, clock=time.time):
+    self.bus = bus
+    self.sqs = sqs
+    self.sns = sns
+    self.topic_arns = list(topic_arns)
+    self.queue_prefix = queue_prefix
+    self.wait_time = wait_time
+    self.retention_period = retention_period
+    self.heartbeat = heartbeat
+    self.stale_after = stale_after
+    self.sweep_interval = sweep_interval
+    self.clock = clock
+    self.lock = Lock()
+    self.pid = None
+    self.queue_url = None
+    self.subscription_arns = []
+
+  def ensure_started(self):
+    if not self.queue_prefix or not self.topic_arns or self.pid == os.getpid():
+      return
+    with self.lock:
+      if self.pid == os.getpid():
+        return
+      self.pid = os.getpid()
+      Thread(target=self.run, name='gas-sqs-events', daemon=True).start()
+
+  def host_prefix(self):
+    host = re.sub(r'[^A-Za-z0-9_-]', '-', socket.gethostname())[:32]
+    return f"{self.queue_prefix}-{host}-"
+
+  # SNS FIFO topics only deliver to FIFO queues
+  def fifo(self):
+    return all(arn.endswith('.fifo') for arn in self.topic_arns)
+
+  def queue_arn(self, queue_url):
+    return self.sqs.get_queue_attributes(QueueUrl=queue_url,
+      AttributeNames=['QueueArn'])['Attributes']['QueueArn']
+
+  """Create this process's queue and subscribe it to the topics"""
+  def open(self):
+    name = f"{self.host_prefix()}{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    attributes = {'MessageRetentionPeriod': str(self.retention_period)}
+    if self.fifo():
+      name += '.fifo'
+      attributes['FifoQueue'] = 'true'
+    self.queue_url = self.sqs.create_queue(QueueName=name,
+      Attributes=attributes, tags=self.last_seen_tag())['QueueUrl']
+
+    queue_arn = self.queue_arn(self.queue_url)
+    self.sqs.set_queue_attributes(QueueUrl=self.queue_url, Attributes={
+      'Policy': json.dumps({
+        'Version': '2012-10-17',
+        'Statement': [{
+          'Effect': 'Allow',
+          'Principal': {'Service': 'sns.amazonaws.com'},
+          'Action': 'sqs:SendMessage',
+          'Resource': queue_arn,
+          'Condition': {'ArnEquals': {'aws:SourceArn': self.topic_arns}}
+        }]
+      })
+    })
+    for topic_arn in self.topic_arns:
+      self.subscription_arns.append(self.sns.subscribe(TopicArn=topic_arn,
+        Protocol='sqs', Endpoint=queue_arn,
+        ReturnSubscriptionArn=True)['SubscriptionArn'])
+
+  """Unsubscribe and delete this process's queue"""
+  def close(self):
+    if self.queue_url is None:
+      return
+    for subscription_arn in self.subscription_arns:
+      try:
+        self.sns.unsubscribe(SubscriptionArn=subscription_arn)
+      except Exception as e:
+        logger.error(f"Unable to unsubscribe {subscription_arn}: {e}")
+    self.subscription_arns = []
+    try:
+      self.sqs.delete_queue(QueueUrl=self.queue_url)
+    except Exception as e:
+      logger.error(f"Unable to delete job notification queue: {e}")
+    self.queue_url = None
+
+  def last_seen_tag(self):
+    return {'last_seen': str(int(self.clock()))}
+
+  """Show that this process's queue is still in use"""
+  def touch(self):
+    self.sqs.tag_queue(QueueUrl=self.queue_url, Tags=self.last_seen_tag())
+
+  def queue_urls(self):
+    kwargs = {'QueueNamePrefix': f"{self.queue_prefix}-", 'MaxResults': 1000}
+    while True:
+      response = self.sqs.list_queues(**kwargs)
+      yield from response.get('QueueUrls', [])
+      if not response.get('NextToken'):
+        return
+      kwargs['NextToken'] = response['NextToken']
+
+  def is_stale(self, queue_url):
+    if queue_url == self.queue_url:
+      return False
+    host_prefix = self.host_prefix()
+    name = queue_url.rsplit('/', 1)[-1]
+    if name.startswith(host_prefix):
+      pid = name[len(host_prefix):].split('-')[0]
+      if pid.isdigit() and not process_exists(int(pid)):
+        return True
+    tags = self.sqs.list_queue_tags(QueueUrl=queue_url).get('Tags', {})
+    last_seen = tags.get('last_seen', '')
+    return not last_seen.isdigit() or \
+      int(last_seen) < self.clock() - self.stale_after
+
+  """Remove the queues (and subscriptions) of listeners that are gone
+  without closing theirs
+  """
+  def sweep(self):
+    stale = {}
+    for queue_url in self.queue_urls():
+      try:
+        if self.is_stale(queue_url):
+          stale[self.queue_arn(queue_url)] = queue_url
+      except ClientError as e:
+        # e.g. deleted by another listener's sweep meanwhile
+        logger.info(f"Skipping queue {queue_url} in sweep: {e}")
+    if not stale:
+      return
+
+    for topic_arn in self.topic_arns:
+      kwargs = {'TopicArn': topic_arn}
+      while True:
+        response = self.sns.list_subscriptions_by_topic(**kwargs)
+        for subscription in response.get('Subscriptions', []):
+          if subscription['Endpoint'] in stale:
+            self.sns.unsubscribe(SubscriptionArn=subscription['SubscriptionArn'])
+        if not response.get('NextToken'):
+          break
+        kwargs['NextToken'] = response['NextToken']
+    for queue_url in stale.values():
+      try:
+        self.sqs.delete_queue(QueueUrl=queue_url)
+      except ClientError as e:
+        logger.info(f"Unable to delete stale queue {queue_url}: {e}")
+
+  def poll_once(self):
+    response = self.sqs.receive_message(
+      QueueUrl=self.queue_url,
+      MaxNumberOfMessages=10,
+      WaitTimeSeconds=self.wait_time)
+    messages = response.get('Messages', [])
+    for message in messages:
+      try:
+        topic, data = parse_notification(message['Body'])
+      except Exception as e:
+        logger.error(f"Dropping unparseable job notification: {e}")
+      else:
+        self.bus.publish(topic, data)
+    if messages:
+      self.sqs.delete_message_batch(
+        QueueUrl=self.queue_url,
+        Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']}
+          for i, m in enumerate(messages)])
+    return len(messages)
+
+  def run(self):
+    # A forked listener must not poll (or delete) its parent's queue
+    self.queue_url = None
+    self.subscription_arns = []
+    atexit.register(self.close)
+    while self.queue_url is None:
+      try:
+        self.open()
+      except Exception as e:
+        logger.error(f"Unable to subscribe to job notifications: {e}")
+        self.close()
+        time.sleep(5)
+    touched = swept = 0
+    while True:
+      try:
+        now = self.clock()
+        if now - touched >= self.heartbeat:
+          self.touch()
+          touched = now
+        if now - swept >= self.sweep_interval:
+          swept = now
+          self.sweep()
+        self.poll_once()
+      except Exception as e:
+        logger.error(f"Job notification poll failed: {e}")
+        time.sleep(5)
+
+"""Background thread that re-reads watched items for their watchers
+One thread per process reads all keys watched in the process with a
+single load(keys) call (e.g. a BatchGetItem) every `interval` seconds,
+so the reads don't grow with the number of watchers. load returns
+{key: item}; a watcher's callback gets (topic, item), like an EventBus
+subscriber. Started by the first watch, and again after a fork.
+"""
+class Poller(object):
+  def __init__(self, load, interval=15, topic='poll'):
+    self.load = load
+    self.interval = interval
+    self.topic = topic
+    self.lock = Lock()
+    self.pid = None
+    self.watches = {}     # key -> set of callbacks
+
+  def watch(self, keys, callback):
+    self.ensure_started()
+    with self.lock:
+      for key in keys:
+        self.watches.setdefault(key, set()).add(callback)
+
+  def unwatch(self, keys, callback):
+    with self.lock:
+      for key in keys:
+        callbacks = self.watches.get(key)
+        if callbacks is not None:
+          callbacks.discard(callback)
+          if not callbacks:
+            del self.watches[key]
+
+  def ensure_started(self):
+    if self.pid == os.getpid():
+      return
+    with self.lock:
+      if self.pid == os.getpid():
+        return
+      self.pid = os.getpid()
+      # Watches made before a fork belong to the parent's watchers
+      self.watches = {}
+      Thread(target=self.run, name='gas-poller', daemon=True).start()
+
+  def poll_once(self):
+    with self.lock:
+      keys = list(self.watches)
+    if not keys:
+      return 0
+    items = self.load(keys)
+    for key, item in items.items():
+      with self.lock:
+        callbacks = list(self.watches.get(key, ()))
+      for callback in callbacks:
+        try:
+          callback(self.topic, item)
+        except Exception as e:
+          logger.error(f"Poll watcher failed on {key}: {e}")
+    return len(items)
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      try:
+        self.poll_once()
+      except Exception as e:
+        logger.error(f"Poll failed: {e}")
+
+def process_exists(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+### EOF
@@ -0,0 +1,187 @@
+# export.py
+#
+# Streamed zip export of a user's annotation results
+#
+# The zip is written to the response as it is built: members are read
+# from S3 by a small pool of threads, each into a bounded queue of
+# chunks, so memory per export stays around
+# concurrency * (queue_chunks + 1) * chunk_size no matter how large the
+# results are, and nothing is written to disk. Members are stored with
+# data descriptors (the output is not seekable) and ZIP64 sizes.
+#
+##
+
+import queue
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import logging
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+"""Unseekable file-like sink for ZipFile; written bytes are taken out
+with take() and sent to the client
+"""
+class ZipSink(object):
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, data):
+    self.chunks.append(bytes(data))
+    return len(data)
+
+  def flush(self):
+    pass
+
+  def take(self):
+    data = b''.join(self.chunks)
+    self.chunks = []
+    return data
+
+"""One S3 object read in the background into a bounded queue of chunks
+Iterating yields the chunks; an S3 error is raised from the iterator.
+"""
+class ObjectFetch(object):
+  def __init__(self, s3, bucket, key, stop, chunk_size=1048576, queue_chunks=4):
+    self.s3 = s3
+    self.bucket = bucket
+    self.key = key
+    self.stop = stop
+    self.chunk_size = chunk_size
+    self.chunks = queue.Queue(maxsize=queue_chunks)
+
+  def run(self):
+    try:
+      body = self.s3.get_object(Bucket=self.bucket, Key=self.key)['Body']
+      try:
+        for chunk in body.iter_chunks(chunk_size=self.chunk_size):
+          if not self.put(chunk):
+            return
+      finally:
+        body.close()
+      self.put(_DONE)
+    except Exception as e:
+      self.put(e)
+
+  # Blocks while the queue is full; gives up once the export is stopped
+  def put(self, item):
+    while not self.stop.is_set():
+      try:
+        self.chunks.put(item, timeout=1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def __iter__(self):
+    while True:
+      item = self.chunks.get()
+      if item is _DONE:
+        return
+      if isinstance(item, Exception):
+        raise item
+      yield item
+
+"""Zip members for a user's jobs: (entries, skipped)
+entries are (name in the zip, S3 key, epoch time) for the result and
+log files of completed jobs whose results are in S3; skipped are
+(job_id, reason) for completed jobs whose results are archived in
+Glacier or still being restored (their logs are exported anyway).
+"""
+def export_entries(jobs):
+  entries, skipped = [], []
+  for job in sorted(jobs, key=lambda job: job.get('submit_time', 0)):
+    if job.get('job_status') != 'COMPLETED':
+      continue
+    job_id = job['job_id']
+    modified = int(job.get('complete_time') or job.get('submit_time') or time.time())
+
+    keys = [job.get('s3_key_log_file')]
+    if 'results_file_archive_id' not in job or job.get('restore_message') == '':
+      keys.append(job.get('s3_key_result_file'))
+    elif job.get('restore_message'):
+      skipped.append((job_id, 'being restored from the archive'))
+    else:
+      skipped.append((job_id, 'archived'))
+
+    for key in filter(None, keys):
+      entries.append((f"{job_id}/{key.split('~')[-1]}", key, modified))
+  return entries, skipped
+
+def manifest_text(entries, skipped, failed):
+  lines = [f"GAS annotations export, {len(entries) - len(failed)} files", '']
+  lines += [f"{name}" for name, _key, _modified in entries if name not in failed]
+  if skipped or failed:
+    lines += ['', 'Not included:']
+    lines += [f"{job_id}: results {reason}" for job_id, reason in skipped]
+    lines += [f"{name}: {reason}" for name, reason in failed.items()]
+  return '\n'.join(lines) + '\n'
+
+"""Generate a zip of the given entries from S3, followed by MANIFEST.txt
+Up to `concurrency` objects are fetched ahead of the one being written.
+An object that can't be read before any of it is written is left out
+and listed in the manifest.
+"""
+def zip_stream(s3, bucket, entries, skipped=(), concurrency=4,
+  chunk_size=1048576, queue_chunks=4):
+  sink = ZipSink()
+  stop = Event()
+  pool = ThreadPoolExecutor(max_workers=concurrency)
+  archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED)
+  remaining = iter(entries)
+  fetches = deque()
+  failed = {}
+
+  def prefetch():
+    while len(fetches) < concurrency:
+      entry = next(remaining, None)
+      if entry is None:
+        return
+      fetch = ObjectFetch(s3, bucket, entry[1], stop,
+        chunk_size=chunk_size, queue_chunks=queue_chunks)
+      pool.submit(fetch.run)
+      fetches.append((entry, fetch))
+
+  try:
+    prefetch()
+    while fetches:
+      (name, key, modified), fetch = fetches.popleft()
+      prefetch()
+
+      info = zipfile.ZipInfo(name, date_time=time.gmtime(modified)[:6])
+      info.compress_type = zipfile.ZIP_DEFLATED
+      member = None
+      try:
+        for chunk in fetch:
+          if member is None:
+            member = archive.open(info, 'w', force_zip64=True)
+          member.write(chunk)
+          data = sink.take()
+          if data:
+            yield data
+      except Exception as e:
+        if member is not None:
+          # Part of the member was already sent; the zip can't be fixed
+          logger.error(f"Export failed while reading {key}: {e}")
+          raise
+        logger.error(f"Export skipped {key}: {e}")
+        failed[name] = 'could not be read'
+        continue
+      if member is None:
+        archive.writestr(info, b'')
+      else:
+        member.close()
+      yield sink.take()
+
+    archive.writestr('MANIFEST.txt', manifest_text(entries, skipped, failed))
+    archive.close()
+    yield sink.take()
+  finally:
+    stop.set()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+### EOF
@@ -0,0 +1,16 @@
+# gunicorn_conf.py
+#
+# gunicorn server hooks for the GAS web app (see run_gas.sh)
+#
+##
+
+"""Start a worker's background threads as soon as it is forked, rather
+than on its first request: jobs left in the outbox by a crashed worker
+or a deploy are then published without waiting for a new submission
+"""
+def post_fork(server, worker):
+  from jobs import job_events_listener, job_outbox
+  job_outbox.ensure_started()
+  job_events_listener.ensure_started()
+
+### EOF
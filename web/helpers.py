@@ -10,6 +10,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import re
 import json
+import time
 
 from flask import request, render_template
 from threading import Lock
@@ -22,13 +23,17 @@ except:
   from urlparse import urlparse, urljoin
 
 from gas import app, db
+from credentials import secrets
 
 """Create an AuthClient for the GAS app
+Credentials come from the secret cache, so a rotated client secret is
+picked up without a restart.
 """
 def load_portal_client():
+  globus_auth = secrets.get('globus/auth_client')
   return globus_sdk.ConfidentialAppAuthClient(
-    app.config['GAS_CLIENT_ID'],
-    app.config['GAS_CLIENT_SECRET']
+    globus_auth['gas_client_id'],
+    globus_auth['gas_client_secret']
   )
 
 """https://security.openstack.org/guidelines/dg_avoid-unvalidated-redirects.html
@@ -60,11 +65,14 @@ def get_portal_tokens(scopes=None):
   scopes = scopes or \
     ['openid','urn:globus:auth:scope:demo-resource-server:all']
   with get_portal_tokens.lock:
-    if not get_portal_tokens.access_tokens:
-      get_portal_tokens.access_tokens = {}
-
     scope_string = ' '.join(scopes)
 
+    # Reuse the tokens granted for these scopes until shortly before
+    # the first of them expires
+    access_tokens, expires_at = get_portal_tokens.granted.get(scope_string, ({}, 0))
+    if expires_at - app.config['GLOBUS_TOKEN_REFRESH_MARGIN'] > time.time():
+      return dict(access_tokens)
+
     client = load_portal_client()
     tokens = client.oauth2_client_credentials_tokens(
       requested_scopes=scope_string
@@ -73,8 +81,9 @@ def get_portal_tokens(scopes=None):
     # Walk all resource servers in the token response (includes the
     # top-level server, as found in tokens.resource_server), and store the
     # relevant Access Tokens
+    access_tokens = {}
     for resource_server, token_info in tokens.by_resource_server.items():
-      get_portal_tokens.access_tokens.update({
+      access_tokens.update({
         resource_server: {
           'token': token_info['access_token'],
           'scope': token_info['scope'],
@@ -82,9 +91,14 @@ def get_portal_tokens(scopes=None):
         }
       })
 
-    return get_portal_tokens.access_tokens
+    get_portal_tokens.granted[scope_string] = (access_tokens, min(
+      [token_info['expires_at_seconds']
+        for token_info in tokens.by_resource_server.values()] or [0]))
+
+    return dict(access_tokens)
 
 get_portal_tokens.lock = Lock()
-get_portal_tokens.access_tokens = None
+# scope string -> (tokens by resource server, when the first expires)
+get_portal_tokens.granted = {}
 
 ### EOF
@@ -0,0 +1,399 @@
+# jobs.py
+#
+# Access to annotation job items in DynamoDB for the GAS web app
+#
+##
+
+import json
+import queue
+import random
+import time
+import uuid
+from decimal import Decimal
+from threading import BoundedSemaphore
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from itsdangerous import BadSignature, URLSafeSerializer
+
+import aws
+from gas import app
+from cache import JobCache, TERMINAL_STATUSES
+from events import EventBus, Poller, SqsEventListener
+from outbox import OutboxDispatcher, with_outbox_marker
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Status shown to users for each job event published by the util and
+# annotator instances
+EVENT_STATUSES = {
+  'running': 'RUNNING',
+  'archived': 'ARCHIVED',
+  'restored': 'RESTORED',
+}
+
+# Counters kept on each user's job summary item
+SUMMARY_COUNTERS = ('jobs_submitted', 'count_pending', 'count_running',
+  'count_completed', 'count_failed', 'count_archived', 'bytes_annotated')
+
+# Most job items saved per transaction (TransactWriteItems takes 100
+# actions; one is the job summary update)
+SUBMIT_TRANSACTION_JOBS = 99
+
+# Paging cursors are the index's last evaluated key, signed so that a
+# client can't make up a start key
+cursor_serializer = URLSafeSerializer(app.secret_key, salt='jobs-cursor')
+
+# BatchGetItem attempts before giving up on unprocessed keys, and the
+# first and largest backoff between them (in seconds)
+BATCH_GET_ATTEMPTS = 6
+BATCH_GET_BACKOFF = 0.05
+BATCH_GET_MAX_BACKOFF = 2
+
+"""DynamoDB is throttling reads; some jobs couldn't be read"""
+class JobsUnavailableError(Exception):
+  pass
+
+"""Submitting would overwrite existing jobs (job IDs come from the
+uploaded inputs' S3 keys)
+"""
+class JobExistsError(Exception):
+  def __init__(self, job_ids):
+    super().__init__(f"Jobs already exist: {', '.join(job_ids)}")
+    self.job_ids = job_ids
+
+# Notifications from the job results, thaws and job events topics
+job_events = EventBus()
+
+# Created in each worker on first use (see aws.py)
+dynamodb = aws.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+annotations_table = aws.ProcessLocal(
+  lambda: dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']))
+
+summaries_table = aws.ProcessLocal(
+  lambda: dynamodb.Table(app.config['AWS_DYNAMODB_SUMMARIES_TABLE']))
+
+# Without notification queues nothing evicts changed items, so every
+# item is only kept for the short in-flight TTL
+job_cache = JobCache(annotations_table,
+  ttl=app.config['JOB_CACHE_TTL'] if app.config['AWS_SQS_JOB_EVENTS_QUEUE_PREFIX'] \
+    else app.config['JOB_CACHE_ACTIVE_TTL'],
+  active_ttl=app.config['JOB_CACHE_ACTIVE_TTL'])
+job_events.subscribe(job_cache.on_event)
+
+job_events_listener = SqsEventListener(job_events,
+  aws.client('sqs', region_name=app.config['AWS_REGION_NAME']),
+  aws.client('sns', region_name=app.config['AWS_REGION_NAME']),
+  app.config['JOB_EVENT_TOPICS'],
+  app.config['AWS_SQS_JOB_EVENTS_QUEUE_PREFIX'],
+  retention_period=app.config['AWS_SQS_JOB_EVENTS_RETENTION'])
+
+# Publishes new jobs to the job requests topic off the request thread
+job_outbox = OutboxDispatcher(annotations_table,
+  aws.client('sns', region_name=app.config['AWS_REGION_NAME']),
+  app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
+  sweep_interval=app.config['OUTBOX_SWEEP_INTERVAL'],
+  sweep_age=app.config['OUTBOX_SWEEP_AGE'])
+
+# Re-reads the unfinished jobs shown by open job status streams, in case
+# a notification is lost
+job_poller = Poller(
+  lambda job_ids: batch_get_jobs(job_ids, attributes=['user_id', 'job_status']),
+  interval=app.config['JOB_STREAM_POLL_INTERVAL'])
+
+# Open job status streams in this worker (see views.annotations_stream)
+job_streams = BoundedSemaphore(app.config['JOB_STREAM_MAX_PER_WORKER'])
+
+"""Reduce a job notification to {job_id, user_id, job_status}
+Returns None for notifications that are not a status change.
+"""
+def job_status_event(topic, data):
+  if not isinstance(data, dict) or not data.get('job_id'):
+    return None
+  if 'event' in data:
+    status = EVENT_STATUSES.get(data['event'])
+  elif 'retrieval_job_id' in data:
+    status = 'RESTORING'
+  else:
+    status = data.get('job_status')
+  if not status:
+    return None
+  return {
+    'job_id': data['job_id'],
+    'user_id': data.get('user_id'),
+    'job_status': status
+  }
+
+"""Generate a server-sent event stream of one user's job status changes
+Fed from job_events, so any number of open streams costs no DynamoDB
+reads. In case a notification is lost, the unfinished jobs in `watch`
+({job_id: status shown}, from the page) are also watched with
+job_poller, which re-reads all the jobs watched in this worker in one
+batch; a status is only sent if it is new to the page. The stream
+closes after `timeout` seconds (below the load balancer idle timeout)
+and the browser reconnects on its own.
+"""
+def job_status_stream(user_id, watch=None, timeout=None, heartbeat=None):
+  timeout = timeout or app.config['JOB_STREAM_TIMEOUT']
+  heartbeat = heartbeat or app.config['JOB_STREAM_HEARTBEAT']
+  job_events_listener.ensure_started()
+  updates = queue.Queue(maxsize=100)
+  # job_id -> status the page last got
+  watched = dict(watch or {})
+
+  def on_event(topic, data):
+    status = job_status_event(topic, data)
+    if status and status['user_id'] == user_id:
+      try:
+        updates.put_nowait(status)
+      except queue.Full:
+        pass
+
+  def changed(status):
+    job_id = status['job_id']
+    if watched.get(job_id) == status['job_status']:
+      return False
+    if job_id in watched:
+      watched[job_id] = status['job_status']
+      if status['job_status'] in TERMINAL_STATUSES:
+        job_poller.unwatch([job_id], on_event)
+    return True
+
+  job_events.subscribe(on_event)
+  job_poller.watch([job_id for job_id, status in watched.items()
+    if status not in TERMINAL_STATUSES], on_event)
+  try:
+    yield "retry: 3000\n\n"
+    deadline = time.monotonic() + timeout
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return
+      try:
+        status = updates.get(timeout=min(heartbeat, remaining))
+      except queue.Empty:
+        yield ": keep-alive\n\n"
+        continue
+      if changed(status):
+        yield f"event: job_status\ndata: {json.dumps(status)}\n\n"
+  finally:
+    job_events.unsubscribe(on_event)
+    job_poller.unwatch(list(watched), on_event)
+
+"""Get a job item (or some of its attributes) through the job cache
+Returns None if the job does not exist.
+"""
+def get_job(job_id, attributes=None):
+  job_events_listener.ensure_started()
+  return job_cache.get(job_id, attributes=attributes)
+
+"""Build the item for a new annotation job from its uploaded input's S3 key
+The job ID is the part of the file name before '~'. It comes from the
+client, so jobs are only ever written with a condition that the ID is
+new (see write_jobs).
+"""
+def new_job_item(s3_key, bucket_name, user_id, user_email, batch_id=None,
+  input_sha256=None):
+  input_file = s3_key.split('/')[-1]
+  data = {
+    "job_id": input_file.split('~')[0],
+    "user_id": user_id,
+    "user_email": user_email,
+    "input_file_name": input_file,
+    "s3_inputs_bucket": bucket_name,
+    "s3_key_input_file": s3_key,
+    "submit_time": int(time.time()),
+    "job_status": "PENDING"
+  }
+  if batch_id:
+    data['batch_id'] = batch_id
+  if input_sha256:
+    data['input_sha256'] = input_sha256
+  return data
+
+"""Find an input this user already uploaded with the given SHA-256
+Returns {'s3_inputs_bucket', 's3_key_input_file'} or None. One query on
+the sparse 'user_digest_index' GSI (hash key user_id, range key
+input_sha256, projecting the input location) finds it, whatever the
+size of the user's job history; only the user's own jobs are searched,
+so a digest never exposes another user's file.
+"""
+def find_input_by_digest(user_id, input_sha256):
+  response = annotations_table.query(
+    IndexName='user_digest_index',
+    KeyConditionExpression=Key('user_id').eq(user_id) & Key('input_sha256').eq(input_sha256),
+    ProjectionExpression='s3_inputs_bucket, s3_key_input_file',
+    Limit=1)
+  items = response.get('Items')
+  return items[0] if items else None
+
+"""Save a new job and queue its announcement to the annotator
+One DynamoDB transaction stores the item together with its outbox
+marker and counts it in the user's job summary; the outbox dispatcher
+publishes it in the background. Raises JobExistsError rather than
+overwrite an existing job.
+"""
+def submit_job(item):
+  write_jobs([item])
+  job_outbox.enqueue(item)
+
+"""Save many new jobs at once
+Items are written SUBMIT_TRANSACTION_JOBS to a transaction, each
+transaction also counting its jobs in the user's job summary, so the
+counters always match the saved jobs; the outbox dispatcher announces
+them with SNS PublishBatch, 10 per request. Raises ValueError for
+duplicate job IDs, and JobExistsError (before writing anything, where
+it can tell) rather than overwrite existing jobs.
+"""
+def submit_jobs(items):
+  duplicates = duplicate_job_ids(items)
+  if duplicates:
+    raise ValueError(f"Duplicate job IDs: {', '.join(duplicates)}")
+  existing = batch_get_jobs([item['job_id'] for item in items], attributes=['job_id'])
+  if existing:
+    raise JobExistsError(sorted(existing))
+
+  for i in range(0, len(items), SUBMIT_TRANSACTION_JOBS):
+    write_jobs(items[i:i + SUBMIT_TRANSACTION_JOBS])
+    for item in items[i:i + SUBMIT_TRANSACTION_JOBS]:
+      job_outbox.enqueue(item)
+
+"""Put new job items (with outbox markers), only if no job has their
+IDs, and count them in their user's summary, in one transaction
+"""
+def write_jobs(items):
+  actions = [{'Put': {
+    'TableName': annotations_table.name,
+    'Item': with_outbox_marker(item),
+    'ConditionExpression': 'attribute_not_exists(job_id)'
+  }} for item in items]
+  actions.append({'Update': summary_submission_update(items[0]['user_id'],
+    len(items), max(item['submit_time'] for item in items))})
+  try:
+    dynamodb.meta.client.transact_write_items(TransactItems=actions)
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'TransactionCanceledException':
+      raise
+    reasons = e.response.get('CancellationReasons', [])
+    existing = [item['job_id'] for item, reason in zip(items, reasons)
+      if reason.get('Code') == 'ConditionalCheckFailed']
+    if existing:
+      raise JobExistsError(existing)
+    raise
+
+"""Job IDs that appear more than once among new job items"""
+def duplicate_job_ids(items):
+  seen, duplicates = set(), []
+  for item in items:
+    if item['job_id'] in seen and item['job_id'] not in duplicates:
+      duplicates.append(item['job_id'])
+    seen.add(item['job_id'])
+  return duplicates
+
+"""Update for the user's summary item counting `count` new PENDING jobs
+The summary item (one per user, in AWS_DYNAMODB_SUMMARIES_TABLE) holds
+counters kept by the web, annotator and util instances: jobs_submitted,
+count_pending, count_running, count_completed, count_failed,
+count_archived, bytes_annotated, and last_submit_time.
+"""
+def summary_submission_update(user_id, count, submit_time):
+  return {
+    'TableName': summaries_table.name,
+    'Key': {'user_id': user_id},
+    'UpdateExpression': 'ADD jobs_submitted :n, count_pending :n '
+      'SET last_submit_time = :t',
+    'ExpressionAttributeValues': {':n': count, ':t': submit_time}
+  }
+
+"""Get the user's job summary counters (all zero for a new user)"""
+def get_job_summary(user_id):
+  item = summaries_table.get_item(Key={'user_id': user_id}).get('Item') or {}
+  summary = {name: int(item.get(name, 0)) for name in SUMMARY_COUNTERS}
+  summary['last_submit_time'] = item.get('last_submit_time')
+  return summary
+
+"""Get many jobs (or some of their attributes) with BatchGetItem
+Reads up to 100 jobs per request and retries unprocessed keys with
+exponential backoff and full jitter, up to BATCH_GET_ATTEMPTS requests.
+Returns {job_id: item} for the jobs that exist; raises
+JobsUnavailableError if keys are still unprocessed after that.
+"""
+def batch_get_jobs(job_ids, attributes=None):
+  table_name = annotations_table.name
+  jobs = {}
+  job_ids = list(dict.fromkeys(job_ids))
+  for i in range(0, len(job_ids), 100):
+    request = {'Keys': [{'job_id': job_id} for job_id in job_ids[i:i + 100]]}
+    if attributes:
+      projection = sorted(set(attributes) | {'job_id'})
+      names = {f'#p{n}': name for n, name in enumerate(projection)}
+      request['ProjectionExpression'] = ', '.join(names)
+      request['ExpressionAttributeNames'] = names
+
+    pending = {table_name: request}
+    for attempt in range(BATCH_GET_ATTEMPTS):
+      if attempt:
+        time.sleep(random.uniform(0,
+          min(BATCH_GET_BACKOFF * 2 ** attempt, BATCH_GET_MAX_BACKOFF)))
+      response = dynamodb.batch_get_item(RequestItems=pending)
+      for item in response['Responses'].get(table_name, []):
+        jobs[item['job_id']] = item
+      pending = response.get('UnprocessedKeys') or {}
+      if not pending:
+        break
+    else:
+      raise JobsUnavailableError(
+        f"{len(pending[table_name]['Keys'])} jobs left unprocessed")
+  return jobs
+
+"""List a user's jobs a page at a time
+`cursor` is the opaque next_cursor from the previous page. Returns
+(items, next_cursor); next_cursor is None on the last page.
+"""
+def list_jobs(user_id, limit=50, cursor=None, attributes=None):
+  kwargs = {
+    'IndexName': 'user_id_index',
+    'KeyConditionExpression': Key('user_id').eq(user_id),
+    'Limit': limit
+  }
+  if attributes:
+    names = {f'#p{n}': name for n, name in enumerate(attributes)}
+    kwargs['ProjectionExpression'] = ', '.join(names)
+    kwargs['ExpressionAttributeNames'] = names
+  if cursor:
+    try:
+      start_key = cursor_serializer.loads(cursor)
+    except BadSignature:
+      raise ValueError("Invalid cursor")
+    # Whatever the index's key schema, a cursor signed for one user
+    # can't page through another user's jobs
+    if start_key.get('user_id') != user_id:
+      raise ValueError("Invalid cursor")
+    kwargs['ExclusiveStartKey'] = start_key
+
+  response = annotations_table.query(**kwargs)
+  next_cursor = None
+  if 'LastEvaluatedKey' in response:
+    next_cursor = cursor_serializer.dumps(plain_item(response['LastEvaluatedKey']))
+  return response['Items'], next_cursor
+
+"""Iterate over all of a user's jobs (or some of their attributes)"""
+def iter_user_jobs(user_id, attributes=None):
+  cursor = None
+  while True:
+    items, cursor = list_jobs(user_id, limit=1000, cursor=cursor,
+      attributes=attributes)
+    yield from items
+    if cursor is None:
+      return
+
+"""A DynamoDB item with Decimals turned into ints/floats, for JSON"""
+def plain_item(item):
+  return {k: (int(v) if v % 1 == 0 else float(v)) if isinstance(v, Decimal) else v
+    for k, v in item.items()}
+
+def new_batch_id():
+  return str(uuid.uuid4())
+
+### EOF
@@ -0,0 +1,208 @@
+# metrics.py
+#
+# Request latency instrumentation for the GAS web app
+#
+# Records a latency histogram per route, and accounts for the time spent
+# in AWS calls (through botocore event hooks on the default boto3
+# session) and in Postgres queries (through SQLAlchemy engine events),
+# both per request and in aggregate. Must be imported before the web
+# app creates its boto3 clients: clients copy the session's hooks when
+# they are created.
+#
+# Route times are measured up to the end of the view (before a streamed
+# body is sent). Counters are per worker process and are not aggregated:
+# a snapshot covers only the worker that served it (identified by host
+# and pid, with the time it started counting), so /admin/metrics shows
+# one worker's partial view of the traffic.
+#
+##
+
+import os
+import socket
+import time
+from threading import Lock
+
+import boto3
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Histogram bucket upper bounds, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+"""Latency histogram with count, total and maximum; not thread-safe
+on its own (Metrics locks)
+"""
+class LatencyHistogram(object):
+  def __init__(self, buckets=LATENCY_BUCKETS_MS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.errors = 0
+    self.total_ms = 0.0
+    self.max_ms = 0.0
+
+  def observe(self, ms, error=False):
+    n = 0
+    while n < len(self.buckets) and ms > self.buckets[n]:
+      n += 1
+    self.counts[n] += 1
+    self.count += 1
+    self.errors += bool(error)
+    self.total_ms += ms
+    self.max_ms = max(self.max_ms, ms)
+
+  def snapshot(self):
+    labels = [f"le_{bound}" for bound in self.buckets] + ['inf']
+    return {
+      'count': self.count,
+      'errors': self.errors,
+      'mean_ms': round(self.total_ms / self.count, 2) if self.count else None,
+      'max_ms': round(self.max_ms, 2),
+      'buckets_ms': dict(zip(labels, self.counts))
+    }
+
+class Metrics(object):
+  def __init__(self):
+    self.lock = Lock()
+    self.pid = None
+    self.since = None
+    self.histograms = {}      # (kind, name) -> LatencyHistogram
+    self.route_totals = {}    # route -> {'aws_calls', 'aws_ms', 'db_queries', 'db_ms'}
+
+  # Counters start over in each forked worker
+  def reset_after_fork(self):
+    if self.pid != os.getpid():
+      self.pid = os.getpid()
+      self.since = time.time()
+      self.histograms = {}
+      self.route_totals = {}
+
+  def observe(self, kind, name, ms, error=False):
+    with self.lock:
+      self.reset_after_fork()
+      histogram = self.histograms.get((kind, name))
+      if histogram is None:
+        histogram = self.histograms[(kind, name)] = LatencyHistogram()
+      histogram.observe(ms, error)
+
+  def add_route_totals(self, route, tally):
+    with self.lock:
+      self.reset_after_fork()
+      totals = self.route_totals.setdefault(route,
+        {'aws_calls': 0, 'aws_ms': 0.0, 'db_queries': 0, 'db_ms': 0.0})
+      for name, value in tally.items():
+        totals[name] += value
+
+  def snapshot(self):
+    with self.lock:
+      self.reset_after_fork()
+      result = {
+        'worker': {'host': socket.gethostname(), 'pid': self.pid,
+          'since': round(self.since, 3)},
+        'routes': {}, 'aws': {}, 'db': {}
+      }
+      for (kind, name), histogram in sorted(self.histograms.items()):
+        result[kind][name] = histogram.snapshot()
+      for route, totals in self.route_totals.items():
+        if route in result['routes']:
+          result['routes'][route].update(
+            {name: round(value, 2) for name, value in totals.items()})
+      return result
+
+metrics = Metrics()
+
+"""The current request's tally of AWS and database time, or None
+outside a request (e.g. on background threads)
+"""
+def request_tally():
+  if not has_app_context() or 'metrics_start' not in g:
+    return None
+  if 'metrics_tally' not in g:
+    g.metrics_tally = {'aws': {}, 'db_queries': 0, 'db_ms': 0.0}
+  return g.metrics_tally
+
+# -------------------- AWS calls (botocore hooks) --------------------
+def aws_before_call(model, context, **kwargs):
+  name = f"{model.service_model.service_name}.{model.name}"
+  context['gas_metrics'] = (name, time.perf_counter())
+
+# Also the after-call-error handler (connection errors), which gets no model
+def aws_after_call(context, http_response=None, exception=None, **kwargs):
+  name, start = context.pop('gas_metrics', (None, None))
+  if start is None:
+    return
+  ms = (time.perf_counter() - start) * 1000
+  error = exception is not None or \
+    (http_response is not None and http_response.status_code >= 300)
+  metrics.observe('aws', name, ms, error)
+
+  tally = request_tally()
+  if tally is not None:
+    calls = tally['aws'].setdefault(name, {'count': 0, 'ms': 0.0})
+    calls['count'] += 1
+    calls['ms'] += ms
+
+if boto3.DEFAULT_SESSION is None:
+  boto3.setup_default_session()
+boto3.DEFAULT_SESSION.events.register('before-call', aws_before_call)
+boto3.DEFAULT_SESSION.events.register('after-call', aws_after_call)
+boto3.DEFAULT_SESSION.events.register('after-call-error', aws_after_call)
+
+# -------------------- Postgres queries (SQLAlchemy events) --------------------
+@event.listens_for(Engine, 'before_cursor_execute')
+def db_before_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('gas_metrics_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def db_after_execute(conn, cursor, statement, parameters, context, executemany):
+  starts = conn.info.get('gas_metrics_start')
+  if not starts:
+    return
+  ms = (time.perf_counter() - starts.pop()) * 1000
+  metrics.observe('db', statement.split(None, 1)[0].upper(), ms)
+
+  tally = request_tally()
+  if tally is not None:
+    tally['db_queries'] += 1
+    tally['db_ms'] += ms
+
+# -------------------- Routes --------------------
+def start_request_timer():
+  g.metrics_start = time.perf_counter()
+
+def record_request_time(response):
+  start = g.pop('metrics_start', None)
+  if start is None:
+    return response
+  ms = (time.perf_counter() - start) * 1000
+  route = f"{request.method} {request.url_rule.rule if request.url_rule else '<unmatched>'}"
+  metrics.observe('routes', route, ms, error=response.status_code >= 500)
+
+  tally = g.pop('metrics_tally', None) or {'aws': {}, 'db_queries': 0, 'db_ms': 0.0}
+  aws_calls = sum(calls['count'] for calls in tally['aws'].values())
+  aws_ms = sum(calls['ms'] for calls in tally['aws'].values())
+  metrics.add_route_totals(route, {'aws_calls': aws_calls, 'aws_ms': aws_ms,
+    'db_queries': tally['db_queries'], 'db_ms': tally['db_ms']})
+  by_operation = {name: calls['count'] for name, calls in tally['aws'].items()}
+  current_app.logger.debug(f"{route} {ms:.1f}ms; AWS {aws_calls} calls {aws_ms:.1f}ms "
+    f"{by_operation}; DB {tally['db_queries']} queries {tally['db_ms']:.1f}ms")
+
+  if current_app.config.get('METRICS_SERVER_TIMING'):
+    response.headers['Server-Timing'] = server_timing(ms, aws_calls, aws_ms,
+      tally['db_queries'], tally['db_ms'])
+  return response
+
+def server_timing(ms, aws_calls, aws_ms, db_queries, db_ms):
+  return ', '.join([
+    f"app;dur={ms:.1f}",
+    f'aws;dur={aws_ms:.1f};desc="{aws_calls} calls"',
+    f'db;dur={db_ms:.1f};desc="{db_queries} queries"'
+  ])
+
+"""Time every request of `app`"""
+def init_app(app):
+  app.before_request(start_request_timer)
+  app.after_request(record_request_time)
+
+### EOF
@@ -0,0 +1,186 @@
+# outbox.py
+#
+# Transactional outbox for job request notifications
+#
+# A new job item is written with an outbox marker (outbox_status =
+# 'pending') in the same put, and the request returns right away. The
+# dispatcher thread publishes marked jobs to the job requests topic in
+# batches, retrying failures, and then removes the marker. Jobs whose
+# marker outlives OUTBOX_SWEEP_AGE (e.g. the worker died before
+# publishing) are found again through the sparse 'outbox_index' GSI
+# (hash key outbox_status, range key submit_time, all attributes
+# projected) and republished. Every worker sweeps, so a swept job is
+# first claimed with a conditional update that leases it to one worker
+# (outbox_claimed_until) for `claim_lease` seconds; the FIFO topic also
+# deduplicates on job ID. The dispatcher is started when a worker starts
+# (see gunicorn_conf.py), so the sweep runs without new submissions.
+#
+##
+
+import os
+import time
+from collections import deque
+from decimal import Decimal
+from threading import Condition, Lock, Thread
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+import logging
+logger = logging.getLogger(__name__)
+
+OUTBOX_PENDING = 'pending'
+OUTBOX_ATTRIBUTES = ('outbox_status', 'outbox_claimed_until')
+
+"""Mark a job item as not yet published"""
+def with_outbox_marker(item):
+  return dict(item, outbox_status=OUTBOX_PENDING)
+
+"""The job request message for an item: marker removed, numbers as ints"""
+def job_message(item):
+  return {k: (int(v) if isinstance(v, Decimal) else v)
+    for k, v in item.items() if k not in OUTBOX_ATTRIBUTES}
+
+class OutboxDispatcher(object):
+  def __init__(self, table, sns, topic_arn, batch_size=10,
+    max_attempts=8, sweep_interval=60, sweep_age=60, claim_lease=300):
+    self.table = table
+    self.sns = sns
+    self.topic_arn = topic_arn
+    self.batch_size = min(batch_size, 10)   # SNS PublishBatch limit
+    self.max_attempts = max_attempts
+    self.sweep_interval = sweep_interval
+    self.sweep_age = sweep_age
+    self.claim_lease = claim_lease
+    self.pending = deque()      # (ready_at, attempts, item)
+    self.wakeup = Condition(Lock())
+    self.pid = None
+    self.last_sweep = 0
+
+  def enqueue(self, item, attempts=0, delay=0):
+    with self.wakeup:
+      self.pending.append((time.monotonic() + delay, attempts, item))
+      self.wakeup.notify()
+    self.ensure_started()
+
+  def ensure_started(self):
+    if self.pid == os.getpid():
+      return
+    with self.wakeup:
+      if self.pid == os.getpid():
+        return
+      self.pid = os.getpid()
+      Thread(target=self.run, name='gas-outbox', daemon=True).start()
+
+  # Take up to batch_size entries that are due; keep the rest queued
+  def take_batch(self):
+    with self.wakeup:
+      now = time.monotonic()
+      if not any(entry[0] <= now for entry in self.pending):
+        next_ready = min((entry[0] for entry in self.pending), default=now + 1)
+        self.wakeup.wait(timeout=min(max(next_ready - now, 0.05), 1))
+        now = time.monotonic()
+      batch, waiting = [], deque()
+      while self.pending:
+        entry = self.pending.popleft()
+        if entry[0] <= now and len(batch) < self.batch_size:
+          batch.append(entry)
+        else:
+          waiting.append(entry)
+      self.pending = waiting
+      return batch
+
+  def publish(self, batch):
+    entries = [{
+      'Id': str(n),
+      'Message': str(job_message(item)),
+      'MessageGroupId': 'annotations_jobs',
+      'MessageDeduplicationId': item['job_id']
+    } for n, (_ready, _attempts, item) in enumerate(batch)]
+    try:
+      response = self.sns.publish_batch(TopicArn=self.topic_arn,
+        PublishBatchRequestEntries=entries)
+      failed = {int(f['Id']) for f in response.get('Failed', [])}
+    except ClientError as e:
+      logger.error(f"Couldn't publish job requests: {e}")
+      failed = set(range(len(batch)))
+
+    for n, (_ready, attempts, item) in enumerate(batch):
+      if n in failed:
+        self.retry(item, attempts + 1)
+      else:
+        self.mark_published(item['job_id'])
+
+  def retry(self, item, attempts):
+    if attempts >= self.max_attempts:
+      # Left marked; the sweep picks it up again later
+      logger.error(f"Giving up publishing job {item['job_id']} for now")
+      return
+    self.enqueue(item, attempts=attempts, delay=min(2 ** attempts, 60))
+
+  def mark_published(self, job_id):
+    try:
+      self.table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='REMOVE outbox_status, outbox_claimed_until',
+        ConditionExpression='attribute_exists(job_id)')
+    except ClientError as e:
+      logger.error(f"Couldn't clear outbox marker of job {job_id}: {e}")
+
+  """Lease a marked job to this worker for claim_lease seconds; False if
+  it was published or another worker holds it
+  """
+  def claim(self, job_id):
+    now = int(time.time())
+    try:
+      self.table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression='SET outbox_claimed_until = :until',
+        ConditionExpression='outbox_status = :pending AND '
+          '(attribute_not_exists(outbox_claimed_until) OR outbox_claimed_until < :now)',
+        ExpressionAttributeValues={
+          ':until': now + self.claim_lease,
+          ':pending': OUTBOX_PENDING,
+          ':now': now
+        })
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+        return False
+      raise
+    return True
+
+  """Requeue marked jobs older than sweep_age (left by a dead worker)
+  once this worker has claimed them
+  """
+  def sweep(self):
+    cutoff = int(time.time()) - self.sweep_age
+    with self.wakeup:
+      queued = {item['job_id'] for _r, _a, item in self.pending}
+    kwargs = {
+      'IndexName': 'outbox_index',
+      'KeyConditionExpression':
+        Key('outbox_status').eq(OUTBOX_PENDING) & Key('submit_time').lt(cutoff)
+    }
+    while True:
+      response = self.table.query(**kwargs)
+      for item in response.get('Items', []):
+        if item['job_id'] not in queued and self.claim(item['job_id']):
+          self.enqueue(item)
+      if 'LastEvaluatedKey' not in response:
+        break
+      kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+  def run(self):
+    while True:
+      try:
+        if time.monotonic() - self.last_sweep >= self.sweep_interval:
+          self.last_sweep = time.monotonic()
+          self.sweep()
+        batch = self.take_batch()
+        if batch:
+          self.publish(batch)
+      except Exception as e:
+        logger.error(f"Outbox dispatcher error: {e}")
+        time.sleep(1)
+
+### EOF
@@ -0,0 +1,107 @@
+# profiles.py
+#
+# Short-lived in-process cache of user profiles from the accounts database
+#
+# Every worker process has its own cache. A profile write drops the
+# cached copy in the writing process and, once committed, is announced
+# on the profile events topic, which each worker's notification queue
+# is subscribed to (see events.py), so the others drop theirs too.
+#
+##
+
+import json
+import uuid
+
+from botocore.exceptions import ClientError
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+import aws
+from gas import app, db
+from cache import TTLCache
+from jobs import job_events, job_events_listener
+from models import Profile
+
+import logging
+logger = logging.getLogger(__name__)
+
+PROFILE_UPDATED = 'profile_updated'
+
+# identity_id -> plain dict snapshot of the profile (never ORM instances,
+# which are bound to the request's database session)
+profile_cache = TTLCache(ttl=app.config['PROFILE_CACHE_TTL'])
+
+sns = aws.client('sns', region_name=app.config['AWS_REGION_NAME'])
+
+"""Get a snapshot of a user's profile, querying RDS only on a cache miss
+(or always, with refresh=True). Returns None if the user has no profile
+yet.
+"""
+def get_cached_profile(identity_id, refresh=False):
+  if not identity_id:
+    return None
+  job_events_listener.ensure_started()
+  if refresh:
+    invalidate_profile(identity_id)
+  return profile_cache.get_or_load(str(identity_id),
+    lambda: load_profile(identity_id))
+
+def load_profile(identity_id):
+  profile = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+  if not profile:
+    return None
+  return {
+    'identity_id': str(profile.identity_id),
+    'name': profile.name,
+    'email': profile.email,
+    'institution': profile.institution,
+    'role': profile.role
+  }
+
+def invalidate_profile(identity_id):
+  profile_cache.invalidate(str(identity_id))
+
+"""Tell the other web workers to drop their copies of a profile"""
+def publish_profile_event(identity_id):
+  try:
+    sns.publish(
+      TopicArn=app.config['AWS_SNS_PROFILE_EVENTS_TOPIC'],
+      Message=json.dumps({'identity_id': identity_id, 'event': PROFILE_UPDATED}),
+      MessageGroupId=identity_id,
+      MessageDeduplicationId=str(uuid.uuid4()))
+  except ClientError as e:
+    logger.error(f"Couldn't publish profile event for {identity_id}: {e}")
+
+"""EventBus subscriber: drop profiles other workers announce as changed"""
+def on_profile_event(topic, data):
+  if isinstance(data, dict) and data.get('event') == PROFILE_UPDATED:
+    invalidate_profile(data['identity_id'])
+
+job_events.subscribe(on_profile_event)
+
+"""Drop the cached copy whenever a profile row is written
+Covers auth.create_profile/update_profile (and so /subscribe and
+/unsubscribe) without touching auth.py. The change is announced to the
+other workers only after the commit, so they can't reload the old row.
+"""
+@event.listens_for(Profile, 'after_insert')
+@event.listens_for(Profile, 'after_update')
+@event.listens_for(Profile, 'after_delete')
+def on_profile_write(mapper, connection, target):
+  invalidate_profile(target.identity_id)
+  session = object_session(target)
+  if session is not None:
+    session.info.setdefault('changed_profiles', set()).add(str(target.identity_id))
+
+@event.listens_for(Session, 'after_commit')
+def on_commit(session):
+  for identity_id in session.info.pop('changed_profiles', ()):
+    # Again, in case this process read the row before the commit
+    invalidate_profile(identity_id)
+    publish_profile_event(identity_id)
+
+@event.listens_for(Session, 'after_rollback')
+def on_rollback(session):
+  session.info.pop('changed_profiles', None)
+
+### EOF
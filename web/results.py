@@ -0,0 +1,98 @@
+# results.py
+#
+# Streamed and ranged reads of annotation result objects in S3
+#
+##
+
+import codecs
+
+"""Fetch an object, optionally only its last tail_bytes bytes
+Returns (S3 response, truncated) where truncated is True if the
+response does not start at the beginning of the object; a truncated
+response also holds the byte before the tail, for iter_text to tell
+whether the tail starts a line. Issued before a streaming response
+starts, so S3 errors still surface as error pages.
+"""
+def open_object(s3, bucket, key, tail_bytes=None):
+  if not tail_bytes:
+    return s3.get_object(Bucket=bucket, Key=key), False
+
+  response = s3.get_object(Bucket=bucket, Key=key,
+    Range=f"bytes=-{int(tail_bytes) + 1}")
+  # Content-Range: bytes <first>-<last>/<total>; absent if S3 ignored the range
+  content_range = response.get('ContentRange', '')
+  truncated = bool(content_range) and \
+    not content_range.split(' ')[-1].startswith('0-')
+  return response, truncated
+
+"""Yield an S3 response body as text, chunk by chunk
+Decodes UTF-8 incrementally so multi-byte characters split across
+chunks survive. With skip_partial_line (a truncated open_object
+response), the first byte is the one before the tail: it is dropped,
+and so is the partial first line, unless that byte ends a line.
+"""
+def iter_text(response, chunk_size=65536, skip_partial_line=False):
+  decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+  body = response['Body']
+  preceding = None
+  try:
+    for chunk in body.iter_chunks(chunk_size=chunk_size):
+      if skip_partial_line:
+        if preceding is None and chunk:
+          preceding, chunk = chunk[:1], chunk[1:]
+          if preceding == b'\n':
+            skip_partial_line = False
+        if skip_partial_line:
+          if b'\n' not in chunk:
+            continue
+          chunk = chunk.split(b'\n', 1)[1]
+          skip_partial_line = False
+      text = decoder.decode(chunk)
+      if text:
+        yield text
+    text = decoder.decode(b'', final=True)
+    if text and not skip_partial_line:
+      yield text
+  finally:
+    body.close()
+
+"""Read one page of a line-oriented object (e.g. a VCF) with a ranged GET
+Reads about page_bytes bytes starting at byte offset and ends the page
+on the last complete line. If offset falls mid-line, the page starts
+with the next line. Returns a dict with the page's lines and byte range,
+the object size and next_offset (None on the last page).
+"""
+def read_page(s3, bucket, key, offset=0, page_bytes=65536):
+  # Read one byte before offset to learn whether it starts a line
+  start = max(offset - 1, 0)
+  end = offset + page_bytes - 1
+  response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+  data = response['Body'].read()
+  # Content-Range: bytes <first>-<last>/<total>
+  total = int(response['ContentRange'].split('/')[-1])
+
+  if offset > 0:
+    aligned = data[:1] == b'\n'
+    data = data[1:]
+    if not aligned:
+      skip = data.find(b'\n') + 1
+      if skip == 0:
+        skip = len(data)
+      offset += skip
+      data = data[skip:]
+
+  if offset + len(data) < total:
+    cut = data.rfind(b'\n') + 1
+    if cut > 0:
+      data = data[:cut]
+
+  next_offset = offset + len(data)
+  lines = data.decode('utf-8', errors='replace').splitlines()
+  return {
+    'lines': lines,
+    'offset': offset,
+    'next_offset': next_offset if next_offset < total else None,
+    'size': total
+  }
+
+### EOF
@@ -18,7 +18,11 @@ fi
 /home/ec2-user/mpcs-cc/bin/gunicorn \
   --log-file=$LOG_TARGET \
   --log-level=debug \
+  --preload \
+  --config=gunicorn_conf.py \
   --workers=$GUNICORN_WORKERS \
+  --worker-class=gthread \
+  --threads=${GUNICORN_THREADS:-16} \
   --certfile=$SSL_CERT_PATH \
   --keyfile=$SSL_KEY_PATH \
   --bind=$GAS_APP_HOST:$GAS_HOST_PORT gas:app
@@ -0,0 +1,13 @@
+# conftest.py
+#
+# Tests for the GAS web app modules that don't need the Flask app, AWS
+# or the accounts database; AWS services are replaced by local fakes
+#
+##
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### EOF
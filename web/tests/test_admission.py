@@ -0,0 +1,87 @@
+from botocore.exceptions import ClientError
+
+from admission import AdmissionController
+
+QUOTAS = {'free_user': (1.0, 3), 'premium_user': (10.0, 100)}
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class FakeTable(object):
+  def __init__(self):
+    self.items = {}
+    self.puts = 0
+    self.before_put = None
+
+  def get_item(self, Key, ConsistentRead):
+    item = self.items.get(Key['bucket_key'])
+    return {'Item': dict(item)} if item else {}
+
+  def put_item(self, Item, ConditionExpression, ExpressionAttributeValues=None):
+    if self.before_put:
+      before_put, self.before_put = self.before_put, None
+      before_put()
+    current = self.items.get(Item['bucket_key'])
+    if ConditionExpression == 'attribute_not_exists(bucket_key)':
+      ok = current is None
+    else:
+      ok = current is not None and current['version'] == ExpressionAttributeValues[':version']
+    if not ok:
+      raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'PutItem')
+    self.puts += 1
+    self.items[Item['bucket_key']] = dict(Item)
+
+def controllers(n=1):
+  table = FakeTable()
+  clock = FakeClock()
+  return [AdmissionController(QUOTAS, table, clock=clock) for _ in range(n)], table, clock
+
+def test_bucket_is_shared_by_all_controllers():
+  (first, second), table, clock = controllers(2)
+  assert first.admit('user', 'free_user', 2) == (True, 0)
+  assert second.admit('user', 'free_user') == (True, 0)
+  admitted, retry_after = first.admit('user', 'free_user')
+  assert not admitted
+  assert retry_after == 1.0
+
+def test_bucket_refills_over_time():
+  (controller,), table, clock = controllers()
+  controller.admit('user', 'free_user', 3)
+  clock.now += 2
+  assert controller.admit('user', 'free_user', 2) == (True, 0)
+  assert not controller.admit('user', 'free_user')[0]
+
+def test_request_over_burst_is_never_admitted():
+  (controller,), table, clock = controllers()
+  assert controller.admit('user', 'free_user', 4) == (False, None)
+  assert table.puts == 0
+
+def test_burst_is_per_role_with_free_default():
+  (controller,), table, clock = controllers()
+  assert controller.burst('premium_user') == 100
+  assert controller.burst('unknown') == 3
+
+def test_refund_gives_tokens_back():
+  (controller,), table, clock = controllers()
+  controller.admit('user', 'free_user', 3)
+  controller.refund('user', 'free_user', 2)
+  assert controller.admit('user', 'free_user', 2) == (True, 0)
+  assert controller.counters()['jobs']['free_user'] == {'admitted': 5, 'rejected': 0, 'refunded': 2}
+
+def test_concurrent_write_is_retried():
+  (first, second), table, clock = controllers(2)
+  first.admit('user', 'free_user')
+  # Another worker takes a token between this one's read and write
+  table.before_put = lambda: second.admit('user', 'free_user')
+  assert first.admit('user', 'free_user') == (True, 0)
+  assert not second.admit('user', 'free_user')[0]
+
+def test_roles_have_separate_buckets():
+  (controller,), table, clock = controllers()
+  controller.admit('user', 'free_user', 3)
+  assert controller.admit('user', 'premium_user', 50) == (True, 0)
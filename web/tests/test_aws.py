@@ -0,0 +1,34 @@
+import os
+
+from aws import ProcessLocal
+
+
+class FakeClient(object):
+  def __init__(self, n):
+    self.n = n
+
+  def name(self):
+    return f"client {self.n}"
+
+def counting_factory():
+  made = []
+  def factory():
+    made.append(FakeClient(len(made)))
+    return made[-1]
+  return factory, made
+
+def test_process_local_is_created_on_first_use():
+  factory, made = counting_factory()
+  client = ProcessLocal(factory)
+  assert made == []
+  assert client.name() == 'client 0'
+  assert client.name() == 'client 0'
+  assert len(made) == 1
+
+def test_process_local_is_created_again_after_a_fork(monkeypatch):
+  factory, made = counting_factory()
+  client = ProcessLocal(factory)
+  client.name()
+  monkeypatch.setattr(os, 'getpid', lambda: -1)
+  assert client.name() == 'client 1'
+  assert client.get() is made[1]
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from threading import Lock
+
+import pytest
+from botocore.exceptions import ClientError
+
+from credentials import SecretCache
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+class FakeSecretsManager(object):
+  def __init__(self, secrets):
+    self.secrets = secrets
+    self.calls = []
+    self.lock = Lock()
+    self.failing = False
+    self.barrier = None
+
+  def get_secret_value(self, SecretId):
+    with self.lock:
+      self.calls.append(SecretId)
+    if self.barrier:
+      self.barrier.wait(timeout=5)
+    if self.failing:
+      raise ClientError({'Error': {'Code': 'InternalServiceError'}}, 'GetSecretValue')
+    return {'SecretString': json.dumps(self.secrets[SecretId])}
+
+def secret_cache(secrets, **kwargs):
+  client = FakeSecretsManager(secrets)
+  clock = FakeClock()
+  return SecretCache(ttl=100, client=client, clock=clock, **kwargs), client, clock
+
+def wait_for_refresh(cache):
+  deadline = time.monotonic() + 5
+  while cache.refreshing and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert not cache.refreshing
+
+def test_get_caches_the_secret():
+  cache, client, clock = secret_cache({'a': {'key': 1}})
+  assert cache.get('a') == {'key': 1}
+  clock.now = 50
+  assert cache.get('a') == {'key': 1}
+  assert client.calls == ['a']
+
+def test_get_refreshes_ahead_in_the_background():
+  cache, client, clock = secret_cache({'a': {'key': 1}})
+  cache.get('a')
+  client.secrets['a'] = {'key': 2}
+  clock.now = 80
+  # The cached value is served while the refresh runs
+  assert cache.get('a') == {'key': 1}
+  wait_for_refresh(cache)
+  assert cache.get('a') == {'key': 2}
+  assert client.calls == ['a', 'a']
+
+def test_get_refetches_an_expired_secret():
+  cache, client, clock = secret_cache({'a': {'key': 1}})
+  cache.get('a')
+  client.secrets['a'] = {'key': 2}
+  clock.now = 100
+  assert cache.get('a') == {'key': 2}
+
+def test_failed_refresh_keeps_the_cached_secret():
+  cache, client, clock = secret_cache({'a': {'key': 1}})
+  cache.get('a')
+  client.failing = True
+  clock.now = 80
+  assert cache.get('a') == {'key': 1}
+  wait_for_refresh(cache)
+  assert cache.get('a') == {'key': 1}
+
+def test_expired_secret_fetch_failure_raises():
+  cache, client, clock = secret_cache({'a': {'key': 1}})
+  cache.get('a')
+  client.failing = True
+  clock.now = 100
+  with pytest.raises(ClientError):
+    cache.get('a')
+
+def test_load_fetches_secrets_concurrently():
+  cache, client, clock = secret_cache({'a': {'key': 1}, 'b': {'key': 2}, 'c': {'key': 3}})
+  # Every fetch waits for the others: a serial load would time out
+  client.barrier = threading.Barrier(3)
+  assert cache.load(['a', 'b', 'c']) == {'a': {'key': 1}, 'b': {'key': 2}, 'c': {'key': 3}}
+  client.barrier = None
+  assert cache.get('b') == {'key': 2}
+  assert sorted(client.calls) == ['a', 'b', 'c']
+
+def test_load_creates_one_client_before_fetching(monkeypatch):
+  import credentials
+  secrets_manager = FakeSecretsManager({'a': {'key': 1}, 'b': {'key': 2}})
+  created = []
+  def fake_client(service, region_name=None):
+    created.append(threading.current_thread().name)
+    return secrets_manager
+  monkeypatch.setattr(credentials.boto3, 'client', fake_client)
+
+  cache = SecretCache(region_name='us-east-1', ttl=100)
+  assert cache.load(['a', 'b']) == {'a': {'key': 1}, 'b': {'key': 2}}
+  assert created == [threading.current_thread().name]
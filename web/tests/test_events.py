@@ -0,0 +1,218 @@
+import json
+
+import events
+from cache import JobCache
+from events import EventBus, Poller, SqsEventListener, parse_notification
+
+TOPIC_ARN = 'arn:aws:sns:us-east-1:123:job_results.fifo'
+
+
+class FakeSqs(object):
+  def __init__(self):
+    self.queues = {}      # name -> {'attributes': {}, 'messages': []}
+
+  def url(self, name):
+    return f"https://sqs.us-east-1.amazonaws.com/123/{name}"
+
+  def name(self, queue_url):
+    return queue_url.rsplit('/', 1)[-1]
+
+  def create_queue(self, QueueName, Attributes=None, tags=None):
+    self.queues.setdefault(QueueName, {'attributes': dict(Attributes or {}),
+      'tags': dict(tags or {}), 'messages': []})
+    return {'QueueUrl': self.url(QueueName)}
+
+  def tag_queue(self, QueueUrl, Tags):
+    self.queues[self.name(QueueUrl)]['tags'].update(Tags)
+
+  def list_queue_tags(self, QueueUrl):
+    return {'Tags': dict(self.queues[self.name(QueueUrl)]['tags'])}
+
+  def get_queue_attributes(self, QueueUrl, AttributeNames):
+    return {'Attributes': {'QueueArn': f"arn:aws:sqs:us-east-1:123:{self.name(QueueUrl)}"}}
+
+  def set_queue_attributes(self, QueueUrl, Attributes):
+    self.queues[self.name(QueueUrl)]['attributes'].update(Attributes)
+
+  def list_queues(self, QueueNamePrefix, MaxResults=None):
+    return {'QueueUrls': [self.url(name) for name in self.queues
+      if name.startswith(QueueNamePrefix)]}
+
+  def delete_queue(self, QueueUrl):
+    del self.queues[self.name(QueueUrl)]
+
+  def deliver(self, queue_arn, body):
+    queue = self.queues.get(queue_arn.split(':')[-1])
+    if queue is not None:
+      queue['messages'].append(body)
+
+  def receive_message(self, QueueUrl, MaxNumberOfMessages, WaitTimeSeconds):
+    messages = self.queues[self.name(QueueUrl)]['messages']
+    taken = messages[:MaxNumberOfMessages]
+    del messages[:MaxNumberOfMessages]
+    return {'Messages': [{'Body': body, 'ReceiptHandle': str(i)}
+      for i, body in enumerate(taken)]}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+    return {'Successful': Entries}
+
+class FakeSns(object):
+  def __init__(self, sqs):
+    self.sqs = sqs
+    self.subscriptions = {}   # subscription ARN -> (topic ARN, queue ARN)
+
+  def subscribe(self, TopicArn, Protocol, Endpoint, ReturnSubscriptionArn):
+    arn = f"{TopicArn}:{len(self.subscriptions)}"
+    self.subscriptions[arn] = (TopicArn, Endpoint)
+    return {'SubscriptionArn': arn}
+
+  def unsubscribe(self, SubscriptionArn):
+    del self.subscriptions[SubscriptionArn]
+
+  def list_subscriptions_by_topic(self, TopicArn):
+    return {'Subscriptions': [{'SubscriptionArn': arn, 'Endpoint': endpoint}
+      for arn, (topic, endpoint) in self.subscriptions.items() if topic == TopicArn]}
+
+  def publish(self, TopicArn, Message):
+    body = json.dumps({'Type': 'Notification', 'TopicArn': TopicArn, 'Message': Message})
+    for topic, endpoint in list(self.subscriptions.values()):
+      if topic == TopicArn:
+        self.sqs.deliver(endpoint, body)
+
+class FakeTable(object):
+  def __init__(self, items):
+    self.items = items
+    self.reads = 0
+
+  def get_item(self, Key, **kwargs):
+    self.reads += 1
+    return {'Item': dict(self.items[Key['job_id']])}
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 100000.0
+
+  def __call__(self):
+    return self.now
+
+def listener(sqs, sns, bus=None, clock=None):
+  listener = SqsEventListener(bus or EventBus(), sqs, sns, [TOPIC_ARN], 'gas_events',
+    clock=clock or FakeClock())
+  listener.open()
+  return listener
+
+def test_every_listener_gets_every_notification():
+  sqs = FakeSqs()
+  sns = FakeSns(sqs)
+  table = FakeTable({'job-1': {'job_id': 'job-1', 'job_status': 'COMPLETED'}})
+  caches = [JobCache(table), JobCache(table)]
+  listeners = []
+  for cache in caches:
+    bus = EventBus()
+    bus.subscribe(cache.on_event)
+    listeners.append(listener(sqs, sns, bus))
+    cache.get('job-1')
+  assert table.reads == 2
+
+  table.items['job-1']['job_status'] = 'ARCHIVED'
+  sns.publish(TOPIC_ARN, json.dumps({'job_id': 'job-1', 'event': 'archived'}))
+  assert [l.poll_once() for l in listeners] == [1, 1]
+
+  assert [cache.get('job-1')['job_status'] for cache in caches] == ['ARCHIVED', 'ARCHIVED']
+  assert table.reads == 4
+
+def test_listener_queue_is_fifo_for_fifo_topics():
+  sqs = FakeSqs()
+  l = listener(sqs, FakeSns(sqs))
+  name = sqs.name(l.queue_url)
+  assert name.endswith('.fifo')
+  assert sqs.queues[name]['attributes']['FifoQueue'] == 'true'
+  assert TOPIC_ARN in sqs.queues[name]['attributes']['Policy']
+
+def test_close_unsubscribes_and_deletes_the_queue():
+  sqs = FakeSqs()
+  sns = FakeSns(sqs)
+  l = listener(sqs, sns)
+  l.close()
+  assert sqs.queues == {}
+  assert sns.subscriptions == {}
+  l.close()
+
+def test_sweep_removes_queues_of_dead_processes(monkeypatch):
+  sqs = FakeSqs()
+  sns = FakeSns(sqs)
+  live = listener(sqs, sns)
+  dead = listener(sqs, sns)
+  dead_name = sqs.name(dead.queue_url).replace(f"-{events.os.getpid()}-", '-99999999-')
+  sqs.queues[dead_name] = sqs.queues.pop(sqs.name(dead.queue_url))
+  sns.subscriptions[dead.subscription_arns[0]] = (TOPIC_ARN,
+    f"arn:aws:sqs:us-east-1:123:{dead_name}")
+  monkeypatch.setattr(events, 'process_exists', lambda pid: pid != 99999999)
+
+  live.sweep()
+  assert list(sqs.queues) == [sqs.name(live.queue_url)]
+  assert list(sns.subscriptions) == live.subscription_arns
+
+def test_sweep_removes_queues_not_seen_lately_from_any_host():
+  sqs = FakeSqs()
+  sns = FakeSns(sqs)
+  clock = FakeClock()
+  live = listener(sqs, sns, clock=clock)
+  other = listener(sqs, sns, clock=clock)
+  gone = listener(sqs, sns, clock=clock)
+  # Queues of listeners on other (e.g. terminated) instances
+  for l, host in ((other, 'other-host'), (gone, 'gone-host')):
+    name = sqs.name(l.queue_url).replace(live.host_prefix(), f"gas_events-{host}-")
+    sqs.queues[name] = sqs.queues.pop(sqs.name(l.queue_url))
+    sns.subscriptions[l.subscription_arns[0]] = (TOPIC_ARN, f"arn:aws:sqs:us-east-1:123:{name}")
+    l.queue_url = sqs.url(name)
+
+  clock.now += 500
+  other.touch()
+  live.touch()
+  clock.now += 200
+  live.sweep()
+  assert sorted(sqs.queues) == sorted([sqs.name(live.queue_url), sqs.name(other.queue_url)])
+  assert sorted(sns.subscriptions) == sorted(live.subscription_arns + other.subscription_arns)
+
+def test_failing_subscriber_does_not_stop_delivery():
+  bus = EventBus()
+  received = []
+  def fail(topic, data):
+    raise ValueError('boom')
+  bus.subscribe(fail)
+  bus.subscribe(lambda topic, data: received.append((topic, data)))
+  bus.publish('job_results', {'job_id': 'job-1'})
+  assert received == [('job_results', {'job_id': 'job-1'})]
+
+def test_parse_notification_accepts_json_and_dict_repr():
+  for message in (json.dumps({'job_id': 'job-1'}), str({'job_id': 'job-1'})):
+    body = json.dumps({'TopicArn': TOPIC_ARN, 'Message': message})
+    assert parse_notification(body) == ('job_results.fifo', {'job_id': 'job-1'})
+
+def test_poller_reads_all_watched_keys_in_one_load():
+  loads = []
+  def load(keys):
+    loads.append(sorted(keys))
+    return {key: {'job_id': key, 'job_status': 'COMPLETED'} for key in keys}
+  poller = Poller(load, interval=3600)
+  first, second = [], []
+  poller.watch(['job-1', 'job-2'], lambda topic, item: first.append(item['job_id']))
+  poller.watch(['job-2', 'job-3'], lambda topic, item: second.append(item['job_id']))
+
+  assert poller.poll_once() == 3
+  assert loads == [['job-1', 'job-2', 'job-3']]
+  assert sorted(first) == ['job-1', 'job-2']
+  assert sorted(second) == ['job-2', 'job-3']
+
+def test_poller_stops_reading_unwatched_keys():
+  loads = []
+  poller = Poller(lambda keys: loads.append(sorted(keys)) or {}, interval=3600)
+  def callback(topic, item):
+    pass
+  poller.watch(['job-1', 'job-2'], callback)
+  poller.unwatch(['job-1'], callback)
+  poller.poll_once()
+  poller.unwatch(['job-2'], callback)
+  assert poller.poll_once() == 0
+  assert loads == [['job-2']]
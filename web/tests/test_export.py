@@ -0,0 +1,89 @@
+import io
+import zipfile
+
+from botocore.exceptions import ClientError
+
+from export import export_entries, zip_stream
+
+
+class FakeBody(object):
+  def __init__(self, data):
+    self.data = data
+    self.closed = False
+
+  def iter_chunks(self, chunk_size):
+    return (self.data[i:i + chunk_size] for i in range(0, len(self.data), chunk_size))
+
+  def close(self):
+    self.closed = True
+
+class FakeS3(object):
+  def __init__(self, objects):
+    self.objects = objects
+
+  def get_object(self, Bucket, Key):
+    if Key not in self.objects:
+      raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    return {'Body': FakeBody(self.objects[Key])}
+
+def job(job_id, status='COMPLETED', **attributes):
+  return dict({
+    'job_id': job_id,
+    'job_status': status,
+    'submit_time': 1700000000,
+    's3_key_result_file': f"prefix/u1/{job_id}~sample.annot.vcf",
+    's3_key_log_file': f"prefix/u1/{job_id}~sample.vcf.count.log"
+  }, **attributes)
+
+def export(objects, entries, skipped=(), **kwargs):
+  data = b''.join(zip_stream(FakeS3(objects), 'bucket', entries, skipped, **kwargs))
+  return zipfile.ZipFile(io.BytesIO(data))
+
+def test_entries_cover_completed_jobs_in_s3():
+  entries, skipped = export_entries([
+    job('j2', submit_time=2),
+    job('j1', submit_time=1),
+    job('running', status='RUNNING'),
+  ])
+  assert [name for name, _key, _modified in entries] == [
+    'j1/sample.vcf.count.log', 'j1/sample.annot.vcf',
+    'j2/sample.vcf.count.log', 'j2/sample.annot.vcf']
+  assert skipped == []
+
+def test_archived_results_are_skipped_but_restored_ones_included():
+  entries, skipped = export_entries([
+    job('archived', results_file_archive_id='a1'),
+    job('restoring', results_file_archive_id='a2', restore_message='Restoring'),
+    job('restored', results_file_archive_id='a3', restore_message=''),
+  ])
+  assert [name for name, _key, _modified in entries] == [
+    'archived/sample.vcf.count.log',
+    'restoring/sample.vcf.count.log',
+    'restored/sample.vcf.count.log', 'restored/sample.annot.vcf']
+  assert skipped == [('archived', 'archived'),
+    ('restoring', 'being restored from the archive')]
+
+def test_zip_holds_every_object_and_a_manifest():
+  objects = {
+    'k1': b'result one\n' * 100,
+    'k2': b'',
+    'k3': b'result three\n',
+  }
+  entries = [('j1/a.vcf', 'k1', 1700000000), ('j2/b.vcf', 'k2', 1700000000),
+    ('j3/c.vcf', 'k3', 1700000000)]
+  archive = export(objects, entries, chunk_size=7, queue_chunks=1, concurrency=2)
+
+  assert archive.read('j1/a.vcf') == objects['k1']
+  assert archive.read('j2/b.vcf') == b''
+  assert archive.read('j3/c.vcf') == objects['k3']
+  assert archive.read('MANIFEST.txt').decode().splitlines() == [
+    'GAS annotations export, 3 files', '', 'j1/a.vcf', 'j2/b.vcf', 'j3/c.vcf']
+
+def test_missing_objects_are_left_out_and_listed_in_the_manifest():
+  entries = [('j1/a.vcf', 'k1', 1700000000), ('j2/b.vcf', 'gone', 1700000000)]
+  archive = export({'k1': b'data'}, entries, skipped=[('j3', 'archived')])
+
+  assert archive.namelist() == ['j1/a.vcf', 'MANIFEST.txt']
+  assert archive.read('MANIFEST.txt').decode().splitlines() == [
+    'GAS annotations export, 1 files', '', 'j1/a.vcf', '',
+    'Not included:', 'j3: results archived', 'j2/b.vcf: could not be read']
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+from flask import Flask
+from sqlalchemy import create_engine, text
+
+import metrics
+from metrics import LatencyHistogram, Metrics, init_app
+
+
+@pytest.fixture(autouse=True)
+def fresh_metrics(monkeypatch):
+  monkeypatch.setattr(metrics, 'metrics', Metrics())
+
+
+class FakeRawResponse(object):
+  def __init__(self, body):
+    self.body = body
+
+  def stream(self, **kwargs):
+    yield self.body
+
+
+# botocore's Stubber answers in before-call, ahead of the metrics hook,
+# so the fake answers at the HTTP layer instead
+def stubbed_sqs(status=200, body=b'{"QueueUrls": []}'):
+  sqs = boto3.client('sqs', region_name='us-east-1',
+    aws_access_key_id='test', aws_secret_access_key='test')
+  sqs.meta.events.register('before-send.sqs', lambda request, **kwargs:
+    AWSResponse(request.url, status, {'Content-Type': 'application/x-amz-json-1.0'},
+      FakeRawResponse(body)))
+  return sqs
+
+
+def timed_app(server_timing=True):
+  app = Flask(__name__)
+  app.config['METRICS_SERVER_TIMING'] = server_timing
+  init_app(app)
+
+  @app.route('/queues')
+  def queues():
+    stubbed_sqs().list_queues()
+    return 'ok'
+
+  return app
+
+
+def test_histogram_buckets():
+  histogram = LatencyHistogram(buckets=(10, 100))
+  for ms in (5, 50, 500):
+    histogram.observe(ms, error=ms > 100)
+  snapshot = histogram.snapshot()
+  assert snapshot['buckets_ms'] == {'le_10': 1, 'le_100': 1, 'inf': 1}
+  assert snapshot['count'] == 3 and snapshot['errors'] == 1
+  assert snapshot['max_ms'] == 500
+
+
+def test_snapshot_names_its_worker():
+  worker = metrics.metrics.snapshot()['worker']
+  assert worker['pid'] == os.getpid()
+  assert worker['host']
+
+
+def test_aws_calls_are_timed():
+  stubbed_sqs().list_queues()
+  snapshot = metrics.metrics.snapshot()
+  assert snapshot['aws']['sqs.ListQueues']['count'] == 1
+  assert snapshot['aws']['sqs.ListQueues']['errors'] == 0
+
+
+def test_failed_aws_calls_are_errors():
+  sqs = stubbed_sqs(status=400,
+    body=b'{"__type": "com.amazonaws.sqs#InvalidAddress", "message": "no"}')
+  with pytest.raises(ClientError):
+    sqs.list_queues()
+  assert metrics.metrics.snapshot()['aws']['sqs.ListQueues']['errors'] == 1
+
+
+def test_db_queries_are_timed():
+  engine = create_engine('sqlite://')
+  with engine.connect() as connection:
+    connection.execute(text('SELECT 1'))
+  assert metrics.metrics.snapshot()['db']['SELECT']['count'] == 1
+
+
+def test_request_tallies_aws_time_in_server_timing():
+  response = timed_app().test_client().get('/queues')
+  header = response.headers['Server-Timing']
+  assert header.startswith('app;dur=')
+  assert 'aws;dur=' in header and 'desc="1 calls"' in header
+  assert 'desc="0 queries"' in header
+
+  route = metrics.metrics.snapshot()['routes']['GET /queues']
+  assert route['count'] == 1
+  assert route['aws_calls'] == 1
+
+
+def test_server_timing_is_optional():
+  response = timed_app(server_timing=False).test_client().get('/queues')
+  assert 'Server-Timing' not in response.headers
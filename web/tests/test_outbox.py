@@ -0,0 +1,154 @@
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from outbox import OUTBOX_PENDING, OutboxDispatcher, job_message, with_outbox_marker
+
+TOPIC_ARN = 'arn:aws:sns:us-east-1:123:job_requests.fifo'
+
+
+def conditional_check_failed():
+  return ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+
+
+class FakeTable(object):
+  def __init__(self, items=()):
+    self.items = {item['job_id']: dict(item) for item in items}
+
+  def update_item(self, Key, UpdateExpression, ConditionExpression,
+    ExpressionAttributeValues=None):
+    item = self.items.get(Key['job_id'])
+    if UpdateExpression.startswith('REMOVE'):
+      if item is None:
+        raise conditional_check_failed()
+      item.pop('outbox_status', None)
+      item.pop('outbox_claimed_until', None)
+      return
+    values = ExpressionAttributeValues
+    if (item is None or item.get('outbox_status') != values[':pending']
+      or item.get('outbox_claimed_until', values[':now'] - 1) >= values[':now']):
+      raise conditional_check_failed()
+    item['outbox_claimed_until'] = values[':until']
+
+  def query(self, IndexName, KeyConditionExpression, ExclusiveStartKey=None):
+    cutoff = KeyConditionExpression.get_expression()['values'][1] \
+      .get_expression()['values'][1]
+    return {'Items': [dict(item) for item in self.items.values()
+      if item.get('outbox_status') == OUTBOX_PENDING and item['submit_time'] < cutoff]}
+
+
+class FakeSns(object):
+  def __init__(self, fail=()):
+    self.fail = set(fail)
+    self.published = []
+    self.batches = []
+
+  def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+    self.batches.append(len(PublishBatchRequestEntries))
+    failed = []
+    for entry in PublishBatchRequestEntries:
+      if entry['MessageDeduplicationId'] in self.fail:
+        failed.append({'Id': entry['Id'], 'Code': 'InternalError'})
+      else:
+        self.published.append(entry['MessageDeduplicationId'])
+    return {'Successful': [], 'Failed': failed}
+
+
+def job(job_id, submit_time=None):
+  return with_outbox_marker({'job_id': job_id, 'user_id': 'u1',
+    'submit_time': int(time.time()) if submit_time is None else submit_time})
+
+
+def dispatcher(table, sns, **kwargs):
+  outbox = OutboxDispatcher(table, sns, TOPIC_ARN, **kwargs)
+  outbox.pid = os.getpid()      # as if started; the tests drive it
+  return outbox
+
+
+def test_job_message_drops_outbox_attributes():
+  item = dict(job('j1', 100), outbox_claimed_until=200)
+  assert job_message(item) == {'job_id': 'j1', 'user_id': 'u1', 'submit_time': 100}
+
+
+def test_enqueued_jobs_are_published_and_unmarked():
+  table = FakeTable([job('j1'), job('j2')])
+  sns = FakeSns()
+  outbox = dispatcher(table, sns)
+  outbox.enqueue(table.items['j1'])
+  outbox.enqueue(table.items['j2'])
+
+  outbox.publish(outbox.take_batch())
+
+  assert sns.published == ['j1', 'j2']
+  assert 'outbox_status' not in table.items['j1']
+  assert 'outbox_status' not in table.items['j2']
+  assert not outbox.pending
+
+
+def test_bulk_submissions_are_published_ten_per_request():
+  table = FakeTable([job(f"j{n:02}") for n in range(25)])
+  sns = FakeSns()
+  outbox = dispatcher(table, sns, batch_size=25)
+  for job_id in sorted(table.items):
+    outbox.enqueue(table.items[job_id])
+
+  while outbox.pending:
+    outbox.publish(outbox.take_batch())
+
+  assert sns.batches == [10, 10, 5]
+  assert sns.published == sorted(table.items)
+  assert not any('outbox_status' in item for item in table.items.values())
+
+
+def test_failed_publish_is_retried_with_backoff():
+  table = FakeTable([job('j1'), job('j2')])
+  sns = FakeSns(fail={'j2'})
+  outbox = dispatcher(table, sns)
+  outbox.enqueue(table.items['j1'])
+  outbox.enqueue(table.items['j2'])
+
+  outbox.publish(outbox.take_batch())
+
+  assert sns.published == ['j1']
+  assert table.items['j2']['outbox_status'] == OUTBOX_PENDING
+  [(ready_at, attempts, item)] = outbox.pending
+  assert attempts == 1 and item['job_id'] == 'j2'
+  assert ready_at > time.monotonic()
+
+
+def test_retry_gives_up_after_max_attempts():
+  table = FakeTable([job('j1')])
+  outbox = dispatcher(table, FakeSns(), max_attempts=3)
+  outbox.retry(table.items['j1'], 3)
+  assert not outbox.pending
+  assert table.items['j1']['outbox_status'] == OUTBOX_PENDING
+
+
+def test_mark_published_ignores_deleted_jobs():
+  table = FakeTable([job('j1')])
+  outbox = dispatcher(table, FakeSns())
+  outbox.mark_published('gone')
+  outbox.mark_published('j1')
+  assert 'outbox_status' not in table.items['j1']
+
+
+def test_sweep_requeues_old_marked_jobs_once_across_workers():
+  old = int(time.time()) - 600
+  table = FakeTable([job('old', old), job('new')])
+  first = dispatcher(table, FakeSns(), sweep_age=60)
+  second = dispatcher(table, FakeSns(), sweep_age=60)
+
+  first.sweep()
+  second.sweep()
+
+  assert [item['job_id'] for _r, _a, item in first.pending] == ['old']
+  assert not second.pending
+  assert table.items['old']['outbox_claimed_until'] > time.time()
+
+
+def test_sweep_reclaims_expired_claims():
+  table = FakeTable([dict(job('old', 0), outbox_claimed_until=int(time.time()) - 1)])
+  outbox = dispatcher(table, FakeSns())
+  outbox.sweep()
+  assert [item['job_id'] for _r, _a, item in outbox.pending] == ['old']
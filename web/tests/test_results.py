@@ -0,0 +1,94 @@
+from results import iter_text, open_object, read_page
+
+
+class FakeBody(object):
+  def __init__(self, chunks):
+    self.chunks = chunks
+    self.closed = False
+
+  def iter_chunks(self, chunk_size):
+    return iter(self.chunks)
+
+  def read(self):
+    return b''.join(self.chunks)
+
+  def close(self):
+    self.closed = True
+
+class FakeS3(object):
+  def __init__(self, data):
+    self.data = data
+    self.ranges = []
+
+  def get_object(self, Bucket, Key, Range=None):
+    self.ranges.append(Range)
+    if Range is None:
+      return {'Body': FakeBody([self.data])}
+    first, last = Range[len('bytes='):].split('-')
+    if first:
+      start, end = int(first), min(int(last), len(self.data) - 1)
+    else:
+      start, end = max(len(self.data) - int(last), 0), len(self.data) - 1
+    return {
+      'Body': FakeBody([self.data[start:end + 1]]),
+      'ContentRange': f"bytes {start}-{end}/{len(self.data)}"
+    }
+
+def tail(data, tail_bytes, chunks=None):
+  response, truncated = open_object(FakeS3(data), 'bucket', 'key', tail_bytes)
+  if chunks:
+    body = response['Body'].chunks[0]
+    response['Body'] = FakeBody([body[i:i + chunks] for i in range(0, len(body), chunks)])
+  return ''.join(iter_text(response, skip_partial_line=truncated)), truncated
+
+def test_tail_starting_on_a_line_keeps_the_line():
+  assert tail(b'first\nsecond\nthird\n', 13) == ('second\nthird\n', True)
+
+def test_tail_starting_mid_line_drops_the_partial_line():
+  assert tail(b'first\nsecond\nthird\n', 10) == ('third\n', True)
+
+def test_tail_split_across_chunks():
+  assert tail(b'first\nsecond\nthird\n', 13, chunks=1) == ('second\nthird\n', True)
+  assert tail(b'first\nsecond\nthird\n', 10, chunks=3) == ('third\n', True)
+
+def test_tail_covering_the_whole_object():
+  assert tail(b'first\nsecond\n', 100) == ('first\nsecond\n', False)
+
+def test_multibyte_characters_split_across_chunks():
+  data = 'café\n'.encode()
+  response = {'Body': FakeBody([data[:4], data[4:]])}
+  assert ''.join(iter_text(response)) == 'café\n'
+
+VCF = b'##header\n#CHROM\tPOS\nchr1\t100\nchr1\t200\n'
+
+def test_page_ends_on_a_complete_line():
+  page = read_page(FakeS3(VCF), 'bucket', 'key', page_bytes=20)
+  assert page['lines'] == ['##header', '#CHROM\tPOS']
+  assert page['offset'] == 0
+  assert page['next_offset'] == len(b'##header\n#CHROM\tPOS\n')
+  assert page['size'] == len(VCF)
+
+def test_pages_cover_every_line_once():
+  s3 = FakeS3(VCF)
+  lines, offset = [], 0
+  while offset is not None:
+    page = read_page(s3, 'bucket', 'key', offset=offset, page_bytes=16)
+    lines += page['lines']
+    offset = page['next_offset']
+  assert lines == VCF.decode().splitlines()
+  assert s3.ranges[1] == 'bytes=8-24'    # one byte before the second page
+
+def test_page_starting_mid_line_skips_to_the_next_line():
+  page = read_page(FakeS3(VCF), 'bucket', 'key', offset=12, page_bytes=100)
+  assert page['lines'] == ['chr1\t100', 'chr1\t200']
+  assert page['offset'] == len(b'##header\n#CHROM\tPOS\n')
+  assert page['next_offset'] is None
+
+def test_line_longer_than_a_page_is_cut_and_the_next_page_skips_its_rest():
+  s3 = FakeS3(b'x' * 10 + b'\nnext\n')
+  page = read_page(s3, 'bucket', 'key', page_bytes=4)
+  assert page['lines'] == ['xxxx']
+  page = read_page(s3, 'bucket', 'key', offset=page['next_offset'], page_bytes=4)
+  assert page['lines'] == []
+  page = read_page(s3, 'bucket', 'key', offset=page['next_offset'], page_bytes=10)
+  assert page['lines'] == ['next']
@@ -8,27 +8,37 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import re
 import uuid
-import time
-import json
 from datetime import datetime
 
 import boto3
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Key, Attr
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template,
-  request, session, url_for)
+  request, session, url_for, jsonify, Response, stream_with_context)
 
 from gas import app, db
-from decorators import authenticated, is_premium
+# Before anything creates boto3 clients, so they carry the timing hooks
+from metrics import metrics, init_app as init_metrics
+from decorators import (authenticated, api_authenticated, is_premium, is_admin,
+  admission_controlled, admit_submission, refund_submission,
+  submission_admission, submission_burst)
 from auth import get_profile, update_profile
+from jobs import (get_job, job_status_stream, job_streams, new_job_item,
+  new_batch_id, submit_job, submit_jobs, duplicate_job_ids, JobExistsError,
+  JobsUnavailableError, find_input_by_digest, get_job_summary,
+  batch_get_jobs, list_jobs, iter_user_jobs, plain_item)
+from results import open_object, iter_text, read_page
+from export import export_entries, zip_stream
 
 import logging
 # Configure logging
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger(__name__)
+init_metrics(app)
 subscription_topic_arn = app.config['AWS_SNS_SUBSCRIPTION_UPGRADE_TOPIC']
 
 """Start annotation request
@@ -82,8 +92,11 @@ def annotate():
     app.logger.error(f"Unable to generate presigned URL for upload: {e}")
     return abort(500)
 
-  # Render the upload form which will parse/submit the presigned POST
-  return render_template('annotate.html', s3_post=presigned_post)
+  # Render the upload form which will parse/submit the presigned POST;
+  # files above the threshold go through the multipart upload instead
+  return render_template('annotate.html', s3_post=presigned_post,
+    multipart_threshold=app.config['MULTIPART_THRESHOLD'],
+    dedupe_max_bytes=app.config['DEDUPE_MAX_HASH_BYTES'])
 
 
 """Fires off an annotation job
@@ -96,79 +109,352 @@ homework assignments
 """
 @app.route('/annotate/job', methods=['GET'])
 @authenticated
+@admission_controlled()
 def create_annotation_job_request():
 
   # Get bucket name, key, and job ID from the S3 redirect URL
   bucket_name = str(request.args.get('bucket'))
   s3_key = str(request.args.get('key'))
 
-  # Extract the job ID from the S3 key
-  input_file = s3_key.split('/')[-1]
-  job_id = input_file.split('~')[0]
-
-  # Persist job to database
-  # Move your code here..
-  dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-  table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-  print(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-  submit_time = int(time.time())
   user_id = session['primary_identity']
   user_email = session['email']
 
-  data = {
-    "job_id": job_id,
-    "user_id": user_id,
-    "user_email": user_email, # new
-    "input_file_name": input_file,
-    "s3_inputs_bucket": bucket_name,
-    "s3_key_input_file": s3_key,
-    "submit_time": submit_time,
-    "job_status": "PENDING"
-  }
+  # Extract the job ID from the S3 key; the page adds the input's
+  # SHA-256 (if the browser could compute it) for upload dedupe
+  data = new_job_item(s3_key, bucket_name, user_id, user_email,
+    input_sha256=clean_sha256(request.args.get('sha256')))
+  job_id = data['job_id']
 
+  # Persist job to database; one write stores the job and its outbox
+  # marker, the outbox dispatcher publishes it to the annotator
   # error handling for put item to DynamoDB
   # https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Programming.Errors.html
   try:
-    response = table.put_item(Item=data)
-    print("Item successfully inserted: PENDING \n")
+    submit_job(data)
+  except JobExistsError:
+    return render_template('error.html',
+      title='Job already submitted', alert_level='warning',
+      message="A job was already submitted for this upload."), 409
   except ClientError as e:
     # Handle specific DynamoDB errors
     error_code = e.response['Error']['Code']
-    if error_code == 'ConditionalCheckFailedException':
-        print("Conditional check failed, item may already exist or condition not met")
-    elif error_code == 'ProvisionedThroughputExceededException':
-        print("Provisioned throughput exceeded, consider increasing throughput or implementing backoff/retry strategies")
+    if error_code == 'ProvisionedThroughputExceededException':
+      logger.warning("Provisioned throughput exceeded submitting job %s.", job_id)
     elif error_code == 'ValidationException':
-        print("Validation error:", e.response['Error']['Message'])
+      logger.error("Invalid job %s: %s", job_id, e.response['Error']['Message'])
     else:
-        print("Unexpected error:", e.response['Error']['Message'])
-  except Exception as e:
-    print("Error inserting item:", str(e))
+      logger.exception("Couldn't submit job %s.", job_id)
+    return internal_error(e)
+
+  return render_template('annotate_confirm.html', job_id=job_id)
 
-  # Send message to request queue
-  # Move your code here...
-  # Publish to SNS Topic
-  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-  sns_client = boto3.client('sns')
-  topic_arn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
 
+"""Start a batch annotation request
+Signs a presigned POST for each of up to BATCH_MAX_FILES input files
+(no more than the user's plan admits at once) in one page load; the page uploads the files from the browser and then
+registers them all with annotate_batch_job().
+"""
+@app.route('/annotate/batch', methods=['GET'])
+@authenticated
+def annotate_batch():
+  count = min(request.args.get('files', app.config['BATCH_MAX_FILES'], type=int),
+    submission_burst())
   try:
-    # Publish the message to the SNS topic
-    response = sns_client.publish(
-        TopicArn=topic_arn,
-        Message=str(data),
-        MessageGroupId='annotations_jobs',
-        MessageDeduplicationId=job_id
-    )
-    message_id = response["MessageId"]
+    presigned_posts = sign_input_uploads(session['primary_identity'], count)
+  except ClientError as e:
+    app.logger.error(f"Unable to generate presigned URLs for batch upload: {e}")
+    return abort(500)
+
+  return render_template('annotate_batch.html', s3_posts=presigned_posts)
+
+"""Presigned POSTs for uploading `count` input files (at most
+BATCH_MAX_FILES) under the user's prefix, for XHR uploads: S3 answers
+201 instead of redirecting
+"""
+def sign_input_uploads(user_id, count):
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+
+  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
+  count = min(max(count, 1), app.config['BATCH_MAX_FILES'])
+
+  encryption = app.config['AWS_S3_ENCRYPTION']
+  acl = app.config['AWS_S3_ACL']
+  fields = {
+    "success_action_status": "201",
+    "x-amz-server-side-encryption": encryption,
+    "acl": acl
+  }
+  conditions = [
+    {"success_action_status": "201"},
+    {"x-amz-server-side-encryption": encryption},
+    {"acl": acl}
+  ]
+
+  presigned_posts = []
+  for _ in range(count):
+    key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
+      str(uuid.uuid4()) + '~${filename}'
+    presigned_posts.append(s3.generate_presigned_post(
+      Bucket=bucket_name,
+      Key=key_name,
+      Fields=fields,
+      Conditions=conditions,
+      ExpiresIn=app.config['BATCH_SIGNED_REQUEST_EXPIRATION']))
+  return presigned_posts
+
+
+"""Number of jobs in a batch or API submission request, or None if its
+keys are not a list of 1 to BATCH_MAX_FILES entries (rejected with 400
+by the route before any tokens are taken)
+"""
+def submitted_key_count():
+  keys = (request.get_json(silent=True) or {}).get('keys')
+  if not isinstance(keys, list) or not 1 <= len(keys) <= app.config['BATCH_MAX_FILES']:
+    return None
+  return len(keys)
+
+"""Fires off a batch of annotation jobs
+Accepts the S3 keys uploaded from the batch page as JSON, saves all job
+items in bulk, publishes them in bulk and returns the batch ID.
+"""
+@app.route('/annotate/batch/job', methods=['POST'])
+@authenticated
+@admission_controlled(cost=submitted_key_count)
+def annotate_batch_job():
+  user_id = session['primary_identity']
+  user_email = session['email']
+  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
+  user_prefix = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/'
+
+  keys = (request.get_json(silent=True) or {}).get('keys')
+  if submitted_key_count() is None:
+    return jsonify(error=f"Submit between 1 and {app.config['BATCH_MAX_FILES']} files"), 400
+  # Only accept inputs uploaded under this user's prefix
+  if any(not str(key).startswith(user_prefix) or '~' not in str(key) for key in keys):
+    return forbidden('Unauthorized')
+
+  batch_id = new_batch_id()
+  items = [new_job_item(str(key), bucket_name, user_id, user_email, batch_id=batch_id)
+    for key in keys]
+  if duplicate_job_ids(items):
+    return jsonify(error="Each file can only be submitted once"), 400
+
+  try:
+    submit_jobs(items)
+  except JobExistsError as e:
+    return jsonify(error="Jobs were already submitted for some files",
+      job_ids=e.job_ids), 409
+  except JobsUnavailableError as e:
+    app.logger.warning(f"Unable to check for existing jobs: {e}")
+    return jsonify(error="Too many requests; please retry shortly"), 503, {'Retry-After': '1'}
+  except ClientError:
+    logger.exception("Couldn't submit batch %s.", batch_id)
+    return jsonify(error="Unable to submit batch"), 500
+
+  return jsonify(
+    batch_id=batch_id,
+    job_ids=[item['job_id'] for item in items],
+    url=url_for('annotations_list', batch=batch_id))
+
+
+"""Create a job from an input the user already uploaded, if any
+The browser sends the SHA-256 of the selected file before uploading it.
+If one of the user's earlier inputs has the same digest, it is copied
+server-side to a new input key and the job is created without an
+upload; otherwise the browser falls back to a normal upload.
+"""
+@app.route('/annotate/dedupe', methods=['POST'])
+@authenticated
+def annotate_dedupe():
+  args = request.get_json(silent=True) or {}
+  input_sha256 = clean_sha256(args.get('sha256'))
+  filename = str(args.get('filename', '')).replace('/', '_').replace('\\', '_')
+  if not input_sha256 or not filename:
+    return jsonify(error="Missing digest or file name"), 400
+
+  user_id = session['primary_identity']
+  try:
+    source = find_input_by_digest(user_id, input_sha256)
+  except ClientError as e:
+    app.logger.error(f"Unable to look up input digest: {e}")
+    source = None
+  if not source:
+    return jsonify(found=False), 404
+
+  # Only a job actually created here counts against the user's quota
+  rejected = admit_submission()
+  if rejected:
+    return rejected
+
+  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
+  key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
+    str(uuid.uuid4()) + '~' + filename
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  try:
+    # Managed copy; switches to multipart copy for objects over 5 GB
+    s3.copy(
+      CopySource={'Bucket': source['s3_inputs_bucket'], 'Key': source['s3_key_input_file']},
+      Bucket=bucket_name,
+      Key=key_name,
+      ExtraArgs={
+        'ACL': app.config['AWS_S3_ACL'],
+        'ServerSideEncryption': app.config['AWS_S3_ENCRYPTION']
+      })
+  except ClientError as e:
+    # e.g. the earlier input was deleted; upload as usual
+    app.logger.info(f"Unable to copy deduplicated input: {e}")
+    refund_submission()
+    return jsonify(found=False), 404
 
-    logger.info("Published message to SNS topic: %s", response)  # Logging at INFO level
+  data = new_job_item(key_name, bucket_name, user_id, session['email'],
+    input_sha256=input_sha256)
+  try:
+    submit_job(data)
+  except JobExistsError:
+    refund_submission()
+    return jsonify(error="A job was already submitted for this upload"), 409
+  except ClientError:
+    logger.exception("Couldn't submit job %s.", data['job_id'])
+    refund_submission()
+    return jsonify(error="Unable to submit job"), 500
+
+  return jsonify(found=True, job_id=data['job_id'],
+    url=url_for('annotation_details', id=data['job_id']))
+
+
+"""Multipart upload of large input files
+The browser asks for an upload ID, then for pre-signed URLs for the
+parts it is about to send, PUTs the parts to S3 in parallel (retrying
+single parts, resuming from the uploaded parts after a reload), and
+finally asks the server to complete the upload, which creates the job.
+"""
+def multipart_request_args():
+  user_prefix = app.config['AWS_S3_KEY_PREFIX'] + session['primary_identity'] + '/'
+  args = request.get_json(silent=True) or {}
+  key = str(args.get('key', ''))
+  upload_id = str(args.get('upload_id', ''))
+  # Only let users touch uploads under their own prefix
+  if not key.startswith(user_prefix) or '~' not in key or not upload_id:
+    abort(403)
+  return args, key, upload_id
+
+def multipart_s3_client():
+  return boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
 
+@app.route('/annotate/multipart', methods=['POST'])
+@authenticated
+def annotate_multipart_start():
+  filename = str((request.get_json(silent=True) or {}).get('filename', ''))
+  filename = filename.replace('/', '_').replace('\\', '_')
+  if not filename:
+    return jsonify(error="Missing file name"), 400
+
+  key_name = app.config['AWS_S3_KEY_PREFIX'] + session['primary_identity'] + \
+    '/' + str(uuid.uuid4()) + '~' + filename
+  try:
+    upload = multipart_s3_client().create_multipart_upload(
+      Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+      Key=key_name,
+      ACL=app.config['AWS_S3_ACL'],
+      ServerSideEncryption=app.config['AWS_S3_ENCRYPTION'])
   except ClientError as e:
-    logger.exception("Couldn't publish message to topic %s.", topic_arn)
-    raise  # Re-raises the last exception ??
+    app.logger.error(f"Unable to start multipart upload: {e}")
+    return jsonify(error="Unable to start upload"), 500
 
-  return render_template('annotate_confirm.html', job_id=job_id)
+  return jsonify(key=key_name, upload_id=upload['UploadId'],
+    part_size=app.config['MULTIPART_PART_SIZE'])
+
+@app.route('/annotate/multipart/sign', methods=['POST'])
+@authenticated
+def annotate_multipart_sign():
+  args, key, upload_id = multipart_request_args()
+  try:
+    part_numbers = [int(n) for n in args.get('part_numbers', [])]
+  except (TypeError, ValueError):
+    return jsonify(error="Part numbers must be integers"), 400
+  part_numbers = [n for n in part_numbers
+    if 1 <= n <= 10000][:app.config['MULTIPART_SIGN_BATCH']]
+
+  s3 = multipart_s3_client()
+  urls = {}
+  for part_number in part_numbers:
+    urls[part_number] = s3.generate_presigned_url('upload_part',
+      Params={
+        'Bucket': app.config['AWS_S3_INPUTS_BUCKET'],
+        'Key': key,
+        'UploadId': upload_id,
+        'PartNumber': part_number
+      },
+      ExpiresIn=app.config['BATCH_SIGNED_REQUEST_EXPIRATION'])
+  return jsonify(urls=urls)
+
+@app.route('/annotate/multipart/parts', methods=['POST'])
+@authenticated
+def annotate_multipart_parts():
+  args, key, upload_id = multipart_request_args()
+  s3 = multipart_s3_client()
+  parts = []
+  try:
+    paginator = s3.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+      Key=key, UploadId=upload_id):
+      parts.extend({'PartNumber': p['PartNumber'], 'ETag': p['ETag'], 'Size': p['Size']}
+        for p in page.get('Parts', []))
+  except ClientError as e:
+    # Upload expired or was aborted; the browser starts a new one
+    return jsonify(error=e.response['Error']['Code']), 404
+  return jsonify(parts=parts)
+
+@app.route('/annotate/multipart/complete', methods=['POST'])
+@authenticated
+@admission_controlled()
+def annotate_multipart_complete():
+  args, key, upload_id = multipart_request_args()
+  try:
+    parts = sorted(({'PartNumber': int(p['PartNumber']), 'ETag': str(p['ETag'])}
+      for p in args.get('parts', [])), key=lambda p: p['PartNumber'])
+  except (TypeError, ValueError, KeyError):
+    return jsonify(error="Invalid parts list"), 400
+  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
+
+  try:
+    multipart_s3_client().complete_multipart_upload(
+      Bucket=bucket_name,
+      Key=key,
+      UploadId=upload_id,
+      MultipartUpload={'Parts': parts})
+  except ClientError as e:
+    app.logger.error(f"Unable to complete multipart upload: {e}")
+    return jsonify(error="Unable to complete upload"), 500
+
+  data = new_job_item(key, bucket_name,
+    session['primary_identity'], session['email'],
+    input_sha256=clean_sha256(args.get('sha256')))
+  try:
+    submit_job(data)
+  except JobExistsError:
+    return jsonify(error="A job was already submitted for this upload"), 409
+  except ClientError:
+    logger.exception("Couldn't submit job %s.", data['job_id'])
+    return jsonify(error="Unable to submit job"), 500
+
+  return jsonify(job_id=data['job_id'],
+    url=url_for('annotation_details', id=data['job_id']))
+
+@app.route('/annotate/multipart/abort', methods=['POST'])
+@authenticated
+def annotate_multipart_abort():
+  args, key, upload_id = multipart_request_args()
+  try:
+    multipart_s3_client().abort_multipart_upload(
+      Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=key, UploadId=upload_id)
+  except ClientError as e:
+    app.logger.error(f"Unable to abort multipart upload: {e}")
+  return jsonify(aborted=True)
 
 
 """List all annotations for the user
@@ -182,10 +468,17 @@ def annotations_list():
   dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
   table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])  # Replace 'YourTableName' with your actual table name
 
+  # ?batch=<batch_id> lists only the jobs of one batch submission
+  query = {
+    'IndexName': 'user_id_index',  # If querying on a secondary index
+    'KeyConditionExpression': Key('user_id').eq(user_id)
+  }
+  batch_id = request.args.get('batch')
+  if batch_id:
+    query['FilterExpression'] = Attr('batch_id').eq(batch_id)
+
   try :
-    response = table.query(
-          IndexName='user_id_index',  # If querying on a secondary index
-          KeyConditionExpression=Key('user_id').eq(user_id))
+    response = table.query(**query)
   except ClientError as e:
     error_code = e.response['Error']['Code']
     print(f"An unexpected error occurred: {e}. Error Code : {error_code}")
@@ -196,7 +489,62 @@ def annotations_list():
   for annotation in annotations:
     annotation['submit_time'] = convert_epoch_to_datetime(annotation['submit_time'])
 
-  return render_template('annotations.html', annotations=annotations)
+  return render_template('annotations.html', annotations=annotations,
+    batch_id=batch_id, summary=user_job_summary())
+
+
+"""Download all of the user's results and logs as one zip (premium only)
+The zip is streamed while it is built from S3; results still archived
+in Glacier are left out and listed in the zip's MANIFEST.txt.
+"""
+@app.route('/annotations/export', methods=['GET'])
+@authenticated
+@is_premium
+def annotations_export():
+  user_id = session['primary_identity']
+  try:
+    jobs = list(iter_user_jobs(user_id, attributes=['job_id', 'job_status',
+      'submit_time', 'complete_time', 's3_key_result_file', 's3_key_log_file',
+      'results_file_archive_id', 'restore_message']))
+  except ClientError as e:
+    app.logger.error(f"Unable to list jobs for export: {e}")
+    return abort(500)
+  entries, skipped = export_entries(jobs)
+
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  stream = zip_stream(s3, app.config['AWS_S3_RESULTS_BUCKET'], entries, skipped,
+    concurrency=app.config['EXPORT_CONCURRENCY'],
+    chunk_size=app.config['EXPORT_CHUNK_SIZE'],
+    queue_chunks=app.config['EXPORT_QUEUE_CHUNKS'])
+  file_name = f"gas-annotations-{datetime.utcnow().strftime('%Y%m%d')}.zip"
+  return Response(stream_with_context(stream), mimetype='application/zip',
+    headers={
+      'Content-Disposition': f'attachment; filename="{file_name}"',
+      'X-Accel-Buffering': 'no'
+    })
+
+
+"""Stream status changes of the user's jobs as server-sent events
+Pages listen here instead of reloading to poll for progress, passing the
+unfinished jobs they show as job_id and job_status parameters.
+"""
+@app.route('/annotations/stream', methods=['GET'])
+@authenticated
+def annotations_stream():
+  user_id = session['primary_identity']
+  watch = dict(list(zip(request.args.getlist('job_id'),
+    request.args.getlist('job_status')))[:app.config['JOB_STREAM_MAX_WATCHED']])
+
+  # Streams hold a worker thread each; past the cap, the page retries later
+  if not job_streams.acquire(blocking=False):
+    retry = app.config['JOB_STREAM_RETRY']
+    return Response(f"retry: {retry * 1000}\n\n", status=503,
+      mimetype='text/event-stream', headers={'Retry-After': str(retry)})
+  response = Response(stream_with_context(job_status_stream(user_id, watch=watch)),
+    mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+  response.call_on_close(job_streams.release)
+  return response
 
 
 """Display details of a specific annotation job
@@ -209,25 +557,21 @@ def annotation_details(id):
     region_name=app.config['AWS_REGION_NAME'],
     config=Config(signature_version='s3v4'))
 
-  # Initialize a DynamoDB client
-  dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-  table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])  # Replace 'YourTableName' with your actual table name
-
   bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   user_id = session['primary_identity']
 
-  # query for job
+  # query for job (served from the job cache on repeat views)
   try :
-    response = table.get_item(Key = { 'job_id': id })
+    annotation = get_job(id)
   except ClientError as e:
     error_code = e.response['Error']['Code']
     print(f"An unexpected error occurred: {e}. Error Code : {error_code}")
+    return internal_error(e)
   except Exception as e:
     print(e)
     return internal_error(e)
-
-  # parsing the results
-  annotation = response['Item']
+  if annotation is None:
+    return page_not_found(id)
 
   # -- Authorize user --
   if user_id != annotation['user_id']:
@@ -282,41 +626,108 @@ def annotation_details(id):
 @app.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
 def annotation_log(id):
-  # Initialize a DynamoDB client
-  dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-  table = dynamodb.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])  # Replace 'YourTableName' with your actual table name
   user_id = session['primary_identity']
 
-  # query for job
+  # query for job; the log view only needs the owner and the log key
   try :
-    response = table.get_item(Key = { 'job_id': id })
+    annotation = get_job(id, attributes=['user_id', 's3_key_log_file'])
   except ClientError as e:
     error_code = e.response['Error']['Code']
     print(f"An unexpected error occurred: {e}. Error Code : {error_code}")
+    return internal_error(e)
   except Exception as e:
     print(e)
     return internal_error(e)
-  # parsing the results
-  annotation = response['Item']
+  if annotation is None:
+    return page_not_found(id)
   # -- Authorize user --
   if user_id != annotation['user_id']:
     print('Unauthorized User')
     return forbidden('Unauthorized')
   log_file_key = annotation['s3_key_log_file']
 
+  # ?tail=<KB> shows only the end of the log, fetched with a ranged GET
+  tail_kb = request.args.get('tail', type=int)
+  if tail_kb is not None and tail_kb <= 0:
+    tail_kb = app.config['LOG_TAIL_DEFAULT_KB']
+
   # Create a session client to the S3 service
   s3 = boto3.client('s3',
     region_name=app.config['AWS_REGION_NAME'],
     config=Config(signature_version='s3v4'))
   try:
-    # Fetch the file object from S3
-    file_obj = s3.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=log_file_key)
-    # Read the file content
-    log_file_contents = file_obj['Body'].read().decode('utf-8')
+    # Open the log object; the body is streamed into the page below
+    file_obj, truncated = open_object(s3,
+      app.config['AWS_S3_RESULTS_BUCKET'], log_file_key,
+      tail_bytes=(tail_kb * 1024 if tail_kb else None))
+  except ClientError as e:
+    app.logger.error(f"Error fetching log file from S3: {e}")
+    return abort(500)
+
+  log_chunks = iter_text(file_obj,
+    chunk_size=app.config['LOG_STREAM_CHUNK_SIZE'],
+    skip_partial_line=truncated)
+
+  return Response(stream_with_context(stream_template('view_log.html',
+    log_chunks=log_chunks, job_id=id, tail_kb=tail_kb,
+    truncated=truncated, default_tail_kb=app.config['LOG_TAIL_DEFAULT_KB'])))
+
+"""Preview a page of the annotated results file
+Reads only the requested page of the result object with a ranged GET;
+?offset=<byte> pages forward through the file.
+"""
+@app.route('/annotations/<id>/preview', methods=['GET'])
+@authenticated
+def annotation_preview(id):
+  user_id = session['primary_identity']
+
+  try :
+    annotation = get_job(id, attributes=['user_id', 'job_status',
+      's3_key_result_file', 'results_file_archive_id', 'restore_message'])
+  except ClientError as e:
+    error_code = e.response['Error']['Code']
+    print(f"An unexpected error occurred: {e}. Error Code : {error_code}")
+    return internal_error(e)
   except Exception as e:
-    print(f"Error fetching file from S3: {e}")
+    print(e)
+    return internal_error(e)
+  if annotation is None or 's3_key_result_file' not in annotation:
+    return page_not_found(id)
+
+  # -- Authorize user --
+  if user_id != annotation['user_id']:
+    print('Unauthorized User')
+    return forbidden('Unauthorized')
+
+  # Archived results are only available to premium users, once restored
+  if 'results_file_archive_id' in annotation:
+    if session['role'] != 'premium_user':
+      return redirect(url_for('subscribe'))
+    if annotation.get('restore_message'):
+      flash(annotation['restore_message'], 'info')
+      return redirect(url_for('annotation_details', id=id))
+
+  offset = max(request.args.get('offset', 0, type=int), 0)
+
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+  try:
+    page = read_page(s3, app.config['AWS_S3_RESULTS_BUCKET'],
+      annotation['s3_key_result_file'], offset=offset,
+      page_bytes=app.config['PREVIEW_PAGE_BYTES'])
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'InvalidRange':
+      # Offset past the end of the file; start over
+      return redirect(url_for('annotation_preview', id=id))
+    app.logger.error(f"Error fetching results preview from S3: {e}")
+    return abort(500)
 
-  return render_template('view_log.html', log_file_contents=log_file_contents, job_id=id)
+  header = [line for line in page['lines'] if line.startswith('#')]
+  records = [line for line in page['lines'] if not line.startswith('#')]
+
+  return render_template('preview.html', job_id=id, page=page,
+    header=header, records=records)
 
 """Subscription management handler
 """
@@ -367,6 +778,23 @@ def subscribe():
     # Display confirmation page
     return render_template('subscribe_confirm.html')
 
+"""Job submission admission counters (admins only)
+"""
+@app.route('/admin/admission', methods=['GET'])
+@authenticated
+@is_admin
+def admin_admission():
+  return jsonify(submission_admission.counters())
+
+"""Route latency histograms and AWS/database call timings (admins only)
+Counted by the worker that serves the request only; see metrics.py.
+"""
+@app.route('/admin/metrics', methods=['GET'])
+@authenticated
+@is_admin
+def admin_metrics():
+  return jsonify(metrics.snapshot())
+
 """Reset subscription
 """
 @app.route('/unsubscribe', methods=['GET'])
@@ -377,9 +805,172 @@ def unsubscribe():
     identity_id=session['primary_identity'],
     role="free_user"
   )
+  session['role'] = "free_user"
   return redirect(url_for('profile'))
 
+# --------------------JSON API----------------------------------
+"""Sign uploads for programmatic job submission
+POST {"files": n}; returns {"uploads": [{"url", "fields"}, ...]}. Each
+file is POSTed to S3 as multipart/form-data with the fields plus a
+"file" field, and the resulting key ("key" with ${filename} replaced)
+is then submitted to POST /api/v1/jobs.
+"""
+@app.route('/api/v1/uploads', methods=['POST'])
+@api_authenticated
+def api_sign_uploads():
+  count = (request.get_json(silent=True) or {}).get('files', 1)
+  if not isinstance(count, int) or not 1 <= count <= app.config['BATCH_MAX_FILES']:
+    return jsonify(error=f"files must be between 1 and {app.config['BATCH_MAX_FILES']}"), 400
+  try:
+    uploads = sign_input_uploads(session['primary_identity'], count)
+  except ClientError as e:
+    app.logger.error(f"Unable to generate presigned URLs for API upload: {e}")
+    return jsonify(error="Unable to sign uploads"), 500
+  return jsonify(uploads=uploads)
+
+"""Submit jobs for uploaded inputs
+POST {"keys": [s3 key, ...]} (at most BATCH_MAX_FILES); the jobs share a
+batch ID when there is more than one. Returns 201 with the job IDs.
+"""
+@app.route('/api/v1/jobs', methods=['POST'])
+@api_authenticated
+@admission_controlled(cost=submitted_key_count)
+def api_submit_jobs():
+  user_id = session['primary_identity']
+  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
+  user_prefix = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/'
+
+  keys = (request.get_json(silent=True) or {}).get('keys')
+  if submitted_key_count() is None:
+    return jsonify(error=f"keys must list between 1 and {app.config['BATCH_MAX_FILES']} S3 keys"), 400
+  # Only accept inputs uploaded under this user's prefix
+  if any(not str(key).startswith(user_prefix) or '~' not in str(key) for key in keys):
+    return jsonify(error="Keys must be inputs uploaded by this user"), 403
+
+  batch_id = new_batch_id() if len(keys) > 1 else None
+  items = [new_job_item(str(key), bucket_name, user_id, session['email'],
+    batch_id=batch_id) for key in keys]
+  if duplicate_job_ids(items):
+    return jsonify(error="keys must not submit the same job twice",
+      job_ids=duplicate_job_ids(items)), 400
+  try:
+    if len(items) == 1:
+      submit_job(items[0])
+    else:
+      submit_jobs(items)
+  except JobExistsError as e:
+    return jsonify(error="Jobs already exist for some keys", job_ids=e.job_ids), 409
+  except JobsUnavailableError as e:
+    app.logger.warning(f"Unable to check for existing jobs: {e}")
+    return jsonify(error="Too many requests; please retry shortly"), 503, {'Retry-After': '1'}
+  except ClientError:
+    logger.exception("Couldn't submit jobs from the API.")
+    return jsonify(error="Unable to submit jobs"), 500
+
+  return jsonify(
+    batch_id=batch_id,
+    job_ids=[item['job_id'] for item in items]), 201
+
+"""List the user's jobs a page at a time
+GET ?limit=n (at most API_PAGE_MAX) &cursor=<next_cursor of the previous
+page>. Returns {"jobs": [...], "next_cursor": cursor or null}.
+"""
+@app.route('/api/v1/jobs', methods=['GET'])
+@api_authenticated
+def api_list_jobs():
+  limit = request.args.get('limit', app.config['API_PAGE_DEFAULT'], type=int)
+  limit = min(max(limit, 1), app.config['API_PAGE_MAX'])
+  try:
+    items, next_cursor = list_jobs(session['primary_identity'], limit=limit,
+      cursor=request.args.get('cursor'), attributes=API_JOB_ATTRIBUTES)
+  except ValueError:
+    return jsonify(error="Invalid cursor"), 400
+  except ClientError as e:
+    app.logger.error(f"Unable to list jobs: {e}")
+    return jsonify(error="Unable to list jobs"), 500
+
+  return jsonify(jobs=[plain_item(item) for item in items], next_cursor=next_cursor)
+
+"""Status of many jobs at once
+POST {"job_ids": [...]} (at most API_STATUS_MAX_JOBS). Returns
+{"jobs": {job_id: job}, "not_found": [...]}; other users' jobs are
+reported as not found.
+"""
+@app.route('/api/v1/jobs/status', methods=['POST'])
+@api_authenticated
+def api_jobs_status():
+  job_ids = (request.get_json(silent=True) or {}).get('job_ids')
+  if not isinstance(job_ids, list) or \
+    not 1 <= len(job_ids) <= app.config['API_STATUS_MAX_JOBS'] or \
+    not all(isinstance(job_id, str) and job_id for job_id in job_ids):
+    return jsonify(error=f"job_ids must list between 1 and {app.config['API_STATUS_MAX_JOBS']} job IDs"), 400
+
+  try:
+    items = batch_get_jobs(job_ids, attributes=API_JOB_ATTRIBUTES + ('user_id',))
+  except JobsUnavailableError as e:
+    app.logger.warning(f"Unable to get job status: {e}")
+    return jsonify(error="Too many requests; please retry shortly"), 503, {'Retry-After': '1'}
+  except ClientError as e:
+    app.logger.error(f"Unable to get job status: {e}")
+    return jsonify(error="Unable to get job status"), 500
+
+  user_id = session['primary_identity']
+  jobs = {job_id: api_job(item) for job_id, item in items.items()
+    if item.get('user_id') == user_id}
+  return jsonify(jobs=jobs,
+    not_found=[job_id for job_id in dict.fromkeys(job_ids) if job_id not in jobs])
+
+"""One job's details
+"""
+@app.route('/api/v1/jobs/<id>', methods=['GET'])
+@api_authenticated
+def api_job_details(id):
+  try:
+    item = get_job(id)
+  except ClientError as e:
+    app.logger.error(f"Unable to get job {id}: {e}")
+    return jsonify(error="Unable to get job"), 500
+  if not item or item.get('user_id') != session['primary_identity']:
+    return jsonify(error="Job not found"), 404
+  return jsonify(api_job(item, API_JOB_ATTRIBUTES + API_JOB_DETAIL_ATTRIBUTES))
+
+# Job attributes returned by the API (details add the file keys)
+API_JOB_ATTRIBUTES = ('job_id', 'job_status', 'submit_time', 'complete_time',
+  'input_file_name', 'batch_id')
+API_JOB_DETAIL_ATTRIBUTES = ('s3_key_result_file', 's3_key_log_file',
+  'results_file_archive_id')
+
+def api_job(item, attributes=API_JOB_ATTRIBUTES):
+  return plain_item({k: item[k] for k in attributes if k in item})
+
 # --------------------Util functions----------------------------
+"""Current user's job summary counters, or None if unavailable
+Also available to templates (e.g. the profile page) as job_summary().
+"""
+def user_job_summary():
+  try:
+    return get_job_summary(session['primary_identity'])
+  except ClientError as e:
+    app.logger.error(f"Unable to get job summary: {e}")
+    return None
+
+@app.context_processor
+def inject_job_summary():
+  return {'job_summary': user_job_summary}
+
+"""Return a client-supplied SHA-256 hex digest, normalized, or None"""
+def clean_sha256(value):
+  value = str(value or '').strip().lower()
+  return value if re.fullmatch('[0-9a-f]{64}', value) else None
+
+"""Render a template as a stream of fragments (like Flask's
+stream_template), so large values can be generators
+"""
+def stream_template(template_name, **context):
+  app.update_template_context(context)
+  template = app.jinja_env.get_template(template_name)
+  return template.stream(context)
+
 def convert_epoch_to_datetime(epoch):
     return datetime.utcfromtimestamp(int(epoch)).strftime('%Y-%m-%d %H:%M:%S UTC')
 